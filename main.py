@@ -4,25 +4,46 @@ import ast
 import json
 import configparser
 from databricks.sdk import AccountClient
+from databricks.sdk.config import Config
 import logging
+import logging.handlers
 import os
+import queue
+import atexit
+import time
+import threading
+import hashlib
+import io
+import contextlib
+import copy
+import subprocess
+import sys
+import concurrent.futures
+import argparse
+import collections
+import collections.abc
+import urllib.parse
 import datetime
-from databricks.sdk.service.iam import ComplexValue
-# import time
+import array
+import random
+import tracemalloc
+import csv
+import itertools
+import struct
+import uuid
+import shutil
+import tempfile
+import re
+import email.utils
+from databricks.sdk.service.iam import ComplexValue, Patch, PatchOp, PatchSchema
+from databricks.sdk import errors as db_errors
+
+try:
+    import fcntl
+except ImportError:  # Windows: shards on one node still work, but principal creation is not locked
+    fcntl = None
 
 
-# Configure logging to both stdout and a log file
-log_dir = 'logs'
-log_filename = f"{log_dir}/ad_sync_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # Log to stdout
-        logging.FileHandler(log_filename)  # Log to a file with timestamp suffix
-    ]
-)
-
 # Create ConfigParser object and read values from cred.ini file.
 config = configparser.ConfigParser()
 config.read('cred.ini')
@@ -35,9 +56,286 @@ scim_url = config.get("databricks", "scim_url")
 databricks_account_number = config.get("databricks", "databricks_account_number")
 azure_databricks_host = config.get("databricks", "azure_databricks_host")
 
+
+class JsonLogFormatter(logging.Formatter):
+    """
+        Formats log records as one JSON object per line.
+
+        Records emitted through log_event() carry an 'event' name and a dict of 'fields' which are written as
+        top level keys. Plain logging calls are written with their rendered message only.
+    """
+
+    def format(self, record):
+        payload = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+        }
+        event = getattr(record, "event", None)
+        if event:
+            payload["event"] = event
+            payload.update(getattr(record, "fields", {}))
+        else:
+            payload["message"] = record.getMessage()
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class _TracebackQueueHandler(logging.handlers.QueueHandler):
+    """
+        QueueHandler that keeps the traceback of a record for the handlers of the QueueListener.
+
+        QueueHandler.prepare() merges the traceback into the message and drops 'exc_info', so the JsonLogFormatter of
+        the log file would never see it. Here the message is rendered without it and the traceback is kept as
+        'exc_text', which both the JSON and the text formatter write.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _EventFields:
+    """
+        Renders the fields of a structured log record as 'key=value' pairs, only when a handler asks for the message.
+    """
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(f"{key}={value}" for key, value in self.fields.items())
+
+
+def log_event(level, event, **fields):
+    """
+        Emits a structured log record.
+
+        The record is dropped before any formatting if 'level' is not enabled, so callers can pass counters and ids
+        freely on the hot path. Text handlers render the record as 'event key=value ...', the JSON handler writes
+        the fields as keys of the JSON object.
+
+        Args:
+            level (int): Logging level, e.g. logging.INFO.
+            event (str): Short snake_case event name, e.g. 'group_apply_summary'.
+            **fields: Values attached to the record.
+
+        Returns:
+            None
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", event, _EventFields(fields), extra={"event": event, "fields": fields})
+
+
+def configure_logging(log_config):
+    """
+        Configures logging to both stdout and a log file using the [logging] section of cred.ini.
+
+        Supported options are 'level' (default INFO), 'file_format' ('json' or 'text', default json) and
+        'async_file' (default false). With 'async_file' enabled, records are handed to a QueueHandler and written
+        to the log file by a QueueListener thread, so file I/O does not block the sync threads.
+
+        Args:
+            log_config (configparser.SectionProxy or dict): The [logging] options.
+
+        Returns:
+            str: The log file name.
+    """
+    log_dir = 'logs'
+    # Worker processes of a sharded run (see run_shard_processes()) get their own log file.
+    log_suffix = f"_{os.environ['AD_SYNC_LOG_SUFFIX']}" if os.environ.get("AD_SYNC_LOG_SUFFIX") else ""
+    log_filename = f"{log_dir}/ad_sync_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}{log_suffix}.log"
+    level = logging.getLevelName(str(log_config.get("level", "INFO")).upper())
+    text_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    stream_handler = logging.StreamHandler()  # Log to stdout
+    stream_handler.setFormatter(text_formatter)
+    file_handler = logging.FileHandler(log_filename)  # Log to a file with timestamp suffix
+    if str(log_config.get("file_format", "json")).lower() == "json":
+        file_handler.setFormatter(JsonLogFormatter())
+    else:
+        file_handler.setFormatter(text_formatter)
+
+    handlers = [stream_handler]
+    if str(log_config.get("async_file", "false")).lower() in ("true", "1", "yes"):
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers.append(_TracebackQueueHandler(log_queue))
+    else:
+        handlers.append(file_handler)
+
+    logging.basicConfig(level=level, handlers=handlers)
+    return log_filename
+
+
+# Configure logging to both stdout and a log file
+log_filename = configure_logging(config["logging"] if config.has_section("logging") else {})
+logger = logging.getLogger("ad_sync")
+
+# Folder of the temp files with the crawled members of each group.
+tmp_files_folder = 'groups_users_sps'
+
+# Recording and replay.
+# With AD_SYNC_RECORD=<file>, every HTTP request of the run (Graph, Azure login and Databricks Account API) is recorded
+# with its response and latency, and the exchanges are written to <file> when the run ends. With AD_SYNC_REPLAY=<file>
+# the responses are served from such a cassette instead, after their recorded latency (times
+# AD_SYNC_REPLAY_LATENCY_SCALE), and no request leaves the process. Both hook into requests.Session.send, which all
+# three clients use, so they are installed before the clients are created. The --record, --replay and --perf-gate
+# modes run a sync with these variables in a scratch folder, see run_sync_in_scratch_dir().
+http_record_file = os.environ.get("AD_SYNC_RECORD")
+http_replay_file = os.environ.get("AD_SYNC_REPLAY")
+http_replay_latency_scale = float(os.environ.get("AD_SYNC_REPLAY_LATENCY_SCALE", "1"))
+http_stats_file = os.environ.get("AD_SYNC_HTTP_STATS")
+http_recorded_headers = ("Content-Type", "Retry-After", "Location")
+http_exchanges = []  # recorded exchanges of this run
+http_replay_queues = {}  # exchange key -> recorded exchanges not served yet
+http_stats = {"calls": 0, "misses": 0, "request_bytes": 0, "response_bytes": 0, "groups": 0}
+http_lock = threading.Lock()
+http_started = time.perf_counter()
+
+
+def canonical_json_body(body):
+    """
+        Returns a request or response body as canonical JSON (sorted keys), or None if it is empty or not JSON.
+    """
+    if not body:
+        return None
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+
+
+def canonical_url(url):
+    """
+        Returns a URL with its query options sorted and encoded the same way, so equivalent encodings compare equal.
+        Canonical URLs are their own canonical form, so cassettes can store them.
+    """
+    base, _, query = url.partition("?")
+    pairs = sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))
+    return f"{base}?{urllib.parse.urlencode(pairs, quote_via=urllib.parse.quote)}" if pairs else base
+
+
+def http_exchange_key(method, url, request_body):
+    """
+        Returns the key a request is matched by on replay: method, canonical URL and canonical JSON body. Bodies that
+        are not JSON, e.g. token requests, are not part of the key.
+    """
+    return f"{method} {canonical_url(url)} {canonical_json_body(request_body) or ''}"
+
+
+def recording_send(session, request, **kwargs):
+    """
+        requests.Session.send replacement that records every exchange.
+    """
+    started = time.perf_counter()
+    response = original_session_send(session, request, **kwargs)
+    elapsed = time.perf_counter() - started
+    content = response.content
+    with http_lock:
+        http_exchanges.append({
+            "method": request.method, "url": canonical_url(request.url),
+            "request_body": canonical_json_body(request.body), "status": response.status_code,
+            "headers": {name: response.headers[name] for name in http_recorded_headers if name in response.headers},
+            "body": content.decode("utf-8", "replace"), "elapsed_s": round(elapsed, 4)})
+        count_http_exchange(request, len(content))
+    return response
+
+
+def replaying_send(session, request, **kwargs):
+    """
+        requests.Session.send replacement that serves the exchanges of the replayed cassette. A request that is not
+        in the cassette gets a 501 response. The last recorded response of a request is served again once all its
+        recorded responses were served.
+    """
+    key = http_exchange_key(request.method, request.url, request.body)
+    with http_lock:
+        recorded = http_replay_queues.get(key)
+        exchange = (recorded.popleft() if len(recorded) > 1 else recorded[0]) if recorded else None
+        if exchange is None:
+            http_stats["misses"] += 1
+    if exchange is None:
+        log_event(logging.WARNING, "http_replay_miss", method=request.method, url=canonical_url(request.url))
+        exchange = {"status": 501, "headers": {"Content-Type": "application/json"}, "elapsed_s": 0,
+                    "body": json.dumps({"error": "request not in cassette"})}
+    time.sleep(exchange["elapsed_s"] * http_replay_latency_scale)
+    response = requests.Response()
+    response.status_code = exchange["status"]
+    response.headers = requests.structures.CaseInsensitiveDict(exchange["headers"])
+    response._content = exchange["body"].encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    with http_lock:
+        count_http_exchange(request, len(response._content))
+    return response
+
+
+def count_http_exchange(request, response_bytes):
+    """
+        Counts an exchange in 'http_stats'. Needs http_lock.
+    """
+    body = request.body or b""
+    http_stats["calls"] += 1
+    http_stats["request_bytes"] += len(body.encode("utf-8") if isinstance(body, str) else body)
+    http_stats["response_bytes"] += response_bytes
+
+
+def finish_http_cassette():
+    """
+        Writes the recorded exchanges and the HTTP stats of the run, see the AD_SYNC_* variables above.
+    """
+    with http_lock:
+        if http_record_file:
+            with open(http_record_file, "w") as f:
+                json.dump({"exchanges": http_exchanges}, f)
+        if http_stats_file:
+            with open(http_stats_file, "w") as f:
+                json.dump(dict(http_stats, wall_s=round(time.perf_counter() - http_started, 3)), f)
+
+
+original_session_send = requests.Session.send
+if http_replay_file:
+    with open(http_replay_file, "r") as cassette_in:
+        for recorded_exchange in json.load(cassette_in)["exchanges"]:
+            http_replay_queues.setdefault(http_exchange_key(recorded_exchange["method"], recorded_exchange["url"],
+                                                            recorded_exchange["request_body"]),
+                                          collections.deque()).append(recorded_exchange)
+    requests.Session.send = replaying_send
+elif http_record_file:
+    requests.Session.send = recording_send
+if http_record_file or http_replay_file or http_stats_file:
+    atexit.register(finish_http_cassette)
+
 msal_scope = ["https://graph.microsoft.com/.default"]
 msal_authority = f"https://login.microsoftonline.com/{tenant_id}"
-a = AccountClient(host=azure_databricks_host, account_id=databricks_account_number)
+# The Databricks SDK retries failed calls on its own for up to retry_timeout_seconds and then raises a TimeoutError.
+# Retries are made by call_throttled() instead (see "Throttling" below), which also lets the limiter see every
+# throttled call: with a timeout of 1 second, the SDK gives up after its first attempt.
+databricks_sdk_retry_timeout_seconds = config.getint("throttling", "databricks_sdk_retry_timeout_seconds", fallback=1)
+
+
+def new_account_client(host, account_id):
+    """
+        Creates an AccountClient for a Databricks Account that leaves retries to call_throttled().
+    """
+    return AccountClient(config=Config(host=host, account_id=account_id,
+                                       retry_timeout_seconds=databricks_sdk_retry_timeout_seconds))
+
+
+a = new_account_client(azure_databricks_host, databricks_account_number)
 
 msal_app = ConfidentialClientApplication(
     client_id=client_id,
@@ -63,833 +361,4678 @@ msal_app = ConfidentialClientApplication(
 )
 
 
-# acquire Active Directory access Token
-def get_access_token():
+# Throttling.
+# Every Graph request and every Databricks Account API call goes through the limiter of its endpoint family
+# ('graph:<endpoint>' or 'databricks:<target>:<service>'). A limiter combines a token bucket, which allows bursts of
+# up to '<service>_burst' requests at a sustained '<service>_requests_per_second', with a limit on the requests in
+# flight. Both limits are adapted AIMD-style: every throttled response (429, 5xx) multiplies them by 'decrease_factor',
+# and every full window of successful requests raises them by 'additive_increase', up to the configured rate and
+# 'max_concurrency'. A Retry-After blocks the whole family for that long, so the waiting threads do not all retry
+# at once. Graph throttles per application and tenant, not per endpoint, so all Graph families also share the limiter
+# 'graph': together they never exceed the configured Graph rate, each family can only narrow it further, and a
+# throttled Graph request slows down and blocks all of them. Throttled requests are retried up to 'max_retries' times
+# with jittered exponential backoff, unless the Databricks SDK already waited for the Retry-After. This is the
+# only retry layer: the Databricks SDK gives up after one attempt (see new_account_client()), and membership writes,
+# which MembershipWriter retries with smaller chunks, are not retried here. Calls that create principals or groups are
+# not retried after connection errors and timeouts, which may have happened after the principal was created.
+throttle_settings = {
+    service: {
+        "rate": config.getfloat("throttling", f"{service}_requests_per_second", fallback=default_rate),
+        "burst": config.getfloat("throttling", f"{service}_burst", fallback=default_burst),
+    }
+    for service, default_rate, default_burst in (("graph", 50.0, 20.0), ("databricks", 20.0, 10.0))
+}
+throttle_max_concurrency = config.getint("throttling", "max_concurrency", fallback=16)
+throttle_initial_concurrency = config.getint("throttling", "initial_concurrency", fallback=4)
+throttle_min_rate = config.getfloat("throttling", "min_requests_per_second", fallback=0.5)
+throttle_decrease_factor = config.getfloat("throttling", "decrease_factor", fallback=0.5)
+throttle_additive_increase = config.getfloat("throttling", "additive_increase", fallback=1.0)
+throttle_max_retries = config.getint("throttling", "max_retries", fallback=6)
+throttle_backoff_seconds = config.getfloat("throttling", "backoff_seconds", fallback=1.0)
+throttle_max_backoff_seconds = config.getfloat("throttling", "max_backoff_seconds", fallback=60.0)
+graph_retry_statuses = {429, 500, 502, 503, 504}
+db_throttling_errors = (db_errors.TooManyRequests, db_errors.TemporarilyUnavailable,
+                        db_errors.RequestLimitExceeded, db_errors.ResourceExhausted)
+# (service, method) of the AccountClient calls that are retried by their callers, see MembershipWriter.
+db_caller_retried_calls = {("groups", "patch")}
+db_non_idempotent_methods = {"create"}
+# Services whose families share one limiter named after the service.
+throttle_shared_services = {"graph"}
+throttle_limiters = {}
+throttle_limiters_lock = threading.Lock()
+
+
+class AdaptiveLimiter:
     """
-    Acquires an Azure Active Directory Access Token.
-
-    This function retrieves an access token from Azure Active Directory using Microsoft Authentication Library (MSAL).
+        Token bucket and concurrency limit of one endpoint family, adapted to throttling AIMD-style.
 
-    Returns:
-        str: Azure Active Directory Access Token.
+        A family with a 'parent' limiter also takes a token and a request slot from it, and its outcome adapts the
+        parent as well.
+    """
 
-    Raises:
-        Exception: If unable to obtain the access token.
+    def __init__(self, family, rate, burst, max_concurrency, parent=None):
+        self.family = family
+        self.parent = parent
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max(1, min(throttle_initial_concurrency, max_concurrency)))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "waited_s": 0.0}
+
+    def acquire(self):
+        """
+            Blocks until the family is not blocked by a Retry-After, a request slot is free and a token is available.
+
+            Returns:
+                float: The time the request was started at, to be passed to release().
+        """
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.max_rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if now < self.blocked_until:
+                    self.condition.wait(self.blocked_until - now)
+                elif self.max_concurrency > 0 and self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                elif self.max_rate > 0 and self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+            if self.max_rate > 0:
+                self.tokens -= 1
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            self.stats["waited_s"] += now - started
+        if self.parent:
+            self.parent.acquire()
+        return now
+
+    def release(self, started, throttled=False, retry_after=None):
+        """
+            Frees the request slot and adapts the limits to the outcome of the request.
+
+            Args:
+                started (float): The value returned by acquire().
+                throttled (bool): Whether the request was throttled.
+                retry_after (float): Seconds the service asked to wait before the next request. Optional.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.stats["throttled"] += 1
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                # Requests that were already in flight when the limits were lowered do not lower them again.
+                if started >= self.last_decrease:
+                    self.last_decrease = now
+                    self.concurrency = max(1.0, self.concurrency * throttle_decrease_factor)
+                    if self.max_rate > 0:
+                        self.rate = max(min(throttle_min_rate, self.max_rate), self.rate * throttle_decrease_factor)
+                        self.tokens = min(self.tokens, 0.0)
+            else:
+                # Grows by 'additive_increase' once per window of successful requests.
+                if self.max_concurrency > 0:
+                    self.concurrency = min(self.max_concurrency,
+                                           self.concurrency + throttle_additive_increase / self.concurrency)
+                if self.max_rate > 0:
+                    self.rate = min(self.max_rate, self.rate + throttle_additive_increase / max(1.0, self.rate))
+            self.condition.notify_all()
+        if self.parent:
+            self.parent.release(started, throttled, retry_after)
+
+
+def throttle_limiter(family):
     """
-    result = msal_app.acquire_token_silent(
-        scopes=msal_scope,
-        account=None
-    )
-    if not result:
-        result = msal_app.acquire_token_for_client(
-            scopes=msal_scope
-        )
+        Returns the limiter of an endpoint family, creating it with the settings of its service on first use.
 
-    if "access_token" in result:
-        access_token = result["access_token"]
-    else:
-        raise Exception("Couldn't get access token, please check.")
-    return access_token
+        Args:
+            family (str): 'graph:<endpoint>' or 'databricks:<target>:<service>', or the name of a service in
+                          'throttle_shared_services' for the limiter its families share.
 
+        Returns:
+            AdaptiveLimiter: The limiter of the family.
+    """
+    service = family.split(":", 1)[0]
+    parent = throttle_limiter(service) if service in throttle_shared_services and family != service else None
+    with throttle_limiters_lock:
+        if family not in throttle_limiters:
+            settings = throttle_settings[service]
+            throttle_limiters[family] = AdaptiveLimiter(family, settings["rate"], settings["burst"],
+                                                        throttle_max_concurrency, parent)
+        return throttle_limiters[family]
 
-class AzureAPIError(Exception):
-    pass
 
+def parse_retry_after(value):
+    """
+        Parses a Retry-After header, given in seconds or as an HTTP date.
 
-def get_transitive_members_for_group(group_id):
+        Returns:
+            float: The seconds to wait, or None if the header is missing or invalid.
     """
-        Retrieve transitive members for a specified Azure Active Directory group.
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-        This function makes a request to the Microsoft Graph API to retrieve the transitive members
-        of a specific Azure Active Directory group identified by its 'group_id'.
+
+def throttle_backoff(attempt, retry_after=None, base=None):
+    """
+        Returns the time to wait before a retry: the Retry-After plus a small jitter if the service sent one,
+        otherwise a random time up to the exponential backoff ("full jitter").
 
         Args:
-            group_id (str): The unique identifier of the Azure Active Directory group.
+            attempt (int): The number of retries so far.
+            retry_after (float): Seconds the service asked to wait. Optional.
+            base (float): Backoff of the first retry. Defaults to [throttling] backoff_seconds.
 
         Returns:
-            dict: A dictionary containing the transitive members of the specified group.
+            float: Seconds to wait.
+    """
+    base = throttle_backoff_seconds if base is None else base
+    if retry_after:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(throttle_max_backoff_seconds, base * (2 ** attempt)))
 
-        Raises:
-            AzureAPIError: If an error occurs during the API request or if the response status code
-                           is not 200 (indicating an unsuccessful API call).
+
+def unwrap_sdk_error(error):
     """
-    try:
-        headers = {
-            "Authorization": f"Bearer {get_access_token()}",
-            "content-type": "application/json"
-        }
+        Returns the error a Databricks SDK TimeoutError was raised for, i.e. the error of the call the SDK gave up
+        retrying, or the error itself.
+    """
+    if isinstance(error, TimeoutError) and error.__cause__ is not None:
+        return error.__cause__
+    return error
 
-        response = requests.get(
-            url=f"https://graph.microsoft.com/v1.0/groups/{group_id}/transitiveMembers",
-            headers=headers
-        )
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise AzureAPIError(f"Error: {response.status_code} - {response.text}")
 
-    except Exception as e:
-        raise AzureAPIError(f"An error occurred: {str(e)}")
+def is_throttling_error(error, idempotent=True):
+    """
+        Tells whether an exception means the request was throttled or the service is overloaded.
 
+        Args:
+            error (Exception): The exception raised by the call.
+            idempotent (bool): Whether the call may be repeated after a connection error or timeout, when it is
+                               unknown whether the service processed it.
 
-def get_all_group_details(groups_users, orig_group_details_append, tmp_group_file_name):
+        Returns:
+            bool: True if the call can be retried later.
     """
-        Extracts and stores specific details of Microsoft Graph groups.
+    error = unwrap_sdk_error(error)
+    if isinstance(error, db_throttling_errors):
+        return True
+    return idempotent and isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
 
-        This function processes a list of group-related data ('groups_users') obtained from Microsoft Graph API.
-        It filters and extracts specific details ('displayName') of each group and appends them to a list
-        ('groups_dict_final'). The function also appends original group details ('orig_group_details_append')
-        to the final list and writes the entire group details to a specified file ('tmp_group_file_name').
+
+def call_throttled(family, call, throttled_response=None, max_retries=None, idempotent=True):
+    """
+        Makes a call through the limiter of its endpoint family and retries it while it is throttled.
 
         Args:
-            groups_users (list): List of dictionaries containing group-related data obtained from Microsoft Graph API.
-            orig_group_details_append (dict): Original group details to be appended to the final list.
-            tmp_group_file_name (str): File name to which the group details will be written.
+            family (str): The endpoint family, see throttle_limiter().
+            call (callable): Makes the request and returns its result.
+            throttled_response (callable): For calls that return HTTP responses instead of raising: returns None if
+                                           the response is fine, otherwise the Retry-After in seconds (0 if none).
+                                           Optional.
+            max_retries (int): Retries of a throttled call. Defaults to [throttling] max_retries.
+            idempotent (bool): Whether the call is retried after connection errors and timeouts too.
 
         Returns:
-            list: A list containing dictionaries with the extracted group details.
+            The result of the call. A response that is still throttled after [throttling] max_retries retries is
+            returned as it is.
 
         Raises:
-            Exception: If an error occurs during the processing or writing of group details to the file.
+            Exception: Any error of the call that is not throttling, or the throttling error once the retries are
+                       exhausted.
     """
-    try:
-        all_groups = [d for d in groups_users if d['@odata.type'] == '#microsoft.graph.group']
+    limiter = throttle_limiter(family)
+    max_retries = throttle_max_retries if max_retries is None else max_retries
+    for attempt in itertools.count():
+        started = limiter.acquire()
+        try:
+            result = call()
+        except Exception as e:
+            throttled = is_throttling_error(e, idempotent)
+            # A TimeoutError of the SDK has no Retry-After: the SDK already waited for it before giving up, so the
+            # call is retried right away.
+            sdk_waited = unwrap_sdk_error(e) is not e
+            retry_after = getattr(e, "retry_after_secs", None) if throttled else None
+            limiter.release(started, throttled=throttled, retry_after=retry_after)
+            if not throttled or attempt >= max_retries:
+                raise
+            error = type(unwrap_sdk_error(e)).__name__
+        else:
+            retry_after = throttled_response(result) if throttled_response else None
+            limiter.release(started, throttled=retry_after is not None, retry_after=retry_after)
+            if retry_after is None or attempt >= max_retries:
+                return result
+            error = getattr(result, "status_code", "throttled")
+            sdk_waited = False
+        delay = 0.0 if sdk_waited else throttle_backoff(attempt, retry_after)
+        with limiter.condition:
+            limiter.stats["retries"] += 1
+        log_event(logging.WARNING, "request_throttled", family=family, attempt=attempt + 1, error=error,
+                  retry_after=retry_after, wait_s=round(delay, 3), rate=round(limiter.rate, 2),
+                  concurrency=int(limiter.concurrency))
+        time.sleep(delay)
+
+
+def graph_response_throttled(response):
+    """
+        Tells whether a Graph response has to be retried, see call_throttled().
+    """
+    if response.status_code not in graph_retry_statuses:
+        return None
+    return parse_retry_after(response.headers.get("Retry-After")) or 0.0
 
-        keys_to_retain_for_group = ["displayName"]
 
-        # Iterate through each dictionary in the list
-        groups_dict_final = []
-        groups_dict_final.append((orig_group_details_append))
+class ThrottledService:
+    """
+        Wraps one service of an AccountClient (e.g. 'users') so that all its calls go through call_throttled().
 
-        for user in all_groups:
-            required_group_details = {key: user[key] for key in keys_to_retain_for_group if key in user}
-            groups_dict_final.append(required_group_details)
+        Listings are read completely inside the throttled call, so their page requests are limited and retried too.
+        Calls in 'db_caller_retried_calls' are made once, their callers retry them.
+    """
 
-        # Write User details to user file.
-        with open(tmp_group_file_name, "a") as tmp_groups_file:
-            tmp_groups_file.write(str(groups_dict_final))
+    def __init__(self, service, service_name, family):
+        self.service = service
+        self.service_name = service_name
+        self.family = family
 
-        # Append the original
-        return groups_dict_final
+    def __getattr__(self, name):
+        method = getattr(self.service, name)
+        if not callable(method):
+            return method
+        max_retries = 0 if (self.service_name, name) in db_caller_retried_calls else None
+        idempotent = name not in db_non_idempotent_methods
 
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        raise
+        def throttled_method(*args, **kwargs):
+            def call():
+                result = method(*args, **kwargs)
+                return list(result) if isinstance(result, collections.abc.Iterator) else result
+            return call_throttled(self.family, call, max_retries=max_retries, idempotent=idempotent)
+        return throttled_method
 
 
-def get_all_user_details(groups_users, tmp_user_file_name):
+class ThrottledAccountClient:
+    """
+        Wraps an AccountClient so that the calls of every service go through the limiter of
+        'databricks:<target>:<service>'.
     """
-        Extracts and stores specific details of Microsoft Graph users.
 
-        This function processes a list of user-related data ('groups_users') obtained from Microsoft Graph API.
-        It filters and extracts specific details ('userPrincipalName', 'givenName', 'familyName', 'displayName')
-        of each user and writes them to a file ('tmp_user_file_name').
+    def __init__(self, client, target_name):
+        self.client = client
+        self.target_name = target_name
 
-        Args:
-            groups_users (list): List of dictionaries containing user-related data obtained from Microsoft Graph API.
-            tmp_user_file_name (str): File name to which the user details will be written.
+    def __getattr__(self, name):
+        service = getattr(self.client, name)
+        return ThrottledService(service, name, f"databricks:{self.target_name}:{name}")
 
-        Returns:
-            None: Returns None after processing and writing user details to the file.
 
-        Raises:
-            Exception: If an error occurs during the processing or writing of user details to the file.
+def get_throttling_summary():
     """
-    try:
-        all_users = [d for d in groups_users if d['@odata.type'] == '#microsoft.graph.user']
+        Returns the request, throttling and retry counters and the current limits of every endpoint family.
+    """
+    with throttle_limiters_lock:
+        limiters = list(throttle_limiters.values())
+    summary = {}
+    for limiter in limiters:
+        with limiter.condition:
+            summary[limiter.family] = dict(limiter.stats, waited_s=round(limiter.stats["waited_s"], 3),
+                                           rate=round(limiter.rate, 2), concurrency=int(limiter.concurrency))
+    return summary
 
-        keys_to_retain_for_user = ["userPrincipalName", "givenName", "familyName", "displayName"]
 
-        # Iterate through each dictionary in the list
-        for user in all_users:
-            required_user_details = {key: user[key] for key in keys_to_retain_for_user if key in user}
+def log_throttling_summary():
+    """
+        Logs one 'throttling_summary' record per endpoint family.
+
+        Returns:
+            None
+    """
+    for family, stats in sorted(get_throttling_summary().items()):
+        log_event(logging.INFO, "throttling_summary", family=family, **stats)
 
-            # Write User details to user file.
-            with open(tmp_user_file_name, "a") as tmp_user_file:
-                tmp_user_file.write(str(required_user_details) + "\n")
-            tmp_user_file.close()
 
-        return None
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        raise
+# Databricks targets.
+# The [databricks] section is the default target. Every additional [databricks:<name>] section with its own
+# 'databricks_account_number' (and optionally 'azure_databricks_host') is another Databricks Account the same
+# crawled groups are applied to, in parallel. Each target has its own AccountClient and principal cache.
+class SyncTarget:
+    """
+        A Databricks Account the crawled groups are applied to.
+    """
 
+    def __init__(self, name, host, account_id, client=None):
+        self.name = name
+        self.host = host
+        self.account_id = account_id
+        self.client = ThrottledAccountClient(client or new_account_client(host, account_id), name)
+        # (kind, key) -> Databricks principal id, kind being 'users' (keyed by lower-cased userName) or
+        # 'service_principals' (keyed by applicationId). Kinds in 'preloaded_kinds' were listed completely, so a
+        # cache miss means absent.
+        self.principal_cache = {}
+        self.preloaded_kinds = set()
+        # Ids of all listed principals, of those that are deactivated, and of those that share their key with another
+        # principal of the same kind, filled by preload_db_principals().
+        self.principal_ids = set()
+        self.inactive_principal_ids = set()
+        self.ambiguous_principal_ids = set()
+        self.lock = threading.RLock()
+        # Membership write chunk size learned for this account, loaded lazily by target_chunk_size(), and the
+        # size it may grow back to in this run after a chunk was rejected as too large.
+        self.chunk_size = None
+        self.chunk_size_limit = None
+        # ('externalId', Azure group id) and ('displayName', name) -> Databricks group, loaded by db_group_index().
+        self.group_index = None
+
+
+def load_sync_targets():
+    """
+        Creates the Databricks targets configured in cred.ini.
 
-def get_service_principal(top_level_group_name):
+        Returns:
+            list: The SyncTarget objects, the [databricks] section first.
     """
-        Retrieves service principal details for a specified top-level group from Microsoft Graph API.
+    targets = [SyncTarget("databricks", azure_databricks_host, databricks_account_number, client=a)]
+    for section in config.sections():
+        if section.startswith("databricks:"):
+            targets.append(SyncTarget(section.split(":", 1)[1],
+                                      config.get(section, "azure_databricks_host", fallback=azure_databricks_host),
+                                      config.get(section, "databricks_account_number")))
+    return targets
 
-        This function makes a request to the Microsoft Graph API to obtain service principal details
-        for a specific top-level group identified by its 'top_level_group_name'.
 
-        Args:
-            top_level_group_name (str): The display name of the top-level group to retrieve service principals.
+sync_targets = load_sync_targets()
+target_context = threading.local()
+
+
+def active_target():
+    """
+        Returns the Databricks target the current thread applies to.
 
         Returns:
-            dict: A dictionary containing Azure service principal details related to the specified top-level group.
+            SyncTarget: The target bound by apply_to_target(), or the default target.
+    """
+    return getattr(target_context, "target", None) or sync_targets[0]
 
-        Raises:
-            Exception: If an error occurs during the API request or processing the service principal details.
+
+def db_client():
     """
-    # define header
-    headers = {"Authorization": f"Bearer {get_access_token()}", "content-type": "application/json"}
+        Returns the AccountClient of the Databricks target the current thread applies to.
+
+        Returns:
+            AccountClient: The client of active_target().
+    """
+    return active_target().client
 
-    # Call MS Graph API to get the group members. At this stage, we are only calling the top level group and its members
-    response = requests.get(
-        url=f"https://graph.microsoft.com/v1.0/groups?$filter=displayName%20eq%20'{top_level_group_name}'",
-        headers=headers
-    )
 
-    azure_sp_details = response.json()
+def principal_key_attribute(kind):
+    """
+        Returns the SCIM attribute principals of a kind are matched by: 'applicationId' for service principals,
+        'userName' for users. Both are unique in a Databricks Account, unlike display names.
+    """
+    return "applicationId" if kind == "service_principals" else "userName"
 
-    return azure_sp_details
+
+def principal_cache_key(kind, key):
+    """
+        Returns the key of a principal in the principal cache. User names are not case-sensitive, so they are
+        lower-cased.
+    """
+    return key.lower() if kind == "users" and key else key
 
 
-def get_azure_user(user_name, token):
+def azure_user_name(user_details):
+    """
+        Returns the Databricks user name of an Azure user: its userPrincipalName, or its display name if the
+        crawl did not return one.
     """
-        Retrieves service principal details for a specified top-level group from Microsoft Graph API.
+    return user_details.get("userPrincipalName") or user_details.get("displayName", "None")
 
-        This function makes a request to the Microsoft Graph API to obtain service principal details
-        for a specific top-level group identified by its 'top_level_group_name'.
+
+def find_db_principal_id(kind, key):
+    """
+        Looks up the id of a Databricks user by user name, or of a service principal by application id, through
+        the principal cache of the active target.
 
         Args:
-            top_level_group_name (str): The display name of the top-level group to retrieve service principals.
+            kind (str): 'users' or 'service_principals'.
+            key (str): The user name of the user, or the application id of the service principal.
 
         Returns:
-            dict: A dictionary containing Azure service principal details related to the specified top-level group.
-
-        Raises:
-            Exception: If an error occurs during the API request or processing the service principal details.
+            str: The Databricks id of the principal, or None if it does not exist.
     """
-    # define header
-    headers = {"Authorization": f"Bearer {token}", "content-type": "application/json"}
+    target = active_target()
+    with target.lock:
+        if (kind, principal_cache_key(kind, key)) in target.principal_cache:
+            return target.principal_cache[(kind, principal_cache_key(kind, key))]
+        if kind in target.preloaded_kinds:
+            return None
+    found = list(getattr(target.client, kind).list(filter=f"{principal_key_attribute(kind)} eq '{key}'"))
+    if not found:
+        return None
+    return cache_db_principal_id(kind, key, found[0].id)
 
-    # Call MS Graph API to get the group members. At this stage, we are only calling the top level group and its members
-    response = requests.get(
-        url=f"https://graph.microsoft.com/v1.0/users?$filter=displayName%20eq%20'{user_name}'",
-        headers=headers
-    )
 
-    azure_ad_user_details = response.json()
+def cache_db_principal_id(kind, key, principal_id):
+    """
+        Remembers the Databricks id of a principal in the principal cache of the active target.
 
-    return azure_ad_user_details
+        Args:
+            kind (str): 'users' or 'service_principals'.
+            key (str): The user name of the user, or the application id of the service principal.
+            principal_id (str): The Databricks id of the principal.
 
+        Returns:
+            str: The cached id.
+    """
+    target = active_target()
+    with target.lock:
+        target.principal_cache[(kind, principal_cache_key(kind, key))] = principal_id
+    return principal_id
 
 
-def get_original_group_details(orig_group_id, tokens):
+def preload_db_principals(kind):
     """
-        Retrieves details of the original group from Microsoft Graph API.
+        Lists all users or service principals of the active target once and caches their ids.
 
-        This function makes a request to the Microsoft Graph API to obtain details of the original group
-        identified by its 'orig_group_id'.
+        Users are cached by user name and service principals by application id. Afterwards
+        find_db_principal_id() answers every lookup of that kind from the cache, so resolving many principals takes
+        no further calls however many there are.
 
         Args:
-            orig_group_id (str): The unique identifier of the original group.
-            tokens (str): Access token for authorization to make the API request.
+            kind (str): 'users' or 'service_principals'.
 
         Returns:
-            dict: A dictionary containing specific details ('displayName') of the original group.
+            None
+    """
+    target = active_target()
+    key_field = "application_id" if kind == "service_principals" else "user_name"
+    with target.lock:
+        if kind in target.preloaded_kinds:
+            return
+        started = time.perf_counter()
+        count = 0
+        attributes = "id,displayName,applicationId,active" if kind == "service_principals" else "id,userName,active"
+        for principal in getattr(target.client, kind).list(attributes=attributes):
+            target.principal_ids.add(principal.id)
+            if principal.active is False:
+                target.inactive_principal_ids.add(principal.id)
+            if getattr(principal, key_field, None):
+                cache_key = (kind, principal_cache_key(kind, getattr(principal, key_field)))
+                cached_id = target.principal_cache.setdefault(cache_key, principal.id)
+                if cached_id != principal.id:
+                    target.ambiguous_principal_ids.update((cached_id, principal.id))
+                count += 1
+        target.preloaded_kinds.add(kind)
+        log_event(logging.INFO, "principal_index_loaded", target=target.name, kind=kind, principals=count,
+                  elapsed_s=round(time.perf_counter() - started, 3))
 
-        Raises:
-            AzureAPIError: If an error occurs during the API request or if the response status code
-                           is not 200 (indicating an unsuccessful API call).
+
+# acquire Active Directory access Token
+def get_access_token():
     """
-    try:
-        headers = {"Authorization": f"Bearer {tokens}", "content-type": "application/json"}
+    Acquires an Azure Active Directory Access Token.
 
-        # Call MS Graph API to get the group details. This is needed because sometimes the top-level group
-        # may have some SP that needs to be added to the groups file.
-        response = requests.get(
-            url=f"https://graph.microsoft.com/v1.0/groups/{orig_group_id}",
-            headers=headers
-        )
-        if response.status_code == 200:
-            orig_group_details = response.json()
-            return {"displayName": orig_group_details["displayName"]}
-        else:
-            raise AzureAPIError(f"Error: {response.status_code} - {response.text}")
+    This function retrieves an access token from Azure Active Directory using Microsoft Authentication Library (MSAL).
 
-    except Exception as e:
-        raise AzureAPIError(f"An error occurred: {str(e)}")
+    Returns:
+        str: Azure Active Directory Access Token.
 
+    Raises:
+        Exception: If unable to obtain the access token.
+    """
+    result = msal_app.acquire_token_silent(
+        scopes=msal_scope,
+        account=None
+    )
+    if not result:
+        result = msal_app.acquire_token_for_client(
+            scopes=msal_scope
+        )
+
+    if "access_token" in result:
+        access_token = result["access_token"]
+    else:
+        raise Exception("Couldn't get access token, please check.")
+    return access_token
+
+
+class AzureAPIError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Microsoft Graph request shaping.
+# Only the properties below are ever read from Graph responses, so every call asks for them with $select instead
+# of downloading the full default object shape. '@odata.type' is always returned for directory object collections.
+graph_base_url = "https://graph.microsoft.com/v1.0"
+graph_member_select = "id,displayName,userPrincipalName,givenName,appId"
+graph_select_by_endpoint = {
+    "transitiveMembers": graph_member_select,
+    "members": graph_member_select,
+    "group": "id,displayName",
+    "groups": "id,displayName",
+    "users": "id,displayName,userPrincipalName,givenName",
+    "servicePrincipals": "id,displayName,appId",
+    "transitiveGroups": "id,displayName",
+    "transitiveUsers": "id,displayName,userPrincipalName,givenName",
+    "transitiveServicePrincipals": "id,displayName,appId",
+    "groupDiscovery": "id,displayName",
+    "administrativeUnitGroups": "id,displayName",
+}
+graph_shaping_enabled = config.getboolean("graph", "select_projection", fallback=True)
+graph_compression_enabled = config.getboolean("graph", "compression", fallback=True)
+graph_page_size = config.getint("graph", "page_size", fallback=999)
+graph_request_timeout_seconds = config.getfloat("graph", "request_timeout_seconds", fallback=60)
+graph_query_safe_chars = "$,'()=*/:;"
+# Graph accepts at most 15 values in an 'in' filter.
+graph_filter_in_batch_size = 15
+
+# Per endpoint counters of requests, bytes on the wire, decoded bytes and JSON decode time.
+graph_payload_stats = {}
+graph_payload_stats_lock = threading.Lock()
+
+
+def build_graph_url(path, params=None):
+    """
+        Builds a Microsoft Graph URL from a path and OData query options.
+
+        The '$' of the query option names and the OData punctuation in the values are kept as is, everything else
+        in the values is percent-encoded.
+
+        Args:
+            path (str): The path below the Graph version root, e.g. '/groups/{id}/transitiveMembers'.
+            params (dict): OData query options, e.g. {"$select": "id,displayName"}.
+
+        Returns:
+            str: The full request URL.
+    """
+    url = f"{graph_base_url}{path}"
+    if params:
+        query = "&".join(f"{key}={urllib.parse.quote(str(value), safe=graph_query_safe_chars)}"
+                         for key, value in params.items())
+        url = f"{url}?{query}"
+    return url
+
+
+def record_graph_payload(endpoint, wire_bytes, decoded_bytes, decode_seconds):
+    """
+        Adds one Graph response to the per endpoint payload counters.
+
+        Args:
+            endpoint (str): The endpoint family name used as the counter key.
+            wire_bytes (int): Bytes received on the wire (compressed size when compression is used).
+            decoded_bytes (int): Bytes of the decompressed JSON body.
+            decode_seconds (float): Time spent decoding the JSON body.
+
+        Returns:
+            None
+    """
+    with graph_payload_stats_lock:
+        stats = graph_payload_stats.setdefault(
+            endpoint, {"requests": 0, "wire_bytes": 0, "decoded_bytes": 0, "decode_s": 0.0})
+        stats["requests"] += 1
+        stats["wire_bytes"] += wire_bytes
+        stats["decoded_bytes"] += decoded_bytes
+        stats["decode_s"] += decode_seconds
+
+
+def log_graph_payload_summary():
+    """
+        Logs one 'graph_payload_summary' record per Graph endpoint family with the counters collected in this run.
+
+        Run once with [graph] select_projection and compression set to false and once with the defaults to compare
+        the payload sizes and JSON decode times.
+
+        Returns:
+            None
+    """
+    with graph_payload_stats_lock:
+        for endpoint, stats in sorted(graph_payload_stats.items()):
+            log_event(logging.INFO, "graph_payload_summary", endpoint=endpoint, requests=stats["requests"],
+                      wire_bytes=stats["wire_bytes"], decoded_bytes=stats["decoded_bytes"],
+                      decode_s=round(stats["decode_s"], 4), select_projection=graph_shaping_enabled,
+                      compression=graph_compression_enabled)
+
+
+# Graph response cache.
+# Group and principal metadata is requested repeatedly within a run (e.g. the details of a group in the crawl and
+# again in the apply of every target, or nested group names shared by several top-level groups). Responses are
+# memoized by normalized URL in an LRU cache, with a TTL per endpoint family. Endpoints without a TTL (member
+# listings by default) are never cached. The cache can be saved to a file and reused by the next run.
+graph_cache_enabled = config.getboolean("graph_cache", "enabled", fallback=True)
+graph_cache_max_entries = config.getint("graph_cache", "max_entries", fallback=5000)
+graph_cache_file = config.get("graph_cache", "persist_file", fallback="") or None
+graph_cache_ttl_seconds = {
+    endpoint.strip(): float(ttl)
+    for endpoint, ttl in (item.split(":") for item in config.get(
+        "graph_cache", "ttl_seconds",
+        fallback="group:3600, groups:3600, users:600, servicePrincipals:3600").split(",") if item.strip())
+}
+# Group discovery has its own refresh interval (see "Group discovery" below), so its listings are never cached here.
+graph_uncached_endpoints = {"groupDiscovery", "administrativeUnitGroups"}
+for uncached_endpoint in graph_uncached_endpoints:
+    graph_cache_ttl_seconds.pop(uncached_endpoint, None)
+# Normalized URL -> (endpoint, expiry as epoch seconds, decoded JSON response), least recently used first.
+graph_cache = collections.OrderedDict()
+graph_cache_stats = {}
+graph_cache_lock = threading.Lock()
+graph_cache_loaded = False
+
+
+def graph_cache_key(url):
+    """
+        Normalizes a Graph URL into a cache key, so the order of the query options does not matter.
+    """
+    base, _, query = url.partition("?")
+    return f"{base}?{'&'.join(sorted(query.split('&')))}" if query else base
+
+
+def count_graph_cache(endpoint, outcome):
+    """
+        Counts a cache 'hits', 'misses' or 'evictions' event of an endpoint family. Needs graph_cache_lock.
+    """
+    stats = graph_cache_stats.setdefault(endpoint, {"hits": 0, "misses": 0, "evictions": 0})
+    stats[outcome] += 1
+
+
+def load_graph_cache():
+    """
+        Loads the entries of the persisted Graph cache that have not expired yet. Needs graph_cache_lock.
+
+        Returns:
+            None
+    """
+    global graph_cache_loaded
+    graph_cache_loaded = True
+    if not graph_cache_file:
+        return
+    try:
+        with open(graph_cache_file, "r") as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read Graph cache file {graph_cache_file}, starting with an empty cache: {e}")
+        return
+    now = time.time()
+    for key, endpoint, expires, payload in entries[-graph_cache_max_entries:]:
+        if expires > now:
+            graph_cache[key] = (endpoint, expires, payload)
+
+
+def save_graph_cache():
+    """
+        Writes the unexpired entries of the Graph cache to [graph_cache] persist_file, if one is configured.
+
+        Returns:
+            None
+    """
+    if not graph_cache_enabled or not graph_cache_file:
+        return
+    with graph_cache_lock:
+        now = time.time()
+        entries = [[key, endpoint, expires, payload]
+                   for key, (endpoint, expires, payload) in graph_cache.items() if expires > now]
+    directory = os.path.dirname(graph_cache_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{graph_cache_file}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, graph_cache_file)
+    except OSError as e:
+        logging.warning(f"Could not save Graph cache file {graph_cache_file}: {e}")
+
+
+def graph_cache_get(endpoint, key):
+    """
+        Returns the cached response of a Graph URL, or None if it is not cached, has expired or the endpoint
+        family is not cached at all.
+
+        Args:
+            endpoint (str): The endpoint family of the request.
+            key (str): The cache key from graph_cache_key().
+
+        Returns:
+            dict: The cached decoded JSON response, or None.
+    """
+    if not graph_cache_enabled or graph_cache_ttl_seconds.get(endpoint, 0) <= 0:
+        return None
+    with graph_cache_lock:
+        if not graph_cache_loaded:
+            load_graph_cache()
+        entry = graph_cache.get(key)
+        if entry and entry[1] > time.time():
+            graph_cache.move_to_end(key)
+            count_graph_cache(endpoint, "hits")
+            return entry[2]
+        if entry:
+            del graph_cache[key]
+        count_graph_cache(endpoint, "misses")
+        return None
+
+
+def graph_cache_put(endpoint, key, payload):
+    """
+        Caches a Graph response for the TTL of its endpoint family, evicting the least recently used entries
+        beyond [graph_cache] max_entries.
+
+        Args:
+            endpoint (str): The endpoint family of the request.
+            key (str): The cache key from graph_cache_key().
+            payload (dict): The decoded JSON response.
+
+        Returns:
+            None
+    """
+    ttl = graph_cache_ttl_seconds.get(endpoint, 0)
+    if not graph_cache_enabled or ttl <= 0:
+        return
+    with graph_cache_lock:
+        graph_cache[key] = (endpoint, time.time() + ttl, payload)
+        graph_cache.move_to_end(key)
+        while len(graph_cache) > graph_cache_max_entries:
+            _, (evicted_endpoint, _, _) = graph_cache.popitem(last=False)
+            count_graph_cache(evicted_endpoint, "evictions")
+
+
+def log_graph_cache_summary():
+    """
+        Logs one 'graph_cache_summary' record per cached Graph endpoint family with its hits, misses and evictions.
+
+        Returns:
+            None
+    """
+    with graph_cache_lock:
+        for endpoint, stats in sorted(graph_cache_stats.items()):
+            log_event(logging.INFO, "graph_cache_summary", endpoint=endpoint, entries=len(graph_cache), **stats)
+
+
+def graph_get(endpoint, path=None, params=None, token=None, url=None, headers=None):
+    """
+        Sends a GET request to Microsoft Graph with the $select projection of the endpoint family and compression.
+
+        Responses of endpoint families with a [graph_cache] TTL are answered from the Graph response cache. Requests
+        are limited and retried on throttling per endpoint family, see call_throttled().
+
+        Args:
+            endpoint (str): The endpoint family, one of the keys of 'graph_select_by_endpoint' (or any other name
+                            for calls that should not be projected). Also used as the payload counter key.
+            path (str): The path below the Graph version root. Ignored when 'url' is given.
+            params (dict): Additional OData query options. A '$select' given here wins over the default projection.
+            token (str): Access token. A new one is acquired when not given.
+            url (str): A complete URL, e.g. an '@odata.nextLink', which is requested unchanged.
+            headers (dict): Additional request headers, e.g. 'ConsistencyLevel'. Optional.
+
+        Returns:
+            dict: The decoded JSON response.
+
+        Raises:
+            AzureAPIError: If the response status code is not 200, after the retries of throttled responses.
+    """
+    if url is None:
+        params = dict(params or {})
+        if graph_shaping_enabled and endpoint in graph_select_by_endpoint:
+            params.setdefault("$select", graph_select_by_endpoint[endpoint])
+        url = build_graph_url(path, params)
+
+    cache_key = graph_cache_key(url)
+    cached = graph_cache_get(endpoint, cache_key)
+    if cached is not None:
+        return cached
+
+    headers = {
+        "Authorization": f"Bearer {token or get_access_token()}",
+        "content-type": "application/json",
+        "Accept-Encoding": "gzip, deflate" if graph_compression_enabled else "identity",
+        **(headers or {}),
+    }
+    response = call_throttled(f"graph:{endpoint}", lambda: requests.get(url=url, headers=headers,
+                                                                             timeout=graph_request_timeout_seconds),
+                              graph_response_throttled)
+    if response.status_code != 200:
+        raise AzureAPIError(f"Error: {response.status_code} - {response.text}", response.status_code)
+
+    body = response.content
+    try:
+        wire_bytes = response.raw.tell() or len(body)
+    except (AttributeError, ValueError):
+        wire_bytes = len(body)
+    decode_started = time.perf_counter()
+    payload = json.loads(body)
+    record_graph_payload(endpoint, wire_bytes, len(body), time.perf_counter() - decode_started)
+    graph_cache_put(endpoint, cache_key, payload)
+    return payload
+
+
+def graph_get_all(endpoint, path, params=None, token=None, headers=None):
+    """
+        Reads all pages of a Microsoft Graph collection by following '@odata.nextLink'.
+
+        Args:
+            endpoint (str): The endpoint family, see graph_get().
+            path (str): The collection path below the Graph version root.
+            params (dict): Additional OData query options.
+            token (str): Access token. A new one is acquired when not given.
+            headers (dict): Additional request headers, sent with every page request. Optional.
+
+        Returns:
+            list: The items of all pages.
+
+        Raises:
+            AzureAPIError: If any page request fails.
+    """
+    params = dict(params or {})
+    params.setdefault("$top", graph_page_size)
+    page = graph_get(endpoint, path, params=params, token=token, headers=headers)
+    items = list(page.get("value", []))
+    while page.get("@odata.nextLink"):
+        page = graph_get(endpoint, url=page["@odata.nextLink"], token=token, headers=headers)
+        items.extend(page.get("value", []))
+    return items
+
+
+def get_transitive_members_for_group(group_id):
+    """
+        Retrieve transitive members for a specified Azure Active Directory group.
+
+        This function makes a request to the Microsoft Graph API to retrieve the transitive members
+        of a specific Azure Active Directory group identified by its 'group_id'.
+
+        Args:
+            group_id (str): The unique identifier of the Azure Active Directory group.
+
+        Returns:
+            dict: A dictionary containing the transitive members of the specified group.
+
+        Raises:
+            AzureAPIError: If an error occurs during the API request or if the response status code
+                           is not 200 (indicating an unsuccessful API call).
+    """
+    try:
+        return {"value": graph_get_all("transitiveMembers", f"/groups/{group_id}/transitiveMembers")}
+
+    except Exception as e:
+        raise AzureAPIError(f"An error occurred: {str(e)}")
+
+
+# Nested group traversal.
+# 'transitive' asks Graph for the flattened membership of every top-level group, 'bfs' walks the direct /members of
+# each nested group once per run and memoizes the flattened member set of every subgroup, so subgroups shared by
+# several top-level groups are only fetched once. 'auto' picks one of the two per group based on the overlap seen.
+traversal_mode = config.get("graph", "traversal", fallback="auto").lower()
+traversal_overlap_threshold = config.getfloat("graph", "traversal_overlap_threshold", fallback=0.5)
+graph_group_type = "#microsoft.graph.group"
+
+# Compact member records.
+# Every Azure principal seen in this run is stored once, as a MemberRecord in 'principal_table', and referred to by
+# its principal number everywhere else. Group memberships are arrays of principal numbers, so a membership costs a
+# few bytes instead of one decoded Graph dict per group it appears in.
+MemberRecord = collections.namedtuple(
+    "MemberRecord", ["id", "type", "display_name", "user_principal_name", "given_name", "app_id"])
+member_type_user = "user"
+member_type_group = "group"
+member_type_service_principal = "servicePrincipal"
+member_type_tags = {
+    "#microsoft.graph.user": member_type_user,
+    graph_group_type: member_type_group,
+    "#microsoft.graph.servicePrincipal": member_type_service_principal,
+}
+
+
+def member_record(graph_object):
+    """
+        Converts a Graph directory object into a MemberRecord with an interned type tag.
+
+        Args:
+            graph_object (dict): A member object as returned by Microsoft Graph.
+
+        Returns:
+            MemberRecord: The compact record.
+    """
+    odata_type = graph_object.get("@odata.type") or ""
+    return MemberRecord(graph_object["id"], member_type_tags.get(odata_type) or sys.intern(odata_type),
+                        graph_object.get("displayName"), graph_object.get("userPrincipalName"),
+                        graph_object.get("givenName"), graph_object.get("appId"))
+
+
+class PrincipalTable:
+    """
+        Numbers the Azure principals of a run and keeps one MemberRecord per principal.
+    """
+
+    def __init__(self):
+        self.numbers = {}  # Azure object id -> principal number
+        self.records = []  # principal number -> MemberRecord
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, number):
+        return self.records[number]
+
+    def add(self, graph_object):
+        """
+            Returns the principal number of a Graph directory object, adding a record for a new principal.
+        """
+        number = self.numbers.get(graph_object["id"])
+        if number is None:
+            number = len(self.records)
+            record = member_record(graph_object)
+            self.numbers[record.id] = number
+            self.records.append(record)
+        return number
+
+    def add_all(self, graph_objects):
+        """
+            Returns the principal numbers of Graph directory objects as an array, without duplicates.
+        """
+        return array.array("I", dict.fromkeys(self.add(graph_object) for graph_object in graph_objects))
+
+    def to_records(self, numbers):
+        """
+            Returns the MemberRecords of principal numbers.
+        """
+        return [self.records[number] for number in numbers]
+
+
+principal_table = PrincipalTable()
+
+direct_members_cache = {}  # group id -> array of the principal numbers of its direct members
+flattened_members_cache = {}  # group id -> {"members": array of principal numbers, "groups": array of ...}
+traversal_stats = {"transitive": 0, "bfs": 0, "direct_only": 0, "filtered": 0, "memo_hits": 0, "member_fetches": 0}
+traversal_lock = threading.RLock()
+
+
+def get_direct_members_cached(group_id):
+    """
+        Returns the direct members of a group, fetching them from Microsoft Graph at most once per run.
+
+        Args:
+            group_id (str): The unique identifier of the Azure Active Directory group.
+
+        Returns:
+            array: The principal numbers of the direct members (users, service principals and groups) of the group.
+
+        Raises:
+            AzureAPIError: If the Graph request fails.
+    """
+    with traversal_lock:
+        if group_id in direct_members_cache:
+            return direct_members_cache[group_id]
+    members = graph_get_all("members", f"/groups/{group_id}/members")
+    with traversal_lock:
+        traversal_stats["member_fetches"] += 1
+        direct_members_cache[group_id] = principal_table.add_all(members)
+        return direct_members_cache[group_id]
+
+
+def flatten_from_cache(group_id):
+    """
+        Computes the flattened membership of a group from the direct member cache.
+
+        The hierarchy is walked breadth-first. Groups that are already visited are skipped, so cycles in the nesting
+        do not loop, and subgroups whose flattened membership is memoized are merged without being expanded again.
+        All groups reached by the walk must already be in 'direct_members_cache'.
+
+        Args:
+            group_id (str): The unique identifier of the group to flatten.
+
+        Returns:
+            dict: {"members": array, "groups": array} with the principal numbers of the non-group members and of
+                  the nested groups.
+    """
+    members, groups = set(), set()
+    visited = {group_id}
+    pending = collections.deque([group_id])
+    while pending:
+        current = pending.popleft()
+        memoized = flattened_members_cache.get(current) if current != group_id else None
+        if memoized is not None:
+            members.update(memoized["members"])
+            groups.update(memoized["groups"])
+            visited.update(principal_table[number].id for number in memoized["groups"])
+            continue
+        for number in direct_members_cache[current]:
+            record = principal_table[number]
+            if record.type == member_type_group:
+                if record.id not in visited:
+                    visited.add(record.id)
+                    groups.add(number)
+                    pending.append(record.id)
+            else:
+                members.add(number)
+    groups.discard(principal_table.numbers.get(group_id))
+    return {"members": array.array("I", members), "groups": array.array("I", groups)}
+
+
+def flatten_group_bfs(group_id):
+    """
+        Flattens a nested group by walking its direct members breadth-first, memoizing every subgroup.
+
+        Each group of the hierarchy is fetched from Graph once per run. Subgroups with a memoized flattened
+        membership are not fetched or walked again. After the walk, the flattened membership of every visited
+        subgroup is memoized, deepest groups first, so later top-level groups that share them reuse the result.
+
+        Args:
+            group_id (str): The unique identifier of the top-level group.
+
+        Returns:
+            dict: {"members": array, "groups": array}, see flatten_from_cache().
+
+        Raises:
+            AzureAPIError: If a Graph request fails.
+    """
+    walk_order = [group_id]
+    visited = {group_id}
+    pending = collections.deque([group_id])
+    while pending:
+        current = pending.popleft()
+        if current != group_id and current in flattened_members_cache:
+            with traversal_lock:
+                traversal_stats["memo_hits"] += 1
+            continue
+        for number in get_direct_members_cached(current):
+            record = principal_table[number]
+            if record.type == member_type_group and record.id not in visited:
+                visited.add(record.id)
+                walk_order.append(record.id)
+                pending.append(record.id)
+
+    with traversal_lock:
+        for current in reversed(walk_order):
+            if current not in flattened_members_cache:
+                flattened_members_cache[current] = flatten_from_cache(current)
+        return flattened_members_cache[group_id]
+
+
+def get_flattened_members_for_group(group_id):
+    """
+        Retrieves the flattened membership of a group, choosing the traversal per group.
+
+        With [graph] traversal = auto and subgroups memoized by earlier walks of this run, the direct members of the
+        group are read first. A group without nested groups needs nothing else. If at least
+        'traversal_overlap_threshold' of its nested groups are memoized, the breadth-first walk is used, otherwise a
+        single transitiveMembers call. Without memoized subgroups the walk cannot be cheaper, so transitiveMembers is
+        called right away, without reading the direct members first.
+
+        Args:
+            group_id (str): The unique identifier of the Azure Active Directory group.
+
+        Returns:
+            dict: {"value": [...]} with the MemberRecords of the users, service principals and nested groups of the
+                  group, each once.
+
+        Raises:
+            AzureAPIError: If a Graph request fails.
+    """
+    with traversal_lock:
+        memoized = flattened_members_cache.get(group_id)
+    if memoized is not None:
+        with traversal_lock:
+            traversal_stats["memo_hits"] += 1
+            return {"value": principal_table.to_records(memoized["groups"] + memoized["members"])}
+
+    if traversal_mode == "transitive":
+        strategy = "transitive"
+    elif traversal_mode == "bfs":
+        strategy = "bfs"
+    else:
+        # Subgroups only seen in transitiveMembers results are not memoized and would be fetched again by the walk,
+        # so only memoized subgroups count as overlap.
+        with traversal_lock:
+            probe = group_id in direct_members_cache or bool(flattened_members_cache)
+        direct_groups = [principal_table[number].id for number in get_direct_members_cached(group_id)
+                         if principal_table[number].type == member_type_group] if probe else None
+        with traversal_lock:
+            known = sum(1 for g in direct_groups or () if g in flattened_members_cache)
+        if direct_groups is None:
+            strategy = "transitive"
+        elif not direct_groups:
+            strategy = "direct_only"
+        elif known / len(direct_groups) >= traversal_overlap_threshold:
+            strategy = "bfs"
+        else:
+            strategy = "transitive"
+
+    with traversal_lock:
+        traversal_stats[strategy] += 1
+    log_event(logging.DEBUG, "traversal_strategy", group_id=group_id, strategy=strategy)
+
+    if strategy == "transitive":
+        groups_users = get_transitive_members_for_group(group_id)["value"]
+        with traversal_lock:
+            records = principal_table.to_records(principal_table.add_all(groups_users))
+        return {"value": records}
+
+    flattened = flatten_group_bfs(group_id)
+    with traversal_lock:
+        return {"value": principal_table.to_records(flattened["groups"] + flattened["members"])}
+
+
+def log_traversal_summary():
+    """
+        Logs a 'traversal_summary' record with the traversal strategy counters of this run.
+
+        Returns:
+            None
+    """
+    with traversal_lock:
+        log_event(logging.INFO, "traversal_summary", mode=traversal_mode, **traversal_stats,
+                  memoized_groups=len(flattened_members_cache), principals=len(principal_table))
+
+
+# Member filters.
+# A group can have a "member_filter" in its "group_settings" in groups_to_sync.json, e.g.
+#   {"types": ["user"], "users": "accountEnabled eq true and userType eq 'Member'"}
+# 'types' lists the member types to sync ('user', 'servicePrincipal'), 'users' and 'service_principals' are OData
+# filters on the members of that type. The members of a filtered group are read with one transitiveMembers request
+# per member type, cast to the type, with the filter sent to Graph as an advanced query ($filter, $count and the
+# 'ConsistencyLevel: eventual' header). If Graph rejects a filter, it is evaluated locally instead, on the same
+# request without $filter but with the filtered properties selected. Filtered out members are not written to the
+# temp files and never reach Databricks.
+MemberFilter = collections.namedtuple("MemberFilter", ["types", "users", "service_principals"])
+member_filter_types = (member_type_user, member_type_service_principal)
+graph_unsupported_filters = set()  # filters Graph rejected in this run, evaluated locally from then on
+odata_token_pattern = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)(?![\w.])|"
+                                 r"(?P<name>[A-Za-z_@][\w./@]*)|(?P<punct>[(),]))")
+odata_comparisons = {
+    "eq": lambda left, right: left == right,
+    "ne": lambda left, right: left != right,
+    "gt": lambda left, right: left is not None and right is not None and left > right,
+    "ge": lambda left, right: left is not None and right is not None and left >= right,
+    "lt": lambda left, right: left is not None and right is not None and left < right,
+    "le": lambda left, right: left is not None and right is not None and left <= right,
+}
+odata_functions = {
+    "startswith": lambda value, prefix: isinstance(value, str) and value.startswith(prefix),
+    "endswith": lambda value, suffix: isinstance(value, str) and value.endswith(suffix),
+    "contains": lambda value, part: isinstance(value, str) and part in value,
+}
+odata_literals = {"true": True, "false": False, "null": None}
+
+
+def parse_member_filter(settings):
+    """
+        Parses the "member_filter" of a group in groups_to_sync.json.
+
+        Args:
+            settings (dict): {"types": [...], "users": str, "service_principals": str}, all optional.
+
+        Returns:
+            MemberFilter: The filter, or None if the group has none.
+
+        Raises:
+            ValueError: If 'types' contains an unknown member type.
+    """
+    if not settings:
+        return None
+    types = tuple(settings.get("types") or member_filter_types)
+    unknown = [member_type for member_type in types if member_type not in member_filter_types]
+    if unknown:
+        raise ValueError(f"Unknown member types {unknown} in member_filter, use {list(member_filter_types)}")
+    return MemberFilter(types, settings.get("users"), settings.get("service_principals"))
+
+
+def casefold_value(value):
+    """
+        Returns a string casefolded, so string comparisons are case-insensitive like in Graph; other values as is.
+    """
+    return value.casefold() if isinstance(value, str) else value
+
+
+def compile_odata_filter(text):
+    """
+        Compiles the subset of OData $filter expressions used for members into a local predicate.
+
+        Supported are 'and', 'or', 'not', parentheses, the comparisons eq, ne, gt, ge, lt and le of a property with
+        a literal, 'in' with a list of literals and the functions startswith, endswith and contains. String
+        comparisons are case-insensitive.
+
+        Args:
+            text (str): The filter, e.g. "accountEnabled eq true and userType eq 'Member'".
+
+        Returns:
+            tuple: (predicate taking a Graph object and returning bool, set of the property names used).
+
+        Raises:
+            ValueError: If the filter uses anything else.
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = odata_token_pattern.match(text, position)
+        if not match:
+            raise ValueError(f"Cannot evaluate the filter '{text}' locally at: {text[position:]}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        tokens.append((kind, value))
+        position = match.end()
+    properties = set()
+    index = 0
+
+    def peek(*values):
+        return index < len(tokens) and tokens[index][0] in ("name", "punct") and tokens[index][1] in values
+
+    def take(kind=None, value=None):
+        nonlocal index
+        if index >= len(tokens) or (kind and tokens[index][0] != kind) or (value and tokens[index][1] != value):
+            raise ValueError(f"Cannot evaluate the filter '{text}' locally: expected {value or kind or 'a literal'}")
+        index += 1
+        return tokens[index - 1][1]
+
+    def literal():
+        kind, value = tokens[index] if index < len(tokens) else (None, None)
+        take()
+        if kind == "name":
+            if value not in odata_literals:
+                raise ValueError(f"Cannot evaluate the filter '{text}' locally: {value} is not a literal")
+            return odata_literals[value]
+        if kind not in ("string", "number"):
+            raise ValueError(f"Cannot evaluate the filter '{text}' locally: expected a literal")
+        return casefold_value(value)
+
+    def primary():
+        if peek("("):
+            take("punct", "(")
+            inner = disjunction()
+            take("punct", ")")
+            return inner
+        name = take("name")
+        if name in odata_functions:
+            take("punct", "(")
+            prop = take("name")
+            take("punct", ",")
+            argument = literal()
+            take("punct", ")")
+            properties.add(prop)
+            function = odata_functions[name]
+            return lambda member: function(casefold_value(member.get(prop)), argument)
+        properties.add(name)
+        operator = take("name")
+        if operator == "in":
+            take("punct", "(")
+            values = [literal()]
+            while peek(","):
+                take("punct", ",")
+                values.append(literal())
+            take("punct", ")")
+            return lambda member: casefold_value(member.get(name)) in values
+        if operator not in odata_comparisons:
+            raise ValueError(f"Cannot evaluate the filter '{text}' locally: unsupported operator {operator}")
+        comparison = odata_comparisons[operator]
+        right = literal()
+        return lambda member: comparison(casefold_value(member.get(name)), right)
+
+    def negation():
+        if peek("not"):
+            take("name", "not")
+            inner = negation()
+            return lambda member: not inner(member)
+        return primary()
+
+    def conjunction():
+        parts = [negation()]
+        while peek("and"):
+            take("name", "and")
+            parts.append(negation())
+        return parts[0] if len(parts) == 1 else lambda member: all(part(member) for part in parts)
+
+    def disjunction():
+        parts = [conjunction()]
+        while peek("or"):
+            take("name", "or")
+            parts.append(conjunction())
+        return parts[0] if len(parts) == 1 else lambda member: any(part(member) for part in parts)
+
+    predicate = disjunction()
+    if index != len(tokens):
+        raise ValueError(f"Cannot evaluate the filter '{text}' locally: unexpected {tokens[index][1]}")
+    return predicate, properties
+
+
+def get_filtered_transitive_members(group_id, endpoint, cast, odata_filter):
+    """
+        Reads the transitive members of one type of a group, filtered by Graph or, if Graph rejects the filter,
+        locally.
+
+        Args:
+            group_id (str): The Azure group id.
+            endpoint (str): The endpoint family, e.g. 'transitiveUsers'.
+            cast (str): The type cast segment, e.g. 'microsoft.graph.user'.
+            odata_filter (str): The OData filter, or None for all members of the type.
+
+        Returns:
+            list: The Graph objects of the matching members.
+
+        Raises:
+            AzureAPIError: If a Graph request fails for another reason than an unsupported filter.
+            ValueError: If Graph rejected the filter and it cannot be evaluated locally either.
+    """
+    path = f"/groups/{group_id}/transitiveMembers/{cast}"
+    odata_type = f"#{cast}"
+    if not odata_filter:
+        members = graph_get_all(endpoint, path)
+    elif odata_filter not in graph_unsupported_filters:
+        try:
+            members = graph_get_all(endpoint, path, params={"$filter": odata_filter, "$count": "true"},
+                                    headers={"ConsistencyLevel": "eventual"})
+        except AzureAPIError as e:
+            if e.status_code != 400:
+                raise
+            graph_unsupported_filters.add(odata_filter)
+            log_event(logging.WARNING, "member_filter_local", group_id=group_id, filter=odata_filter,
+                      reason=str(e)[:200])
+            return get_filtered_transitive_members(group_id, endpoint, cast, odata_filter)
+    else:
+        predicate, properties = compile_odata_filter(odata_filter)
+        select = ",".join(dict.fromkeys(graph_select_by_endpoint[endpoint].split(",") + sorted(properties)))
+        members = [member for member in graph_get_all(endpoint, path, params={"$select": select})
+                   if predicate(member)]
+    for member in members:
+        member.setdefault("@odata.type", odata_type)
+    return members
+
+
+def get_filtered_members_for_group(group_id, member_filter):
+    """
+        Retrieves the flattened membership of a group with a member filter.
+
+        Args:
+            group_id (str): The Azure group id.
+            member_filter (MemberFilter): The filter of the group.
+
+        Returns:
+            dict: {"value": [...]} with the MemberRecords of the nested groups and of the matching users and service
+                  principals, each once.
+
+        Raises:
+            AzureAPIError: If a Graph request fails.
+    """
+    members = get_filtered_transitive_members(group_id, "transitiveGroups", "microsoft.graph.group", None)
+    if member_type_user in member_filter.types:
+        members += get_filtered_transitive_members(group_id, "transitiveUsers", "microsoft.graph.user",
+                                                   member_filter.users)
+    if member_type_service_principal in member_filter.types:
+        members += get_filtered_transitive_members(group_id, "transitiveServicePrincipals",
+                                                   "microsoft.graph.servicePrincipal", member_filter.service_principals)
+    with traversal_lock:
+        traversal_stats["filtered"] += 1
+        return {"value": principal_table.to_records(principal_table.add_all(members))}
+
+
+def benchmark_member_records(memberships, group_size=500, distinct_ratio=0.2, seed=7):
+    """
+        Measures the memory and time per membership of the member representations on a synthetic estate.
+
+        Groups of 'group_size' members are drawn from a shared pool of principals, so principals belong to several
+        groups like in real estates. Every membership is decoded into a fresh Graph-like dict, as a Graph response
+        would be. The 'dicts' representation keeps one {id: dict} per group, the 'records' representation keeps
+        the arrays of principal numbers over a PrincipalTable. Both are then flattened into one deduplicated member
+        set. The retained memory is measured with tracemalloc.
+
+        Args:
+            memberships (int): Total number of group memberships to generate.
+            group_size (int): Members per group.
+            distinct_ratio (float): Number of distinct principals as a fraction of the memberships.
+            seed (int): Random seed, so runs are comparable.
+
+        Returns:
+            dict: Representation name -> {"bytes_per_membership", "peak_bytes_per_membership", "elapsed_s"}.
+    """
+    rng = random.Random(seed)
+    group_size = max(1, min(group_size, memberships))
+    principals = max(group_size, int(memberships * distinct_ratio))
+    groups = [rng.sample(range(principals), group_size) for _ in range(max(1, memberships // group_size))]
+    total = sum(len(group) for group in groups)
+
+    def decoded(number):
+        return {"@odata.type": "#microsoft.graph.user", "id": f"{number:08x}-0000-4000-8000-000000000000",
+                "displayName": f"User {number}", "userPrincipalName": f"user{number}@example.com",
+                "givenName": f"User{number}"}
+
+    def as_dicts():
+        by_group = [{member["id"]: member for member in map(decoded, group)} for group in groups]
+        flattened = {}
+        for members in by_group:
+            flattened.update(members)
+        return by_group, flattened
+
+    def as_records():
+        table = PrincipalTable()
+        by_group = [table.add_all(map(decoded, group)) for group in groups]
+        flattened = set()
+        for numbers in by_group:
+            flattened.update(numbers)
+        return table, by_group, flattened
+
+    results = {}
+    for name, build in (("dicts", as_dicts), ("records", as_records)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        retained = build()
+        elapsed = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del retained
+        results[name] = {"bytes_per_membership": round(current / total, 1),
+                         "peak_bytes_per_membership": round(peak / total, 1), "elapsed_s": round(elapsed, 3)}
+        log_event(logging.INFO, "member_record_benchmark", representation=name, memberships=total,
+                  principals=principals, **results[name])
+    return results
+
+
+def get_all_group_details(groups_users, orig_group_details_append, tmp_group_file_name):
+    """
+        Extracts and stores specific details of Microsoft Graph groups.
+
+        This function processes a list of group-related data ('groups_users') obtained from Microsoft Graph API.
+        It filters and extracts specific details ('displayName') of each group and appends them to a list
+        ('groups_dict_final'). The function also appends original group details ('orig_group_details_append')
+        to the final list and writes the entire group details to a specified file ('tmp_group_file_name').
+
+        Args:
+            groups_users (list): List of MemberRecords of the flattened group members.
+            orig_group_details_append (dict): Original group details to be appended to the final list.
+            tmp_group_file_name (str): File name to which the group details will be written.
+
+        Returns:
+            list: A list containing dictionaries with the extracted group details.
+
+        Raises:
+            Exception: If an error occurs during the processing or writing of group details to the file.
+    """
+    try:
+        all_groups = [record for record in groups_users if record.type == member_type_group]
+
+        # Iterate through each record in the list
+        groups_dict_final = []
+        groups_dict_final.append((orig_group_details_append))
+
+        for group in all_groups:
+            groups_dict_final.append({"displayName": group.display_name})
+
+        # Write User details to user file.
+        with open(tmp_group_file_name, "a") as tmp_groups_file:
+            tmp_groups_file.write(str(groups_dict_final))
+
+        # Append the original
+        return groups_dict_final
+
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+
+def get_all_user_details(groups_users, tmp_user_file_name):
+    """
+        Extracts and stores specific details of Microsoft Graph users.
+
+        This function processes a list of user-related data ('groups_users') obtained from Microsoft Graph API.
+        It filters and extracts specific details ('id', 'userPrincipalName', 'givenName', 'displayName')
+        of each user and writes them to a file ('tmp_user_file_name'), one JSON object per line.
+
+        Args:
+            groups_users (list): List of MemberRecords of the flattened group members.
+            tmp_user_file_name (str): File name to which the user details will be written.
+
+        Returns:
+            None: Returns None after processing and writing user details to the file.
+
+        Raises:
+            Exception: If an error occurs during the processing or writing of user details to the file.
+    """
+    try:
+        all_users = [record for record in groups_users if record.type == member_type_user]
+        if not all_users:
+            return None
+
+        # Write User details to user file.
+        with open(tmp_user_file_name, "a") as tmp_user_file:
+            for user in all_users:
+                required_user_details = {"id": user.id, "userPrincipalName": user.user_principal_name,
+                                         "givenName": user.given_name, "displayName": user.display_name}
+                tmp_user_file.write(json.dumps({key: value for key, value in required_user_details.items()
+                                                if value is not None}) + "\n")
+
+        return None
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+
+
+def get_original_group_details(orig_group_id, tokens):
+    """
+        Retrieves details of the original group from Microsoft Graph API.
+
+        This function makes a request to the Microsoft Graph API to obtain details of the original group
+        identified by its 'orig_group_id'.
+
+        Args:
+            orig_group_id (str): The unique identifier of the original group.
+            tokens (str): Access token for authorization to make the API request.
+
+        Returns:
+            dict: A dictionary containing specific details ('displayName') of the original group.
+
+        Raises:
+            AzureAPIError: If an error occurs during the API request or if the response status code
+                           is not 200 (indicating an unsuccessful API call).
+    """
+    try:
+        # Call MS Graph API to get the group details. This is needed because sometimes the top-level group
+        # may have some SP that needs to be added to the groups file.
+        orig_group_details = graph_get("group", f"/groups/{orig_group_id}", token=tokens)
+        return {"displayName": orig_group_details["displayName"]}
+
+    except Exception as e:
+        raise AzureAPIError(f"An error occurred: {str(e)}")
+
+
+def get_service_principal_app_ids(object_ids, token=None):
+    """
+        Resolves the application ids (appId) of Azure service principals from their object ids.
+
+        The ids are requested in batches with a single 'id in (...)' filter per batch, instead of one request per
+        service principal.
+
+        Args:
+            object_ids (list): The Azure object ids of the service principals.
+            token (str): Access token for the Microsoft Graph API. Optional.
+
+        Returns:
+            dict: Azure object id -> application id, for every service principal that was found.
+
+        Raises:
+            AzureAPIError: If a Graph request fails.
+    """
+    app_ids = {}
+    for start in range(0, len(object_ids), graph_filter_in_batch_size):
+        batch = object_ids[start:start + graph_filter_in_batch_size]
+        id_list = ",".join(f"'{object_id}'" for object_id in batch)
+        for sp in graph_get_all("servicePrincipals", "/servicePrincipals",
+                                params={"$filter": f"id in ({id_list})", "$select": "id,displayName,appId"},
+                                token=token):
+            if sp.get("appId"):
+                app_ids[sp["id"]] = sp["appId"]
+    return app_ids
+
+
+def write_service_principal_records(groups_users, sp_file_name, token=None):
+    """
+        Writes the Service Principals among the flattened members of a group to the SP file.
+
+        The crawl already returns every member with its type and, for Service Principals, its application id (see
+        'graph_member_select'), so the nested groups are not read again. Application ids that are missing anyway
+        are resolved in batches (see get_service_principal_app_ids()).
+
+        Args:
+            groups_users (list): List of MemberRecords of the flattened group members.
+            sp_file_name (str): File name to which the Service Principal details will be written.
+            token (str): Access token for the Microsoft Graph API. Optional.
+
+        Returns:
+            int: The number of Service Principals written.
+    """
+    # Azure object id -> record, so a Service Principal in several nested groups is written once.
+    service_principals = {record.id: record for record in groups_users if record.type == member_type_service_principal}
+    app_ids = {sp_id: record.app_id for sp_id, record in service_principals.items() if record.app_id}
+    app_ids.update(get_service_principal_app_ids([sp_id for sp_id in service_principals if sp_id not in app_ids],
+                                                 token))
+    required_for_sps = []
+    for sp_id, record in service_principals.items():
+        if sp_id not in app_ids:
+            logging.warning(f"No application id found for the Service Principal {record.display_name} "
+                            f"({sp_id}). It will not be synced.")
+            continue
+        required_for_sps.append({"account_id": databricks_account_number, "id": sp_id,
+                                 "displayName": record.display_name, "applicationId": app_ids[sp_id],
+                                 "active": "true"})
+    if required_for_sps:
+        with open(sp_file_name, "a") as sp_file:
+            for required_for_sp in required_for_sps:
+                sp_file.write(json.dumps(required_for_sp) + "\n")
+    log_event(logging.INFO, "service_principals_discovered", service_principals=len(service_principals),
+              app_ids_resolved=len(app_ids))
+    return len(required_for_sps)
+
+
+def create_databricks_group(group_name):
+    """
+        Creates a group in Databricks with a name matching the group in Azure Active Directory.
+
+        This function attempts to create a group in Databricks with the same display name as the group in Azure Active Directory.
+
+        Args:
+            group_name (str): The display name of the group to be created in Databricks.
+
+        Returns:
+            bool: True if the Databricks group creation is successful, False otherwise.
+
+        Raises:
+            Exception: If an error occurs during the Databricks group creation process.
+    """
+    # This function will create a group in Databricks with the same name in Azure AD.
+    try:
+        databricks_group_creation = db_client().groups.create(display_name=group_name)
+        logging.debug("Databricks group created: %s", databricks_group_creation)
+        return True
+    except Exception as e:
+        logging.error("Error: %s", e)
+        return False
+
+
+def filter_tmp_files_by_group_id(directory, group_id):
+    """
+        Filters files in a directory based on a specified group ID prefix and suffix conditions.
+
+        This function scans a specified directory for files and filters them based on the given 'group_id'.
+        It selects files with names starting with the provided 'group_id' and ending with either '_tmp_sp.txt'
+        or '_tmp_users.txt'. The filtered filenames are added to a list and returned.
+
+        Args:
+            directory (str): The path of the directory containing files.
+            group_id (str): The group ID used to filter files by prefix.
+
+        Returns:
+            list: A list of filenames matching the conditions of starting with 'group_id' and ending with
+                  either '_tmp_sp.txt' or '_tmp_users.txt'.
+
+        Raises:
+            None
+    """
+    matching_files = []
+
+    for filename in os.listdir(directory):
+        if filename.startswith(group_id) and (filename.endswith("_tmp_sp.txt") or filename.endswith("_tmp_users.txt")):
+            matching_files.append(filename)
+
+    return matching_files
+
+
+def db_group_index(target):
+    """
+        Returns the account-wide group index of a Databricks target, listing all groups of the account on first use.
+
+        Only the id, displayName and externalId of the groups are requested, not their members.
+
+        Args:
+            target (SyncTarget): The Databricks target.
+
+        Returns:
+            dict: ('externalId', Azure group id) and ('displayName', name) -> Databricks group.
+    """
+    with target.lock:
+        if target.group_index is None:
+            started = time.perf_counter()
+            index = {}
+            for db_group in target.client.groups.list(attributes="id,displayName,externalId"):
+                if db_group.external_id:
+                    index.setdefault(("externalId", db_group.external_id), db_group)
+                index.setdefault(("displayName", db_group.display_name), db_group)
+            target.group_index = index
+            log_event(logging.INFO, "group_index_loaded", target=target.name, entries=len(index),
+                      elapsed_s=round(time.perf_counter() - started, 3))
+        return target.group_index
+
+
+def resolve_db_account_group(azure_group_id, db_group_name):
+    """
+        Returns the Databricks Account group of an Azure group, creating it if it does not exist yet.
+
+        The group is looked up in the group index of the active target, first by externalId (the Azure group id,
+        set on the groups this script creates) and then by display name. A new group is created with the Azure
+        group id as externalId and added to the index, so every group is resolved once per run.
+
+        Args:
+            azure_group_id (str): The Azure group id.
+            db_group_name (str): The display name of the group.
+
+        Returns:
+            Group: The Databricks group handle.
+    """
+    target = active_target()
+    with target.lock:
+        index = db_group_index(target)
+        db_group = index.get(("externalId", azure_group_id)) or index.get(("displayName", db_group_name))
+    if db_group:
+        logging.info(f"The group: {db_group_name} is present in Databricks already.")
+        return db_group
+    # The index was loaded when the run started, so in sharded runs another shard may have created the group since.
+    # The creation lock and a second lookup in the account keep two shards from creating it twice. The target lock
+    # is only held to read and update the index, so the other groups of the target are not blocked by the calls.
+    with principal_creation_lock("groups", db_group_name):
+        with target.lock:
+            db_group = index.get(("externalId", azure_group_id)) or index.get(("displayName", db_group_name))
+        if db_group is None and shard_count > 1:
+            found = list(target.client.groups.list(filter=f"displayName eq '{db_group_name}'",
+                                                   attributes="id,displayName,externalId"))
+            db_group = found[0] if found else None
+        if db_group:
+            logging.info(f"The group: {db_group_name} is present in Databricks already.")
+        else:
+            logging.info(f"The group: {db_group_name} is not present in Databricks. "
+                         f"So we will now create this group in Databricks Account.")
+            db_group = target.client.groups.create(display_name=db_group_name, external_id=azure_group_id)
+        with target.lock:
+            index[("externalId", azure_group_id)] = db_group
+            index[("displayName", db_group_name)] = db_group
+        return db_group
+
+
+def read_member_line(line):
+    """
+        Parses one line of a user or Service Principal temp file.
+
+        Lines are JSON objects. Temp files staged by older versions hold Python dict literals, which are still read.
+
+        Args:
+            line (str): The line.
+
+        Returns:
+            dict: The member details.
+    """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return ast.literal_eval(line)
+
+
+# Membership writes.
+# New members are added to a Databricks group with SCIM PATCH 'add' requests of several members each instead of one
+# full-list update per member. The chunk size adapts per account: it doubles after a full chunk is written within
+# 'fast_write_seconds' and halves on throttling, timeouts, server errors and 'payload too large' responses.
+# The size reached is persisted per account, so the next run starts from it.
+membership_initial_chunk_size = config.getint("membership_writes", "initial_chunk_size", fallback=100)
+membership_min_chunk_size = config.getint("membership_writes", "min_chunk_size", fallback=1)
+membership_max_chunk_size = config.getint("membership_writes", "max_chunk_size", fallback=1000)
+membership_fast_write_seconds = config.getfloat("membership_writes", "fast_write_seconds", fallback=2.0)
+membership_max_retries = config.getint("membership_writes", "max_retries", fallback=5)
+membership_backoff_seconds = config.getfloat("membership_writes", "backoff_seconds", fallback=1.0)
+chunk_size_file = config.get("membership_writes", "state_file", fallback="checkpoints/chunk_sizes.json")
+chunk_size_lock = threading.Lock()
+retryable_write_errors = (db_errors.TooManyRequests, db_errors.InternalError, db_errors.TemporarilyUnavailable,
+                          db_errors.DeadlineExceeded, db_errors.ResourceExhausted, db_errors.RequestLimitExceeded,
+                          db_errors.OperationTimeout, requests.exceptions.Timeout,
+                          requests.exceptions.ConnectionError, TimeoutError)
+
+
+def chunk_size_key(target):
+    """
+        Returns the key the chunk size of a target is persisted under: its Databricks account id, or its name.
+    """
+    return target.account_id or target.name
+
+
+def load_chunk_sizes():
+    """
+        Reads the persisted chunk sizes of all accounts.
+
+        Returns:
+            dict: Account key -> chunk size. Empty if the state file does not exist or cannot be read.
+    """
+    try:
+        with open(chunk_size_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read chunk size file {chunk_size_file}, starting from the defaults: {e}")
+        return {}
+
+
+def target_chunk_size(target):
+    """
+        Returns the current membership write chunk size of a target, loading the persisted one on first use.
+
+        Args:
+            target (SyncTarget): The Databricks target.
+
+        Returns:
+            int: The chunk size, within [membership_writes] min_chunk_size and max_chunk_size.
+    """
+    with target.lock:
+        if target.chunk_size is None:
+            with chunk_size_lock:
+                persisted = load_chunk_sizes().get(chunk_size_key(target), membership_initial_chunk_size)
+            target.chunk_size = max(membership_min_chunk_size, min(membership_max_chunk_size, int(persisted)))
+        return target.chunk_size
+
+
+def save_chunk_size(target):
+    """
+        Persists the current chunk size of a target, keeping the sizes of the other accounts.
+
+        Args:
+            target (SyncTarget): The Databricks target.
+
+        Returns:
+            None
+    """
+    if target.chunk_size is None:
+        return
+    with chunk_size_lock:
+        sizes = load_chunk_sizes()
+        if sizes.get(chunk_size_key(target)) == target.chunk_size:
+            return
+        sizes[chunk_size_key(target)] = target.chunk_size
+        directory = os.path.dirname(chunk_size_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = f"{chunk_size_file}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(sizes, f, indent=2)
+            os.replace(tmp_file, chunk_size_file)
+        except OSError as e:
+            logging.warning(f"Could not save chunk size file {chunk_size_file}: {e}")
+
+
+def is_payload_too_large(error):
+    """
+        Tells whether a failed membership write was rejected as too large (HTTP 413).
+
+        The Databricks SDK has no dedicated exception for it, so it is recognised from the error code or message.
+
+        Args:
+            error (Exception): The exception raised by the write.
+
+        Returns:
+            bool: True if the request payload was too large.
+    """
+    if not isinstance(error, db_errors.DatabricksError):
+        return False
+    error_code = str(getattr(error, "error_code", "") or "").upper()
+    return "413" in error_code or "TOO_LARGE" in error_code or "too large" in str(error).lower()
+
+
+def is_retryable_write_error(error):
+    """
+        Tells whether a failed membership write should be retried with a smaller chunk.
+
+        Args:
+            error (Exception): The exception raised by the write.
+
+        Returns:
+            bool: True for throttling, timeouts, server errors and 'payload too large'.
+    """
+    return isinstance(error, retryable_write_errors) or is_payload_too_large(error)
+
+
+class MembershipWriter:
+    """
+        Adds members to one Databricks group in adaptively sized SCIM PATCH chunks.
+
+        Members are queued with add() and written once a full chunk is pending; flush() writes the rest.
+        The chunk size is shared by all groups of the active target (see target_chunk_size()). With 'remove', the
+        queued members are removed from the group instead, with one SCIM 'remove' operation per member.
+    """
+
+    def __init__(self, db_group, on_written=None, remove=False):
+        """
+            Args:
+                db_group (Group): The Databricks group handle the members are added to.
+                on_written (callable): Called with the position after the last member of every written chunk,
+                                       used to advance the checkpoint cursor. Optional.
+                remove (bool): Remove the members from the group instead of adding them.
+        """
+        self.db_group = db_group
+        self.on_written = on_written
+        self.write = remove_db_group_members if remove else add_db_group_members
+        self.target = active_target()
+        self.pending = []
+        self.requests = 0
+        self.retries = 0
+
+    def add(self, member_id, position):
+        """
+            Queues a member and writes a chunk once enough members are pending.
+
+            Args:
+                member_id (str): The Databricks id of the principal.
+                position (int): Position of the member in the member file.
+        """
+        self.pending.append((member_id, position))
+        if len(self.pending) >= target_chunk_size(self.target):
+            self.write_chunk()
+
+    def flush(self):
+        """
+            Writes all pending members and persists the chunk size reached.
+        """
+        while self.pending:
+            self.write_chunk()
+        save_chunk_size(self.target)
+
+    def write_chunk(self):
+        """
+            Writes the next chunk of pending members, shrinking the chunk and retrying on retryable errors.
+
+            Raises:
+                Exception: The last error, once [membership_writes] max_retries retries are exhausted,
+                           or any non-retryable error.
+        """
+        attempt = 0
+        while True:
+            size = target_chunk_size(self.target)
+            chunk = self.pending[:size]
+            started = time.perf_counter()
+            try:
+                self.requests += 1
+                self.write(self.db_group.id, [member_id for member_id, _ in chunk])
+            except Exception as e:
+                if not is_retryable_write_error(e) or attempt >= membership_max_retries:
+                    raise
+                with self.target.lock:
+                    self.target.chunk_size = max(membership_min_chunk_size,
+                                                 min(len(chunk), self.target.chunk_size) // 2)
+                    if is_payload_too_large(e):
+                        self.target.chunk_size_limit = self.target.chunk_size
+                log_event(logging.WARNING, "membership_write_retry", target=self.target.name,
+                          group=self.db_group.display_name, chunk=len(chunk), error=type(e).__name__,
+                          next_chunk_size=self.target.chunk_size)
+                time.sleep(throttle_backoff(attempt, getattr(e, "retry_after_secs", None),
+                                            base=membership_backoff_seconds))
+                attempt += 1
+                self.retries += 1
+                continue
+
+            elapsed = time.perf_counter() - started
+            del self.pending[:len(chunk)]
+            logging.debug("Wrote %s members of %s in %.3fs", len(chunk), self.db_group.display_name, elapsed)
+            if len(chunk) == size and elapsed <= membership_fast_write_seconds:
+                with self.target.lock:
+                    limit = min(membership_max_chunk_size, self.target.chunk_size_limit or membership_max_chunk_size)
+                    self.target.chunk_size = max(self.target.chunk_size, min(limit, self.target.chunk_size * 2))
+            if self.on_written:
+                self.on_written(chunk[-1][1] + 1)
+            return
+
+
+def create_users_add_to_groups(user_file, create_db_grp, group_id=None, member_filter=None):
+    """
+        Processes user details from a file and adds users to an existing Databricks group.
+
+        This function reads user details from a file and either creates new users in Databricks
+        or adds existing users to the specified Databricks group. It checks if users already exist
+        in the Databricks account and, based on that, adds users to the provided Databricks group.
+        The users are added with SCIM PATCH requests in adaptively sized chunks (see MembershipWriter),
+        which keeps the existing members of the group.
+
+        Args:
+            user_file (file): A file containing user details to be processed.
+            create_db_grp (Group): An object representing the Databricks group to which users will be added.
+            group_id (str): Checkpoint key used to record the position in the member file. Optional.
+            member_filter (set): Azure ids of the members to add. The other members of the file are skipped.
+                                 Optional, by default all members are added.
+
+        Returns:
+            list: The Databricks ids of the members that were added to the group.
+
+        Raises:
+            None
+    """
+    started = time.perf_counter()
+    existing_count = 0
+    created_count = 0
+    applied_member_ids = []
+    # Members before the checkpoint cursor were applied by an interrupted run already.
+    start_at = get_checkpoint_cursor(group_id, "users") if group_id else 0
+    # All users of the account are matched by user name from one listing.
+    preload_db_principals("users")
+    writer = MembershipWriter(
+        create_db_grp, on_written=(lambda position: set_checkpoint_cursor(group_id, "users", position))
+        if group_id else None)
+
+    for line_number, line in enumerate(user_file):
+        if line_number < start_at:
+            continue
+        user_details = read_member_line(line)
+        if member_filter is not None and user_details.get("id") not in member_filter:
+            continue
+        display_name = user_details.get("displayName", "None")
+        user_name = azure_user_name(user_details)
+        required_db_user_id = find_db_principal_id("users", user_name)
+
+        if required_db_user_id:
+            # user already exists in the Databricks Account. So user will not be created,
+            # but will add user to group. The id of the user comes from the preloaded principal cache of the account.
+            logging.debug("User %s already exists in Databricks Account, so will add this user"
+                          " to the group. Databricks user creation will be ignored.", display_name)
+            existing_count += 1
+        else:
+            logging.debug("User %s Does NOT exists in Databricks Account. This user will be created "
+                          "in Databricks Account and then be added to the group.", display_name)
+            created_count += 1
+            db_a_user_creation = create_db_principal_exclusively(
+                "users", user_name,
+                lambda: db_client().users.create(active=True, display_name=display_name, user_name=user_name))
+            required_db_user_id = db_a_user_creation.id
+
+        applied_member_ids.append(required_db_user_id)
+        writer.add(required_db_user_id, line_number)
+
+    writer.flush()
+    log_event(logging.INFO, "group_apply_summary", target=active_target().name, group=create_db_grp.display_name,
+              kind="users", existing=existing_count, created=created_count, write_requests=writer.requests,
+              chunk_size=active_target().chunk_size, elapsed_s=round(time.perf_counter() - started, 3))
+    return applied_member_ids
+
+
+def create_sps_add_to_groups(sps_file, create_db_grp, group_id=None, member_filter=None):
+    """
+        Processes Service Principal details from a file and adds Service Principals to an existing Databricks group.
+
+        This function reads SP details from a file and either creates new SP in Databricks
+        or adds existing SP to the specified Databricks group. It checks if SP already exist
+        in the Databricks account and, based on that, adds SP to the provided Databricks group.
+        The SPs are added with SCIM PATCH requests in adaptively sized chunks (see MembershipWriter),
+        which keeps the existing members of the group.
+
+        Args:
+            sps_file (file): A file containing SP details to be processed.
+            create_db_grp (Group): An object representing the Databricks group to which users will be added.
+            group_id (str): Checkpoint key used to record the position in the member file. Optional.
+            member_filter (set): Azure ids of the members to add. The other members of the file are skipped.
+                                 Optional, by default all members are added.
+
+        Returns:
+            list: The Databricks ids of the members that were added to the group.
+
+        Raises:
+            None
+    """
+    started = time.perf_counter()
+    existing_count = 0
+    created_count = 0
+    applied_member_ids = []
+    # Members before the checkpoint cursor were applied by an interrupted run already.
+    start_at = get_checkpoint_cursor(group_id, "service_principals") if group_id else 0
+    # All service principals of the account are matched by application id from one listing.
+    preload_db_principals("service_principals")
+    writer = MembershipWriter(
+        create_db_grp, on_written=(lambda position: set_checkpoint_cursor(group_id, "service_principals", position))
+        if group_id else None)
+
+    for line_number, line in enumerate(sps_file):
+        if line_number < start_at:
+            continue
+        sp_details = read_member_line(line)
+        if member_filter is not None and sp_details.get("id") not in member_filter:
+            continue
+        display_name = sp_details.get("displayName", "None")
+        application_id = sp_details.get("applicationId", "None")
+
+        required_db_sps_id = find_db_principal_id("service_principals", application_id)
+
+        if required_db_sps_id:
+            # SP already exists in the Databricks Account. So SP will not be created,
+            # but will add SP to group. The id of the SP comes from the principal cache of the account,
+            # where service principals are keyed by their application id.
+            logging.debug("Service Principal %s already exists in Databricks Account, so will add this SP"
+                          " to the group. Databricks Service Principal creation will be ignored.", display_name)
+            existing_count += 1
+        else:
+            logging.debug("Service Principal %s Does NOT exists in Databricks Account. "
+                          "This Service Principal will be created in Databricks Account and then added to the group.",
+                          display_name)
+            created_count += 1
+            db_a_sps_creation = create_db_principal_exclusively(
+                "service_principals", application_id,
+                lambda: db_client().service_principals.create(active=True, display_name=display_name,
+                                                              application_id=application_id))
+            required_db_sps_id = db_a_sps_creation.id
+
+        applied_member_ids.append(required_db_sps_id)
+        writer.add(required_db_sps_id, line_number)
+
+    writer.flush()
+    log_event(logging.INFO, "group_apply_summary", target=active_target().name, group=create_db_grp.display_name,
+              kind="service_principals", existing=existing_count, created=created_count,
+              write_requests=writer.requests, chunk_size=active_target().chunk_size,
+              elapsed_s=round(time.perf_counter() - started, 3))
+    return applied_member_ids
+
+
+def create_db_users_add_to_group(db_user_file_name, db_group, group_id=None, member_filter=None):
+    """
+        Creates Databricks account users and adds them to a specified group.
+
+        This function reads user details from a file ('db_user_file_name') and creates users in the Databricks account.
+        It then adds these users to the specified Databricks group ('db_group').
+        The existing members of the group are kept.
+
+        Args:
+            db_user_file_name (str): The file path containing user details to be processed.
+            db_group (Group): The Databricks group to which users will be added.
+            group_id (str): Azure group id used to checkpoint the progress. Optional.
+            member_filter (set): Azure ids of the members to add. Optional, by default all members are added.
+
+        Returns:
+            tuple: The Databricks group handle and the list of Databricks ids of the members added to it.
+
+        Raises:
+            None
+    """
+    # create databricks account users.
+    # read the input user file and loop through the file line by line and create each user.
+    with open(db_user_file_name, "r") as user_file:
+        a1 = create_users_add_to_groups(user_file, db_group, group_id, member_filter)
+        logging.debug("a1: %s", a1)
+        return db_group, a1
+
+
+def create_db_sps_add_to_group(db_sps_file_name, db_group, group_id=None, member_filter=None):
+    """
+        Creates Databricks account users and adds them to a specified group.
+
+        This function reads user details from a file ('db_user_file_name') and creates users in the Databricks account.
+        It then adds these users to the specified Databricks group ('db_group').
+        The existing members of the group are kept.
+
+        Args:
+            db_sps_file_name (str): The file path containing user details to be processed.
+            db_group (Group): The Databricks group to which users will be added.
+            group_id (str): Azure group id used to checkpoint the progress. Optional.
+            member_filter (set): Azure ids of the members to add. Optional, by default all members are added.
+
+        Returns:
+            tuple: The Databricks group handle and the list of Databricks ids of the members added to it.
+
+        Raises:
+            None
+    """
+    # create databricks account service principals.
+    # read the input Service Principal file and loop through the file line by line and create each SP in Databricks.
+    with open(db_sps_file_name, "r") as sp_file:
+        a1 = create_sps_add_to_groups(sp_file, db_group, group_id, member_filter)
+        logging.debug("a1: %s", a1)
+        return db_group, a1
+
+
+def process_files(matching_files, db_group, group_id=None, member_filter=None):
+    """
+        Processes files based on their types (user or service principal) and performs corresponding actions.
+
+        This function analyzes the provided list of file names ('matching_files') to identify the presence of files
+        related to users ('_tmp_users.txt') and service principals ('_tmp_sp.txt'). Based on the identified files,
+        it initiates the creation of users and/or service principals in the Databricks account.
+
+        Args:
+            matching_files (list): A list of file names to be processed.
+            db_group (Group): The Databricks group where users/service principals will be added.
+            group_id (str): Azure group id used to checkpoint the progress. Optional.
+            member_filter (set): Azure ids of the members to add. Optional, by default all members are added.
+
+        Returns:
+            dict: {"group": Databricks group handle, "member_ids": set of Databricks member ids} once all files
+                  were processed, or None if an error occurred.
+
+        Raises:
+            None
+    """
+
+    applied = {"group": db_group, "member_ids": set()}
+
+    def collect(result):
+        if result:
+            applied["group"] = result[0]
+            applied["member_ids"].update(result[1] or [])
+
+    try:
+        has_users = any("_tmp_users.txt" in file for file in matching_files)
+        has_sp = any("_tmp_sp.txt" in file for file in matching_files)
+
+        if has_users and has_sp:
+            logging.info("Now creating both Users and Service Principals.")
+            # create_db_users() get only user files
+            users_files = [file for file in matching_files if file.endswith("_tmp_users.txt")]
+            user_grp_status = create_db_users_add_to_group(f"{tmp_files_folder}/{users_files[0]}", db_group,
+                                                           group_id, member_filter)
+            logging.debug("user_grp_status: %s", user_grp_status)
+            collect(user_grp_status)
+            # create_db_sp()
+            sp_files = [file for file in matching_files if file.endswith("_tmp_sp.txt")]
+            sps_grp_status = create_db_sps_add_to_group(f"{tmp_files_folder}/{sp_files[0]}", db_group,
+                                                        group_id, member_filter)
+            logging.debug("sps_grp_status: %s", sps_grp_status)
+            collect(sps_grp_status)
+        elif has_users:
+            logging.info("Now creating only users.")
+            # create_db_users()
+            users_files = [file for file in matching_files if file.endswith("_tmp_users.txt")]
+            user_grp_status = create_db_users_add_to_group(f"{tmp_files_folder}/{users_files[0]}", db_group,
+                                                           group_id, member_filter)
+            logging.debug("user_grp_status: %s", user_grp_status)
+            collect(user_grp_status)
+        elif has_sp:
+            logging.info("Now creating only sp.")
+            # create_db_sp()
+            sp_files = [file for file in matching_files if file.endswith("_tmp_sp.txt")]
+            sps_grp_status = create_db_sps_add_to_group(f"{tmp_files_folder}/{sp_files[0]}", db_group,
+                                                        group_id, member_filter)
+            logging.debug("sps_grp_status: %s", sps_grp_status)
+            collect(sps_grp_status)
+        else:
+            # Handle scenario when neither file is present
+            logging.error("Something other than Users, Service Principals found. Check the groups_users_sps folder "
+                          "for the types of files created.")
+            exit(99)
+        return applied
+
+    except Exception as e:
+        logging.error(f"Error processing files: {e}")
+        return None
+
+
+# Post-apply verification.
+verification_max_retries = config.getint("verification", "max_retries", fallback=3)
+verification_backoff_seconds = config.getfloat("verification", "backoff_seconds", fallback=2.0)
+verification_results = []
+verification_lock = threading.Lock()
+
+
+def get_db_group_member_ids(db_group_id):
+    """
+        Reads the current member ids of a Databricks Account group.
+
+        Args:
+            db_group_id (str): The Databricks group id.
+
+        Returns:
+            set: The Databricks ids of the group members.
+    """
+    db_group = db_client().groups.get(id=db_group_id)
+    return {member.value for member in (db_group.members or [])}
+
+
+def add_db_group_members(db_group_id, member_ids):
+    """
+        Adds members to a Databricks Account group with a single SCIM PATCH 'add' operation.
+
+        Unlike groups.update(), this only sends the given member ids and leaves the other members untouched.
+        The ids are sent sorted, so the same members always make the same request (see "Recording and replay").
+
+        Args:
+            db_group_id (str): The Databricks group id.
+            member_ids (iterable): The Databricks ids of the principals to add.
+
+        Returns:
+            None
+    """
+    db_client().groups.patch(
+        id=db_group_id,
+        operations=[Patch(op=PatchOp.ADD,
+                          value={"members": [{"value": member_id} for member_id in sorted(member_ids)]})],
+        schemas=[PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP],
+    )
+
+
+def remove_db_group_members(db_group_id, member_ids):
+    """
+        Removes members from a Databricks Account group with a single SCIM PATCH request, one 'remove' operation
+        per member.
+
+        Args:
+            db_group_id (str): The Databricks group id.
+            member_ids (iterable): The Databricks ids of the principals to remove.
+
+        Returns:
+            None
+    """
+    db_client().groups.patch(
+        id=db_group_id,
+        operations=[Patch(op=PatchOp.REMOVE, path=f'members[value eq "{member_id}"]')
+                    for member_id in sorted(member_ids)],
+        schemas=[PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP],
+    )
+
+
+def verify_group_membership(db_group, intended_member_ids, group_id=None):
+    """
+        Verifies that all intended members ended up in a Databricks group and re-sends only the missing ones.
+
+        The group members are read back once and compared with the intended member ids. Missing ids are re-added
+        with exponential backoff, up to [verification] max_retries times, reading the group back after each retry.
+
+        Args:
+            db_group (Group): The Databricks group handle returned by resolve_db_account_group().
+            intended_member_ids (set): The Databricks ids of the members that were applied to the group.
+            group_id (str): The Azure group id. If given, the members read back are written to the snapshot of the
+                            group on the active target. Optional.
+
+        Returns:
+            dict: Convergence stats of the group ('intended', 'missing_after_apply', 'retries', 'missing',
+                  'converged').
+    """
+    intended = {member_id for member_id in intended_member_ids if member_id}
+    current = get_db_group_member_ids(db_group.id)
+    missing = intended - current
+    stats = {"target": active_target().name, "group": db_group.display_name, "intended": len(intended),
+             "missing_after_apply": len(missing), "retries": 0}
+
+    while missing and stats["retries"] < verification_max_retries:
+        time.sleep(verification_backoff_seconds * (2 ** stats["retries"]))
+        stats["retries"] += 1
+        logging.debug("Re-adding %s missing members to %s: %s", len(missing), db_group.display_name, missing)
+        try:
+            writer = MembershipWriter(db_group)
+            for position, member_id in enumerate(sorted(missing)):
+                writer.add(member_id, position)
+            writer.flush()
+        except Exception as e:
+            logging.warning(f"Re-adding missing members to {db_group.display_name} failed: {e}")
+        current = get_db_group_member_ids(db_group.id)
+        missing = intended - current
+
+    stats["missing"] = len(missing)
+    stats["converged"] = not missing
+    if group_id and not missing:
+        write_target_snapshot(group_id, active_target(), current)
+    log_event(logging.INFO if not missing else logging.WARNING, "group_verification", **stats)
+    with verification_lock:
+        verification_results.append(stats)
+    return stats
+
+
+def get_verification_summary():
+    """
+        Sums up the convergence stats of all groups verified in this run.
+
+        Returns:
+            dict: The number of verified groups, converged groups and missing members.
+    """
+    with verification_lock:
+        return {
+            "groups": len(verification_results),
+            "converged": sum(1 for r in verification_results if r["converged"]),
+            "converged_after_retry": sum(1 for r in verification_results if r["converged"] and r["retries"]),
+            "members_missing_after_apply": sum(r["missing_after_apply"] for r in verification_results),
+            "members_still_missing": sum(r["missing"] for r in verification_results),
+        }
+
+
+def log_verification_summary():
+    """
+        Logs a 'verification_summary' record with the convergence stats of all groups verified in this run.
+
+        Returns:
+            None
+    """
+    log_event(logging.INFO, "verification_summary", **get_verification_summary())
+
+
+# Deprovisioning.
+# With [deprovisioning] enabled, after a group is applied its Databricks members are compared with the flattened
+# Azure membership. Users and service principals that are members in Databricks but not in Azure are stale and are
+# removed in adaptively sized chunks (see MembershipWriter). Members that are not users or service principals of the
+# account, e.g. nested Databricks groups, are never removed. A group loses at most 'max_removal_percent' percent of
+# its members per run (and any number up to 'always_allowed_removals'); larger removals, e.g. after an incomplete
+# crawl, are blocked and logged. With 'deactivate_principals', removed principals that are not in any group synced in
+# this run are deactivated at the end of a complete run, and deactivated principals that are synced again are
+# reactivated. A shard only knows its own groups, so in sharded runs the shards report the principals they removed
+# and synced, and the principals are deactivated when the shard reports are merged.
+deprovisioning_enabled = config.getboolean("deprovisioning", "enabled", fallback=False)
+deprovisioning_max_removal_percent = config.getfloat("deprovisioning", "max_removal_percent", fallback=20.0)
+deprovisioning_always_allowed_removals = config.getint("deprovisioning", "always_allowed_removals", fallback=5)
+deprovisioning_deactivate_principals = config.getboolean("deprovisioning", "deactivate_principals", fallback=False)
+deprovisioning_state = {}  # target name -> {"removed": principal ids, "synced": principal ids}
+deprovisioning_results = []
+deprovisioning_lock = threading.Lock()
+
+
+def get_intended_db_member_ids(group_id):
+    """
+        Resolves the Databricks ids of all members in the temp files of a group, without creating any principal.
+
+        Args:
+            group_id (str): The Azure group id.
+
+        Returns:
+            set: The Databricks ids of the users and service principals that exist in the account.
+    """
+    preload_db_principals("users")
+    preload_db_principals("service_principals")
+    member_ids = set()
+    for file_name, kind, member_key in ((f"{group_id}_tmp_users.txt", "users", azure_user_name),
+                                        (f"{group_id}_tmp_sp.txt", "service_principals",
+                                         lambda details: details.get("applicationId"))):
+        try:
+            with open(os.path.join(tmp_files_folder, file_name), "r") as member_file:
+                for line in member_file:
+                    member_id = find_db_principal_id(kind, member_key(read_member_line(line)))
+                    if member_id:
+                        member_ids.add(member_id)
+        except FileNotFoundError:
+            continue
+    return member_ids
+
+
+def reactivate_db_principals(member_ids):
+    """
+        Reactivates the deactivated principals among the given members of a synced group.
+
+        Args:
+            member_ids (set): Databricks ids of users and service principals.
+
+        Returns:
+            int: The number of principals reactivated.
+    """
+    target = active_target()
+    with target.lock:
+        inactive = member_ids & target.inactive_principal_ids
+    for member_id in inactive:
+        set_db_principal_active(member_id, True)
+        with target.lock:
+            target.inactive_principal_ids.discard(member_id)
+    return len(inactive)
+
+
+def set_db_principal_active(principal_id, active):
+    """
+        Activates or deactivates a Databricks user or service principal with a SCIM PATCH request.
+
+        Args:
+            principal_id (str): The Databricks id of the user or service principal.
+            active (bool): The new 'active' value.
+
+        Returns:
+            None
+    """
+    kind = "service_principals" if principal_id in service_principal_ids(active_target()) else "users"
+    getattr(db_client(), kind).patch(
+        id=principal_id,
+        operations=[Patch(op=PatchOp.REPLACE, path="active", value=active)],
+        schemas=[PatchSchema.URN_IETF_PARAMS_SCIM_API_MESSAGES_2_0_PATCH_OP],
+    )
+
+
+def service_principal_ids(target):
+    """
+        Returns the Databricks ids of the service principals in the principal cache of a target.
+    """
+    with target.lock:
+        return {principal_id for (kind, _), principal_id in target.principal_cache.items()
+                if kind == "service_principals"}
+
+
+def deprovision_group(group_id, db_group):
+    """
+        Removes the stale members of a Databricks group: users and service principals that are no longer members
+        of the flattened Azure group.
+
+        Args:
+            group_id (str): The Azure group id.
+            db_group (Group): The Databricks group handle returned by resolve_db_account_group().
+
+        Returns:
+            dict: The removal stats of the group ('members', 'stale', 'removed', 'blocked', 'reactivated').
+    """
+    target = active_target()
+    intended = get_intended_db_member_ids(group_id)
+    current = get_db_group_member_ids(db_group.id)
+    with target.lock:
+        # Only one of several principals with the same key is known as intended, so none of them is removed.
+        stale = {member_id for member_id in current - intended
+                 if member_id in target.principal_ids and member_id not in target.ambiguous_principal_ids}
+    allowed = max(deprovisioning_always_allowed_removals, len(current) * deprovisioning_max_removal_percent / 100)
+    stats = {"target": target.name, "group": db_group.display_name, "members": len(current), "stale": len(stale),
+             "removed": 0, "blocked": len(stale) > allowed, "reactivated": 0}
+
+    if stats["blocked"]:
+        log_event(logging.WARNING, "group_removal_blocked", group_id=group_id, max_removals=int(allowed), **stats)
+    elif stale:
+        writer = MembershipWriter(db_group, remove=True)
+        for position, member_id in enumerate(sorted(stale)):
+            writer.add(member_id, position)
+        writer.flush()
+        stats["removed"] = len(stale)
+        write_target_snapshot(group_id, target, current - stale)
+    if deprovisioning_deactivate_principals:
+        stats["reactivated"] = reactivate_db_principals(intended)
+
+    with deprovisioning_lock:
+        state = deprovisioning_state.setdefault(target.name, {"removed": set(), "synced": set()})
+        state["synced"].update(intended)
+        if not stats["blocked"]:
+            state["removed"].update(stale)
+        deprovisioning_results.append(stats)
+    log_event(logging.INFO, "group_deprovisioning", group_id=group_id, **stats)
+    return stats
+
+
+def deactivate_orphaned_principals(target, complete):
+    """
+        Deactivates the principals that were removed from a group in this run and are not in any synced group.
+
+        Only done if all groups were applied to the target in this run, as otherwise some of them may still be
+        members of a group that was not applied.
+
+        Args:
+            target (SyncTarget): The Databricks target.
+            complete (bool): Whether every group was applied to and verified on the target in this run.
+
+        Returns:
+            int: The number of principals deactivated.
+    """
+    with deprovisioning_lock:
+        state = deprovisioning_state.get(target.name, {"removed": set(), "synced": set()})
+        orphaned = state["removed"] - state["synced"]
+    if not orphaned:
+        return 0
+    if not complete:
+        log_event(logging.WARNING, "principal_deactivation_skipped", target=target.name, principals=len(orphaned),
+                  reason="not all groups were applied in this run")
+        return 0
+    target_context.target = target
+    deactivated = 0
+    try:
+        # Tells users and service principals apart when the principals were not listed by this process.
+        preload_db_principals("service_principals")
+        for principal_id in sorted(orphaned):
+            try:
+                set_db_principal_active(principal_id, False)
+                deactivated += 1
+            except Exception as e:
+                logging.warning(f"Deactivating principal {principal_id} on {target.name} failed: {e}")
+    finally:
+        target_context.target = None
+    log_event(logging.INFO, "principals_deactivated", target=target.name, principals=deactivated)
+    return deactivated
+
+
+def target_run_complete(results, resumed):
+    """
+        Returns whether every group was applied to and verified on a target in this run.
+    """
+    return not resumed and not (results["not_verified"] or results["failed"] or results["carried_over"])
+
+
+def finish_deprovisioning(target_results, resumed):
+    """
+        Deactivates the orphaned principals of every target, if enabled, and logs a 'deprovisioning_summary'.
+
+        Args:
+            target_results (list): The results of apply_to_target() per target, in the order of 'sync_targets'.
+            resumed (bool): Whether this run resumed an interrupted run. Groups applied by the interrupted run are
+                            not known, so no principal is deactivated.
+
+        Returns:
+            None
+    """
+    if not deprovisioning_enabled:
+        return
+    deactivated = 0
+    if deprovisioning_deactivate_principals and shard_count > 1:
+        log_event(logging.INFO, "principal_deactivation_deferred", shard=f"{shard_index}/{shard_count}",
+                  reason="principals are deactivated when the shard reports are merged")
+    elif deprovisioning_deactivate_principals:
+        for target, results in zip(sync_targets, target_results):
+            deactivated += deactivate_orphaned_principals(target, target_run_complete(results, resumed))
+    with deprovisioning_lock:
+        log_event(logging.INFO, "deprovisioning_summary", groups=len(deprovisioning_results),
+                  blocked=sum(1 for r in deprovisioning_results if r["blocked"]),
+                  removed=sum(r["removed"] for r in deprovisioning_results),
+                  reactivated=sum(r["reactivated"] for r in deprovisioning_results), deactivated=deactivated)
+
+
+def get_deprovisioning_report(target_results, resumed):
+    """
+        Returns the principals removed and synced by this shard per target, for the shard report.
+
+        Args:
+            target_results (list): The results of apply_to_target() per target, in the order of 'sync_targets'.
+            resumed (bool): Whether this run resumed an interrupted run.
+
+        Returns:
+            dict: Target name -> {"removed": ids, "synced": ids, "complete": bool}, see deactivate_merged_principals().
+    """
+    report = {}
+    with deprovisioning_lock:
+        for target, results in zip(sync_targets, target_results):
+            state = deprovisioning_state.get(target.name, {"removed": set(), "synced": set()})
+            report[target.name] = {
+                "removed": sorted(state["removed"]), "synced": sorted(state["synced"]),
+                "complete": target_run_complete(results, resumed)}
+    return report
+
+
+def deactivate_merged_principals(shard_reports, missing_shards):
+    """
+        Deactivates the principals that a shard removed from a group and that no shard synced.
+
+        Nothing is deactivated on a target unless every shard reported and applied all its groups to it.
+
+        Args:
+            shard_reports (list): The get_deprovisioning_report() of every shard that reported.
+            missing_shards (list): The shards without a report.
+
+        Returns:
+            int: The number of principals deactivated.
+    """
+    deactivated = 0
+    for target in sync_targets:
+        states = [report.get(target.name) for report in shard_reports]
+        complete = not missing_shards and all(state and state["complete"] for state in states)
+        with deprovisioning_lock:
+            deprovisioning_state[target.name] = {
+                "removed": {principal_id for state in states if state for principal_id in state["removed"]},
+                "synced": {principal_id for state in states if state for principal_id in state["synced"]}}
+        deactivated += deactivate_orphaned_principals(target, complete)
+    return deactivated
+
+
+def clean_up_files(directory_path: object, keep_group_ids=None) -> object:
+    """
+        Cleans up temporary files within the specified directory.
+
+        This function deletes temporary files found within the provided directory path. It iterates through the files
+        in the directory and removes them one by one. If no temporary files are present, it logs a message indicating
+        their absence. Files of the groups in 'keep_group_ids' are kept, so an interrupted run can resume from them.
+
+        Args:
+            directory_path (str): The path to the directory containing temporary files.
+            keep_group_ids (set): Azure group ids whose temporary files must not be deleted. Optional.
+
+        Returns:
+            None
+
+        Raises:
+            None
+    """
+    tmp_files_folder_name = directory_path
+    if os.listdir(tmp_files_folder_name):
+        logging.info("Now attempting to delete all temp files.")
+        for filename in os.listdir(tmp_files_folder_name):
+            file_path = os.path.join(tmp_files_folder_name, filename)
+            if keep_group_ids and filename.split('_')[0] in keep_group_ids:
+                continue
+            try:
+                if os.path.isfile(file_path):
+                    os.unlink(file_path)  # Delete the file
+                    logging.debug("Deleted: %s", file_path)
+            except Exception as e:
+                logging.error(f"Error deleting {file_path}: {e}")
+    else:
+        logging.info("There are no tmp files to delete.")
+
+
+def get_group_id_from_name(azure_group_name, tokens):
+    """
+        Retrieves the Azure Active Directory (AAD) group ID based on the group name.
+
+        This function queries the Microsoft Graph API to find a group's ID by its display name. It uses the provided
+        authentication tokens to authorize the request. If the group exists, it returns the group ID; otherwise, it
+        returns False.
+
+        Args:
+            azure_group_name (str): The display name of the Azure Active Directory group.
+            tokens (str): The authentication token required for accessing the Microsoft Graph API.
+
+        Returns:
+            Union[str, bool]: Returns the group ID as a string if found, or False if the group doesn't exist.
+
+        Raises:
+            AzureAPIError: If an error occurs while querying the Microsoft Graph API or processing the response,
+                an AzureAPIError is raised to handle exceptional cases.
+    """
+    try:
+        # Call MS Graph API to get the group details. This is needed because sometimes the top-level group
+        # may have some SP that needs to be added to the groups file.
+        orig_group_details = graph_get("groups", "/groups",
+                                       params={"$filter": f"startswith(displayName,'{azure_group_name}')"},
+                                       token=tokens)
+        if len(orig_group_details['value']) > 0:
+            group_id = orig_group_details['value'][0]['id']
+
+            return group_id
+        else:
+            return False
+
+    except Exception as e:
+        raise AzureAPIError(f"An error occurred: {str(e)}")
+
+
+# Group discovery.
+# Besides explicit 'group_ids' and 'group_names', groups_to_sync.json can select groups by pattern:
+# 'group_name_prefixes' (display name starts with), 'group_search_patterns' (Graph $search, e.g. "displayName:dbx")
+# and 'administrative_unit_ids' (all groups in the administrative unit). Each pattern is expanded with paged Graph
+# queries that only select id and displayName. The groups found per pattern are kept in [group_discovery] cache_file
+# and reused for 'refresh_minutes', so a run does not list hundreds of groups again when the patterns did not change.
+group_discovery_cache_file = config.get("group_discovery", "cache_file",
+                                        fallback="checkpoints/group_discovery.json")
+group_discovery_refresh_minutes = config.getfloat("group_discovery", "refresh_minutes", fallback=60)
+group_discovery_kinds = {"group_name_prefixes": "prefix", "group_search_patterns": "search",
+                         "administrative_unit_ids": "administrative_unit"}
+
+
+def load_group_discovery_cache():
+    """
+        Reads the groups found per pattern by the previous runs.
+
+        Returns:
+            dict: Pattern key -> {"refreshed": epoch seconds, "groups": [[group id, group name], ...]}.
+    """
+    try:
+        with open(group_discovery_cache_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read group discovery cache {group_discovery_cache_file}, starting without it: {e}")
+        return {}
+
+
+def save_group_discovery_cache(cache):
+    """
+        Writes the groups found per pattern atomically. Shards of one node may write it at the same time.
+
+        Returns:
+            None
+    """
+    directory = os.path.dirname(group_discovery_cache_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{group_discovery_cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_file, group_discovery_cache_file)
+
+
+def expand_group_pattern(kind, pattern, token):
+    """
+        Lists the groups matching one discovery pattern.
+
+        Args:
+            kind (str): 'prefix', 'search' or 'administrative_unit'.
+            pattern (str): The display name prefix, the $search expression or the administrative unit id.
+            token (str): Access token for Microsoft Graph.
+
+        Returns:
+            list: [group id, group name] of every matching group, in the order Graph returned them.
+
+        Raises:
+            AzureAPIError: If a page request fails.
+    """
+    if kind == "prefix":
+        escaped = pattern.replace("'", "''")
+        groups = graph_get_all("groupDiscovery", "/groups",
+                               params={"$filter": f"startswith(displayName,'{escaped}')"}, token=token)
+    elif kind == "search":
+        # $search needs the advanced query capabilities and its expression in double quotes.
+        expression = pattern if pattern.startswith('"') else f'"{pattern}"'
+        groups = graph_get_all("groupDiscovery", "/groups", params={"$search": expression},
+                               token=token, headers={"ConsistencyLevel": "eventual"})
+    else:
+        groups = graph_get_all("administrativeUnitGroups",
+                               f"/directory/administrativeUnits/{pattern}/members/microsoft.graph.group", token=token)
+    return [[group["id"], group.get("displayName")] for group in groups]
+
+
+def discover_groups(items_to_sync, token):
+    """
+        Expands the group patterns of groups_to_sync.json into the groups they match.
+
+        Patterns whose cached result is older than [group_discovery] refresh_minutes are expanded again. If that
+        fails, the cached result is used and a warning is logged; a pattern that was never expanded is skipped.
+
+        Args:
+            items_to_sync (dict): The content of groups_to_sync.json.
+            token (str): Access token for Microsoft Graph.
+
+        Returns:
+            list: (group id, group name) of every group matched by any pattern, each group once.
+    """
+    patterns = [(kind, pattern) for key, kind in group_discovery_kinds.items()
+                for pattern in items_to_sync.get(key) or []]
+    if not patterns:
+        return []
+    cache = load_group_discovery_cache()
+    cache_changed = False
+    discovered = {}
+    for kind, pattern in patterns:
+        cache_key = f"{kind}:{pattern}"
+        cached = cache.get(cache_key)
+        source = "cache"
+        if cached is None or time.time() - cached["refreshed"] >= group_discovery_refresh_minutes * 60:
+            try:
+                groups = expand_group_pattern(kind, pattern, token)
+                cached = cache[cache_key] = {"refreshed": time.time(), "groups": groups}
+                cache_changed = True
+                source = "graph"
+            except AzureAPIError as e:
+                if cached is None:
+                    logging.error(f"Could not expand group pattern {cache_key}, its groups are not synced: {e}")
+                    continue
+                logging.warning(f"Could not refresh group pattern {cache_key}, using the cached groups: {e}")
+                source = "stale_cache"
+        new_groups = 0
+        for group_id, name in cached["groups"]:
+            if group_id not in discovered:
+                discovered[group_id] = name
+                new_groups += 1
+        log_event(logging.INFO, "group_pattern_expanded", kind=kind, pattern=pattern, source=source,
+                  groups=len(cached["groups"]), new_groups=new_groups)
+    if cache_changed:
+        try:
+            save_group_discovery_cache(cache)
+        except OSError as e:
+            logging.warning(f"Could not save group discovery cache {group_discovery_cache_file}: {e}")
+    return list(discovered.items())
+
+
+# Checkpoints.
+# The progress of every group is recorded in a small JSON state file, so an interrupted run can be restarted and
+# picks up each group at the phase (and position in the member file) where it stopped. Phase changes are saved right
+# away, member file positions only every 'cursor_save_chunks' membership writes: a resumed run re-applies at most
+# that many chunks, which is harmless because adding a member twice is a no-op.
+checkpoint_file = config.get("checkpoint", "state_file", fallback="checkpoints/sync_state.json")
+checkpoint_cursor_save_chunks = max(1, config.getint("checkpoint", "cursor_save_chunks", fallback=20))
+checkpoint_unsaved_cursors = 0
+checkpoint_phases = ["crawled", "staged", "principals_resolved", "memberships_applied", "verified"]
+checkpoint_state = {"run_complete": True, "groups": {}}
+checkpoint_lock = threading.RLock()
+
+
+def load_checkpoint_state():
+    """
+        Loads the checkpoint state of the previous run from 'checkpoint_file'.
+
+        Returns:
+            dict: The saved state, or an empty completed state if there is no (readable) state file.
+    """
+    try:
+        with open(checkpoint_file, "r") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {"run_complete": True, "groups": {}}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Checkpoint file {checkpoint_file} could not be read, starting a fresh run: {e}")
+        return {"run_complete": True, "groups": {}}
+
+
+def save_checkpoint_state():
+    """
+        Writes the checkpoint state atomically, so a crash while writing never leaves a truncated state file.
+
+        Returns:
+            None
+    """
+    global checkpoint_unsaved_cursors
+    with checkpoint_lock:
+        checkpoint_unsaved_cursors = 0
+        directory = os.path.dirname(checkpoint_file) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp_name = f"{checkpoint_file}.tmp"
+        with open(tmp_name, "w") as state_file:
+            json.dump(checkpoint_state, state_file, indent=1)
+        os.replace(tmp_name, checkpoint_file)
+
+
+def update_checkpoint(group_id, phase=None, **fields):
+    """
+        Records the progress of a group and saves the state.
+
+        The phase of a group only moves forward through 'checkpoint_phases'. Additional fields (e.g. the display name
+        or the Databricks group id) are stored with the group.
+
+        Args:
+            group_id (str): The Azure group id.
+            phase (str): The phase the group has completed. Optional.
+            **fields: Values stored with the group.
+
+        Returns:
+            None
+    """
+    with checkpoint_lock:
+        entry = checkpoint_state["groups"].setdefault(group_id, {"phase": None, "cursor": {}})
+        if phase and (entry["phase"] is None or
+                      checkpoint_phases.index(phase) > checkpoint_phases.index(entry["phase"])):
+            entry["phase"] = phase
+        entry.update(fields)
+        entry["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        save_checkpoint_state()
+
+
+def checkpoint_phase_reached(group_id, phase):
+    """
+        Checks whether a group has completed a phase in this or the interrupted previous run.
+
+        Args:
+            group_id (str): The Azure group id.
+            phase (str): One of 'checkpoint_phases'.
+
+        Returns:
+            bool: True if the group is at or past the phase.
+    """
+    with checkpoint_lock:
+        current = checkpoint_state["groups"].get(group_id, {}).get("phase")
+    return current is not None and checkpoint_phases.index(current) >= checkpoint_phases.index(phase)
+
+
+def get_checkpoint_cursor(group_id, kind):
+    """
+        Returns the number of members of a member file that were already applied.
+
+        Args:
+            group_id (str): The Azure group id.
+            kind (str): 'users' or 'service_principals'.
+
+        Returns:
+            int: The position in the member file to continue from.
+    """
+    with checkpoint_lock:
+        return checkpoint_state["groups"].get(group_id, {}).get("cursor", {}).get(kind, 0)
+
+
+def set_checkpoint_cursor(group_id, kind, position):
+    """
+        Records the position in a member file up to which all members were applied. The state is saved every
+        'checkpoint_cursor_save_chunks' positions, or with the next phase change of any group.
+
+        Args:
+            group_id (str): The Azure group id.
+            kind (str): 'users' or 'service_principals'.
+            position (int): The number of members applied.
+
+        Returns:
+            None
+    """
+    global checkpoint_unsaved_cursors
+    with checkpoint_lock:
+        entry = checkpoint_state["groups"].setdefault(group_id, {"phase": None, "cursor": {}})
+        entry.setdefault("cursor", {})[kind] = position
+        checkpoint_unsaved_cursors += 1
+        if checkpoint_unsaved_cursors >= checkpoint_cursor_save_chunks:
+            save_checkpoint_state()
+
+
+def start_checkpointed_run(fresh=False):
+    """
+        Prepares the checkpoint state and the temp files folder for a new run.
+
+        If the previous run did not complete, it is resumed: the temp files of the groups that were not verified on
+        every Databricks target are kept, and only the files of completed-and-verified groups are deleted.
+        Otherwise (or with 'fresh') all temp files are deleted and the state is reset.
+
+        Args:
+            fresh (bool): Ignore the checkpoints of an interrupted run.
+
+        Returns:
+            bool: True if an interrupted run is being resumed.
+    """
+    global checkpoint_state
+    previous = load_checkpoint_state()
+    resuming = not fresh and not previous.get("run_complete", True) and bool(previous.get("groups"))
+    with checkpoint_lock:
+        if resuming:
+            checkpoint_state = previous
+            pending = {group_id for group_id in previous["groups"] if "@" not in group_id and
+                       not group_verified_on_all_targets(group_id, previous["groups"])}
+            log_event(logging.INFO, "run_resumed", groups=len(previous["groups"]), pending=len(pending))
+            clean_up_files(tmp_files_folder, keep_group_ids=pending)
+        else:
+            checkpoint_state = {"run_complete": False, "groups": {}}
+            clean_up_files(tmp_files_folder)
+        checkpoint_state["run_complete"] = False
+        checkpoint_state["started"] = datetime.datetime.now().isoformat(timespec="seconds")
+        # A resumed run keeps its run id, so it continues to write the snapshots of the interrupted run.
+        checkpoint_state.setdefault(
+            "run_id", datetime.datetime.now().strftime("%Y%m%dT%H%M%S") + snapshot_run_suffix())
+        save_checkpoint_state()
+    return resuming
+
+
+def finish_checkpointed_run(resumed):
+    """
+        Marks the run as complete if every group was verified on every target, so the next run starts fresh.
+
+        Otherwise the run stays incomplete and the next run resumes it, retrying only the groups that were not
+        verified. A resumed run is always marked complete, so groups that keep failing do not hold back the other
+        groups for more than one run.
+
+        Args:
+            resumed (bool): Whether this run resumed an interrupted run.
+
+        Returns:
+            None
+    """
+    with checkpoint_lock:
+        group_ids = [group_id for group_id in checkpoint_state["groups"] if "@" not in group_id]
+        verified = [group_id for group_id in group_ids
+                    if group_verified_on_all_targets(group_id, checkpoint_state["groups"])]
+        checkpoint_state["run_complete"] = resumed or len(verified) == len(group_ids)
+        save_checkpoint_state()
+    log_event(logging.INFO, "run_checkpoint_summary", groups=len(group_ids), verified=len(verified),
+              not_verified=len(group_ids) - len(verified), run_complete=checkpoint_state["run_complete"])
+
+
+def apply_checkpoint_key(group_id, target=None):
+    """
+        Returns the checkpoint key of the apply phases of a group on a Databricks target.
+
+        The crawl phases ('crawled', 'staged') are recorded under the Azure group id, the apply phases separately
+        for every target under '<group id>@<target name>'.
+
+        Args:
+            group_id (str): The Azure group id.
+            target (SyncTarget): The Databricks target. Defaults to the active target.
+
+        Returns:
+            str: The checkpoint key.
+    """
+    return f"{group_id}@{(target or active_target()).name}"
+
+
+def group_verified_on_all_targets(group_id, groups):
+    """
+        Checks whether a group was verified on every configured Databricks target.
+
+        Args:
+            group_id (str): The Azure group id.
+            groups (dict): The 'groups' of a checkpoint state.
+
+        Returns:
+            bool: True if the apply phases of all targets reached 'verified'.
+    """
+    return all(groups.get(apply_checkpoint_key(group_id, target), {}).get("phase") == "verified"
+               for target in sync_targets)
+
+
+def remove_group_tmp_files(group_id):
+    """
+        Deletes the temp files of one group, e.g. when a crawl was interrupted before its files were complete.
+
+        Args:
+            group_id (str): The Azure group id.
+
+        Returns:
+            None
+    """
+    for suffix in ("_tmp_groups.txt", "_tmp_users.txt", "_tmp_sp.txt"):
+        file_path = f"{tmp_files_folder}/{group_id}{suffix}"
+        if os.path.isfile(file_path):
+            os.unlink(file_path)
+
+
+# Sharding.
+# A large groups_to_sync.json can be split across several worker processes on one node (--processes N) or across
+# nodes (--shard i/N). Groups are assigned to shards by a stable hash of their id, users by a stable hash of their
+# name. Each shard has its own temp files folder, checkpoint file and run report; the reports are merged at the end.
+shard_index = 0
+shard_count = 1
+report_dir = config.get("sharding", "report_dir", fallback="reports")
+principal_lock_dir = config.get("sharding", "lock_dir", fallback="locks")
+principal_thread_locks = collections.defaultdict(threading.Lock)
+principal_thread_locks_guard = threading.Lock()
+
+
+def parse_shard(value):
+    """
+        Parses a '--shard i/N' argument.
+
+        Args:
+            value (str): The shard as 'i/N', with 0 <= i < N.
+
+        Returns:
+            tuple: (i, N)
+
+        Raises:
+            argparse.ArgumentTypeError: If the value is not a valid shard.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected i/N, e.g. 0/4.")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', i must be between 0 and N-1.")
+    return index, count
+
+
+def shard_of(key, count):
+    """
+        Returns the shard a group or user belongs to.
+
+        The hash is stable across processes, runs and nodes (unlike the built-in hash()).
+
+        Args:
+            key (str): The Azure group id, group name or user name from groups_to_sync.json.
+            count (int): The number of shards.
+
+        Returns:
+            int: The shard index.
+    """
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % count
+
+
+def shard_owns(key):
+    """
+        Checks whether a group or user belongs to the shard of this process.
+
+        Args:
+            key (str): The Azure group id, group name or user name from groups_to_sync.json.
+
+        Returns:
+            bool: True if this process has to sync it.
+    """
+    return shard_count == 1 or shard_of(key, shard_count) == shard_index
+
+
+def configure_shard(index, count):
+    """
+        Makes this process run one shard: it gets its own temp files folder, checkpoint, schedule, chunk size,
+        snapshot index and Graph cache files.
+
+        Args:
+            index (int): The shard index.
+            count (int): The number of shards.
+
+        Returns:
+            None
+    """
+    global shard_index, shard_count, tmp_files_folder, checkpoint_file, graph_cache_file, schedule_state_file
+    global snapshot_latest_file, chunk_size_file
+    shard_index, shard_count = index, count
+    suffix = f"shard_{index}_of_{count}"
+    tmp_files_folder = os.path.join(tmp_files_folder, suffix)
+    os.makedirs(tmp_files_folder, exist_ok=True)
+    checkpoint_file = f"{os.path.splitext(checkpoint_file)[0]}.{suffix}.json"
+    schedule_state_file = f"{os.path.splitext(schedule_state_file)[0]}.{suffix}.json"
+    chunk_size_file = f"{os.path.splitext(chunk_size_file)[0]}.{suffix}.json"
+    snapshot_latest_file = f"{os.path.splitext(snapshot_latest_file)[0]}.{suffix}.json"
+    if graph_cache_file:
+        graph_cache_file = f"{os.path.splitext(graph_cache_file)[0]}.{suffix}.json"
+    log_event(logging.INFO, "shard_started", shard=f"{index}/{count}")
+
+
+@contextlib.contextmanager
+def principal_creation_lock(kind, key):
+    """
+        Serializes the creation of one Databricks principal or group across threads and, in sharded runs, across
+        processes.
+
+        Shards use an exclusive lock file per principal in 'principal_lock_dir'. For shards on different nodes this
+        folder must be on a file system shared by all nodes.
+
+        Args:
+            kind (str): 'users', 'service_principals' or 'groups'.
+            key (str): The user name of the user, the display name of the group, or the application id of the service
+                       principal.
+
+        Yields:
+            None
+    """
+    lock_key = f"{active_target().name}/{kind}/{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+    with principal_thread_locks_guard:
+        thread_lock = principal_thread_locks[lock_key]
+    with thread_lock:
+        if shard_count == 1 or fcntl is None:
+            yield
+            return
+        lock_path = os.path.join(principal_lock_dir, f"{lock_key}.lock")
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def create_db_principal_exclusively(kind, key, create_principal):
+    """
+        Creates a Databricks user or service principal unless another thread or shard created it first.
+
+        Under the principal creation lock the account is checked once more, so concurrent shards that found the
+        principal missing do not both create it. Unsharded runs skip the check for kinds that were preloaded.
+
+        Args:
+            kind (str): 'users' or 'service_principals'.
+            key (str): The user name of the user, or the application id of the service principal.
+            create_principal (callable): Creates the principal and returns it.
+
+        Returns:
+            The existing or created principal (an object with an 'id').
+    """
+    with principal_creation_lock(kind, key):
+        found = []
+        if shard_count > 1 or kind not in active_target().preloaded_kinds:
+            found = list(getattr(db_client(), kind).list(filter=f"{principal_key_attribute(kind)} eq '{key}'"))
+        principal = found[0] if found else create_principal()
+    cache_db_principal_id(kind, key, principal.id)
+    return principal
+
+
+def merge_counters(merged, other):
+    """
+        Adds the numbers of a (nested) report dict to another one.
+
+        Args:
+            merged (dict): The dict the values are added to.
+            other (dict): The dict to add.
+
+        Returns:
+            dict: 'merged'
+    """
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge_counters(merged.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            merged[key] = merged.get(key, 0) + value
+        else:
+            merged.setdefault(key, value)
+    return merged
+
+
+def write_run_report(report):
+    """
+        Writes the report of this shard to 'report_dir'.
+
+        Args:
+            report (dict): The run report.
+
+        Returns:
+            str: The report file name.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    report_file = os.path.join(report_dir, f"shard_{shard_index}_of_{shard_count}.json")
+    with open(report_file, "w") as report_out:
+        json.dump(report, report_out, indent=1, default=str)
+    return report_file
+
+
+def merge_shard_reports(count):
+    """
+        Merges the reports of all shards of a run into 'report_dir/merged_report.json'.
+
+        Args:
+            count (int): The number of shards.
+
+        Returns:
+            dict: The merged report. Shards without a report are listed under 'missing_shards'.
+    """
+    merged = {"shards": count, "missing_shards": []}
+    deprovisioning_reports = []
+    for index in range(count):
+        report_file = os.path.join(report_dir, f"shard_{index}_of_{count}.json")
+        try:
+            with open(report_file, "r") as report_in:
+                report = json.load(report_in)
+        except (OSError, ValueError):
+            merged["missing_shards"].append(index)
+            continue
+        report.pop("shard", None)
+        merged["elapsed_s_max"] = max(merged.get("elapsed_s_max", 0), report.pop("elapsed_s", 0))
+        deprovisioning_reports.append(report.pop("deprovisioning", {}))
+        merge_counters(merged, report)
+    if deprovisioning_enabled and deprovisioning_deactivate_principals:
+        merged["principals_deactivated"] = deactivate_merged_principals(deprovisioning_reports,
+                                                                        merged["missing_shards"])
+    with open(os.path.join(report_dir, "merged_report.json"), "w") as merged_out:
+        json.dump(merged, merged_out, indent=1)
+    log_event(logging.INFO, "shard_reports_merged", shards=count, missing_shards=merged["missing_shards"],
+              groups=merged.get("groups", 0), elapsed_s_max=merged.get("elapsed_s_max"))
+    return merged
+
+
+def run_shard_processes(count, extra_args):
+    """
+        Runs a sync with 'count' worker processes on this node, one per shard, and merges their reports.
+
+        Args:
+            count (int): The number of worker processes.
+            extra_args (list): Command line arguments passed on to the workers.
+
+        Returns:
+            int: 0 if all workers succeeded, otherwise the first non-zero exit code.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    for index in range(count):
+        stale_report = os.path.join(report_dir, f"shard_{index}_of_{count}.json")
+        if os.path.isfile(stale_report):
+            os.unlink(stale_report)
+
+    workers = []
+    for index in range(count):
+        env = dict(os.environ, AD_SYNC_LOG_SUFFIX=f"shard_{index}_of_{count}")
+        workers.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--shard", f"{index}/{count}", *extra_args], env=env))
+    exit_codes = [worker.wait() for worker in workers]
+    for index, exit_code in enumerate(exit_codes):
+        if exit_code:
+            logging.error(f"Shard {index}/{count} exited with code {exit_code}.")
+
+    merge_shard_reports(count)
+    return next((code for code in exit_codes if code), 0)
+
+
+# Cassettes and the performance gate.
+# --record runs a sync in a scratch folder with AD_SYNC_RECORD set (see "Recording and replay" above) and writes a
+# sanitized cassette: secrets and access tokens are replaced by REDACTED, the tenant, client and account ids by fixed
+# placeholders, and names, user principal names and mail addresses by pseudonyms that are the same wherever the value
+# appears, so the replayed run sends the same requests. The cassette also holds the sanitized cred.ini and
+# groups_to_sync.json of the recorded run. --replay runs a sync against a cassette without any network access.
+# --perf-gate replays a cassette and compares the HTTP calls per group, the request and response bytes and the
+# replayed wall time with a committed baseline, so a change that adds requests per group (an N+1 pattern) fails.
+# The calls are counted per group synced, including the groups found by prefix, $search or administrative unit.
+perf_gate_baseline_file = config.get("perf_gate", "baseline_file", fallback="perf_baseline.json")
+perf_gate_tolerances = {
+    "calls_per_group": config.getfloat("perf_gate", "calls_tolerance_percent", fallback=0),
+    "request_bytes": config.getfloat("perf_gate", "bytes_tolerance_percent", fallback=10),
+    "response_bytes": config.getfloat("perf_gate", "bytes_tolerance_percent", fallback=10),
+    "wall_s": config.getfloat("perf_gate", "wall_tolerance_percent", fallback=25),
+}
+perf_gate_latency_scale = config.getfloat("perf_gate", "latency_scale", fallback=1)
+cassette_redacted = "REDACTED"
+cassette_secret_options = re.compile(r"secret|token|password", re.IGNORECASE)
+cassette_secret_keys = {"access_token", "refresh_token", "id_token", "client_secret", "password"}
+cassette_pii_keys = {"displayName", "display_name", "display", "userPrincipalName", "givenName", "surname", "mail",
+                     "userName", "user_name", "otherMails", "emails"}
+cassette_placeholder_ids = {"tenant_id": "00000000-0000-4000-8000-000000000001",
+                            "client_id": "00000000-0000-4000-8000-000000000002",
+                            "databricks_account_number": "00000000-0000-4000-8000-000000000003"}
+
+
+def run_sync_in_scratch_dir(cred_text, groups_text, env):
+    """
+        Runs a full sync (--fresh) in a new scratch folder with the given cred.ini and groups_to_sync.json.
+
+        Args:
+            cred_text (str): The content of cred.ini.
+            groups_text (str): The content of groups_to_sync.json.
+            env (dict): Variables added to the environment of the sync.
+
+        Returns:
+            tuple: (exit code, the stats the sync wrote to AD_SYNC_HTTP_STATS or {}, wall time in seconds).
+    """
+    scratch_dir = tempfile.mkdtemp(prefix="ad_sync_")
+    try:
+        with open(os.path.join(scratch_dir, "cred.ini"), "w") as cred_out:
+            cred_out.write(cred_text)
+        with open(os.path.join(scratch_dir, "groups_to_sync.json"), "w") as groups_out:
+            groups_out.write(groups_text)
+        for folder in ("logs", tmp_files_folder):
+            os.makedirs(os.path.join(scratch_dir, folder), exist_ok=True)
+        stats_file = os.path.join(scratch_dir, "http_stats.json")
+        started = time.perf_counter()
+        exit_code = subprocess.call([sys.executable, os.path.abspath(__file__), "--fresh"], cwd=scratch_dir,
+                                    env=dict(os.environ, AD_SYNC_HTTP_STATS=stats_file, **env))
+        wall_s = time.perf_counter() - started
+        stats = {}
+        if os.path.isfile(stats_file):
+            with open(stats_file, "r") as stats_in:
+                stats = json.load(stats_in)
+        return exit_code, stats, wall_s
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+class CassetteSanitizer:
+    """
+        Replaces secrets, tenant identifiers and personal data in the texts of a recorded run.
+
+        Pseudonyms are derived from a random salt, so the same value gets the same pseudonym everywhere in a cassette
+        but different ones in different cassettes.
+    """
+
+    def __init__(self, config_parser):
+        self.salt = uuid.uuid4().hex
+        self.literals = {}  # exact text -> replacement, applied to every string of the cassette
+        self.pseudonyms = {}  # personal value -> pseudonym
+        for section in config_parser.sections():
+            for option, value in config_parser.items(section):
+                if value and cassette_secret_options.search(option):
+                    self.literals[value] = cassette_redacted
+                elif value and option in cassette_placeholder_ids:
+                    self.literals[value] = cassette_placeholder_ids[option]
+
+    def pseudonym(self, value):
+        """
+            Returns the pseudonym of a personal value, keeping the shape of mail addresses.
+        """
+        if value not in self.pseudonyms:
+            digest = hashlib.sha1(f"{self.salt}:{value}".encode("utf-8")).hexdigest()[:12]
+            self.pseudonyms[value] = f"user-{digest}@example.invalid" if "@" in value else f"name-{digest}"
+        return self.pseudonyms[value]
+
+    def collect(self, obj, key=None):
+        """
+            Collects the personal values of a JSON document, i.e. the strings under one of 'cassette_pii_keys'.
+        """
+        if isinstance(obj, dict):
+            for name, value in obj.items():
+                # The addresses of SCIM 'emails' are the 'value' of its entries.
+                is_email = key == "emails" and name == "value"
+                self.collect(value, name if name in cassette_pii_keys else key if is_email else None)
+        elif isinstance(obj, list):
+            for value in obj:
+                self.collect(value, key)
+        elif isinstance(obj, str) and key and obj:
+            self.pseudonym(obj)
+
+    def text(self, value):
+        """
+            Returns a string with its secrets and ids replaced and the personal values in its quoted OData literals
+            pseudonymized.
+        """
+        for literal, replacement in self.literals.items():
+            value = value.replace(literal, replacement)
+        if value in self.pseudonyms:
+            return self.pseudonyms[value]
+
+        # Quotes inside a literal are not always escaped, so the longest quoted span that is a personal value wins.
+        quotes = [position for position, char in enumerate(value) if char == "'"]
+        parts, copied, index = [], 0, 0
+        while index < len(quotes):
+            for end in range(len(quotes) - 1, index, -1):
+                literal = value[quotes[index] + 1:quotes[end]]
+                pseudonym = self.pseudonyms.get(literal) or self.pseudonyms.get(literal.replace("''", "'"))
+                if pseudonym:
+                    parts += [value[copied:quotes[index] + 1], pseudonym]
+                    copied, index = quotes[end], end
+                    break
+            index += 1
+        return "".join(parts) + value[copied:]
+
+    def url(self, url):
+        """
+            Returns a sanitized canonical URL. The query options are sanitized decoded, as their OData literals are
+            percent-encoded in the URL.
+        """
+        base, _, query = url.partition("?")
+        pairs = [(name, self.text(value)) for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True)]
+        return canonical_url(f"{self.text(base)}?{urllib.parse.urlencode(pairs)}") if pairs else self.text(base)
+
+    def document(self, obj, key=None):
+        """
+            Returns a sanitized copy of a JSON document.
+        """
+        if isinstance(obj, dict):
+            return {name: cassette_redacted if name in cassette_secret_keys else self.document(value, name)
+                    for name, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.document(value, key) for value in obj]
+        if isinstance(obj, str):
+            return self.text(obj)
+        return obj
+
+    def body(self, body):
+        """
+            Returns a sanitized request or response body: JSON documents structurally, other bodies as text.
+        """
+        if body is None:
+            return None
+        try:
+            return json.dumps(self.document(json.loads(body)), separators=(",", ":"))
+        except ValueError:
+            return self.text(body)
+
+
+def parse_json_or_none(body):
+    """
+        Returns a body parsed as JSON, or None if it is empty or not JSON.
+    """
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+def record_cassette(cassette_file):
+    """
+        Runs a full sync with the cred.ini and groups_to_sync.json of the current folder, records all its HTTP
+        exchanges and writes them sanitized to 'cassette_file'.
+
+        Args:
+            cassette_file (str): The cassette to write.
+
+        Returns:
+            int: The exit code of the recorded sync.
+    """
+    # Membership writes use a fixed chunk size, as the adaptive size depends on timing and on the order in which
+    # groups are applied, and a different chunk size makes different PATCH requests on replay.
+    recorded_config = configparser.ConfigParser()
+    recorded_config.read("cred.ini")
+    if not recorded_config.has_section("membership_writes"):
+        recorded_config.add_section("membership_writes")
+    for option in ("min_chunk_size", "max_chunk_size"):
+        recorded_config.set("membership_writes", option, str(membership_initial_chunk_size))
+    cred_out = io.StringIO()
+    recorded_config.write(cred_out)
+    cred_text = cred_out.getvalue()
+    with open("groups_to_sync.json", "r") as groups_in:
+        groups_text = groups_in.read()
+    raw_file = f"{cassette_file}.raw"
+    exit_code, stats, wall_s = run_sync_in_scratch_dir(cred_text, groups_text,
+                                                       {"AD_SYNC_RECORD": os.path.abspath(raw_file)})
+    try:
+        with open(raw_file, "r") as raw_in:
+            exchanges = json.load(raw_in)["exchanges"]
+    finally:
+        if os.path.isfile(raw_file):
+            os.unlink(raw_file)
+
+    # Personal values are collected from all documents first, so they are also replaced where they appear before
+    # the response they were read from, e.g. in group names of groups_to_sync.json.
+    sanitizer = CassetteSanitizer(config)
+    for exchange in exchanges:
+        sanitizer.collect(parse_json_or_none(exchange["request_body"]))
+        sanitizer.collect(parse_json_or_none(exchange["body"]))
+    for name in json.loads(groups_text).get("group_names") or []:
+        sanitizer.pseudonym(name)
+    sanitized = [dict(exchange, url=sanitizer.url(exchange["url"]),
+                      request_body=sanitizer.body(exchange["request_body"]),
+                      headers={name: sanitizer.text(value) for name, value in exchange["headers"].items()},
+                      body=sanitizer.body(exchange["body"])) for exchange in exchanges]
+    sanitized_config = configparser.ConfigParser()
+    sanitized_config.read_string(cred_text)
+    for section in sanitized_config.sections():
+        for option, value in sanitized_config.items(section, raw=True):
+            sanitized_config.set(section, option, sanitizer.text(value))
+    cred_out = io.StringIO()
+    sanitized_config.write(cred_out)
+    with open(cassette_file, "w") as cassette_out:
+        json.dump({"meta": {"groups": stats.get("groups", 0), "exit_code": exit_code,
+                            "wall_s": round(wall_s, 3), "http": stats, "cred_ini": cred_out.getvalue(),
+                            "groups_to_sync": json.dumps(sanitizer.document(json.loads(groups_text)), indent=2)},
+                   "exchanges": sanitized}, cassette_out, indent=1)
+    log_event(logging.INFO, "cassette_recorded", cassette=cassette_file, exchanges=len(sanitized),
+              pseudonyms=len(sanitizer.pseudonyms), exit_code=exit_code)
+    return exit_code
+
+
+def replay_cassette(cassette_file, latency_scale=1):
+    """
+        Runs a full sync against the recorded exchanges of a cassette, without network access.
+
+        Args:
+            cassette_file (str): The cassette to replay.
+            latency_scale (float): Factor applied to the recorded latencies.
+
+        Returns:
+            dict: The exit code, HTTP stats, replayed wall time and calls per group of the replayed sync.
+    """
+    with open(cassette_file, "r") as cassette_in:
+        meta = json.load(cassette_in)["meta"]
+    # The Databricks SDK is given a token so it does not look for credentials outside the cassette.
+    exit_code, stats, wall_s = run_sync_in_scratch_dir(meta["cred_ini"], meta["groups_to_sync"], {
+        "AD_SYNC_REPLAY": os.path.abspath(cassette_file), "AD_SYNC_REPLAY_LATENCY_SCALE": str(latency_scale),
+        "DATABRICKS_TOKEN": cassette_redacted})
+    groups = max(1, stats.get("groups") or meta["groups"])
+    result = {"exit_code": exit_code, "groups": groups, "calls": stats.get("calls", 0),
+              "misses": stats.get("misses", 0), "calls_per_group": round(stats.get("calls", 0) / groups, 3),
+              "request_bytes": stats.get("request_bytes", 0), "response_bytes": stats.get("response_bytes", 0),
+              "wall_s": round(stats.get("wall_s", wall_s), 3)}
+    log_event(logging.INFO, "cassette_replayed", cassette=cassette_file, **result)
+    return result
+
+
+def run_perf_gate(cassette_file, baseline_file, update_baseline=False):
+    """
+        Replays a cassette and compares the result with the baseline of that cassette.
+
+        A metric regresses if it exceeds its baseline value by more than its tolerance in 'perf_gate_tolerances'.
+        Requests missing from the cassette and a failed replayed sync always fail the gate.
+
+        Args:
+            cassette_file (str): The cassette to replay.
+            baseline_file (str): JSON file with the baseline of every cassette, keyed by cassette file name.
+            update_baseline (bool): Store the replayed result as the new baseline instead of comparing.
+
+        Returns:
+            bool: True if the gate passed.
+    """
+    result = replay_cassette(cassette_file, perf_gate_latency_scale)
+    baselines = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file, "r") as baseline_in:
+            baselines = json.load(baseline_in)
+    cassette_name = os.path.basename(cassette_file)
+    if update_baseline:
+        baselines[cassette_name] = {metric: result[metric] for metric in perf_gate_tolerances}
+        with open(baseline_file, "w") as baseline_out:
+            json.dump(baselines, baseline_out, indent=1, sort_keys=True)
+        log_event(logging.INFO, "perf_baseline_updated", cassette=cassette_name, baseline=baselines[cassette_name])
+        return result["exit_code"] == 0 and result["misses"] == 0
+
+    baseline = baselines.get(cassette_name)
+    if baseline is None:
+        raise ValueError(f"No baseline for cassette {cassette_name} in {baseline_file}, run with --update-baseline.")
+    regressions = {}
+    for metric, tolerance_percent in perf_gate_tolerances.items():
+        limit = baseline[metric] * (1 + tolerance_percent / 100)
+        if result[metric] > limit:
+            regressions[metric] = {"baseline": baseline[metric], "replayed": result[metric], "limit": round(limit, 3)}
+    passed = not regressions and result["misses"] == 0 and result["exit_code"] == 0
+    log_event(logging.INFO if passed else logging.ERROR, "perf_gate", cassette=cassette_name, passed=passed,
+              regressions=regressions, misses=result["misses"], exit_code=result["exit_code"])
+    return passed
+
+
+# Membership snapshots.
+# Every run writes the flattened membership of each crawled group to snapshots/<run id>/<group id>.bin: the Azure
+# object ids, sorted, followed by a column with the type of every member. After a group is verified on a target,
+# the Databricks member ids read back by the verification are written to <group id>@<target>.bin. snapshots/
+# latest.json points every group to the snapshot of its last verified run. Comparing the new snapshot with it
+# tells which members were added and removed: unchanged groups are not sent to Databricks at all, changed groups
+# only with their added members. Each run also writes a manifest.json with the diff of every group.
+snapshots_enabled = config.getboolean("snapshots", "enabled", fallback=True)
+snapshot_diff_apply = config.getboolean("snapshots", "diff_apply", fallback=True)
+snapshot_dir = config.get("snapshots", "directory", fallback="snapshots")
+snapshot_keep_runs = config.getint("snapshots", "keep_runs", fallback=30)
+snapshot_latest_file = os.path.join(snapshot_dir, "latest.json")
+snapshot_magic = b"ADS1"
+snapshot_type_codes = {member_type_user: 1, member_type_group: 2, member_type_service_principal: 3}
+snapshot_type_names = {code: name for name, code in snapshot_type_codes.items()}
+snapshot_id_encodings = {"text": 0, "uuid": 1, "int64": 2}
+snapshot_latest = {}  # group id -> {"run", "digest", "verified_targets"} of the last verified snapshot
+snapshot_manifest = {}  # group id -> snapshot and diff of this run
+snapshot_diffs = {}  # group id -> {"status", "added", "removed"}, computed once per run
+snapshot_lock = threading.RLock()
+
+
+def encode_id_column(ids):
+    """
+        Encodes a sorted id column: 16 bytes per id if all are GUIDs, 8 bytes if all are integers, otherwise
+        length-prefixed UTF-8. The binary encodings are only used if every id decodes back to the same string, so
+        ids like '0123' or upper case GUIDs are kept as text.
+
+        Args:
+            ids (list): The ids, as strings.
+
+        Returns:
+            tuple: (encoding code, bytes).
+    """
+    try:
+        guids = [uuid.UUID(member_id) for member_id in ids]
+        if all(str(guid) == member_id for guid, member_id in zip(guids, ids)):
+            return snapshot_id_encodings["uuid"], b"".join(guid.bytes for guid in guids)
+    except ValueError:
+        pass
+    if all(member_id.isascii() and member_id.isdigit() and len(member_id) < 19 and str(int(member_id)) == member_id
+           for member_id in ids):
+        return snapshot_id_encodings["int64"], struct.pack(f"<{len(ids)}q", *(int(member_id) for member_id in ids))
+    encoded = [member_id.encode("utf-8") for member_id in ids]
+    return snapshot_id_encodings["text"], b"".join(struct.pack("<H", len(e)) + e for e in encoded)
+
+
+def decode_id_column(encoding, count, data, offset):
+    """
+        Decodes an id column written by encode_id_column().
+
+        Returns:
+            tuple: (list of ids, offset after the column).
+    """
+    if encoding == snapshot_id_encodings["uuid"]:
+        ids = [str(uuid.UUID(bytes=data[offset + 16 * i:offset + 16 * (i + 1)])) for i in range(count)]
+        return ids, offset + 16 * count
+    if encoding == snapshot_id_encodings["int64"]:
+        return [str(value) for value in struct.unpack_from(f"<{count}q", data, offset)], offset + 8 * count
+    ids = []
+    for _ in range(count):
+        (length,) = struct.unpack_from("<H", data, offset)
+        ids.append(data[offset + 2:offset + 2 + length].decode("utf-8"))
+        offset += 2 + length
+    return ids, offset
+
+
+def write_snapshot_file(path, ids, types=None):
+    """
+        Writes a snapshot file: a header, the sorted id column and, if given, the type column.
+
+        Args:
+            path (str): The file name.
+            ids (list): The member ids.
+            types (list): The type tag of every member, in the order of 'ids'. Optional.
 
-def get_service_principal_details(groups_file_name, token, sp_file_name):
+        Returns:
+            str: SHA-1 digest of the file content, which is the same for the same membership.
     """
-        Retrieves and logs details of Service Principals associated with groups from Microsoft Graph API.
-
-        This function reads group details from a file ('groups_file_name'), iterates through each group,
-        retrieves the associated Service Principals using Microsoft Graph API, and logs their details. It then
-        writes specific Service Principal details to a file ('sp_file_name').
+    rows = sorted(zip(ids, types or [None] * len(ids)))
+    encoding, id_column = encode_id_column([row[0] for row in rows])
+    type_column = bytes(snapshot_type_codes.get(row[1], 0) for row in rows) if types is not None else b""
+    content = struct.pack("<4sBBI", snapshot_magic, encoding, 1 if types is not None else 0, len(rows))
+    content += id_column + type_column
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+    os.replace(tmp_file, path)
+    return hashlib.sha1(content).hexdigest()
+
+
+def read_snapshot_file(path):
+    """
+        Reads a snapshot file written by write_snapshot_file().
 
         Args:
-            groups_file_name (str): The name of the file containing group details.
-            token (str): Access token for authorization to make the API request.
-            sp_file_name (str): File name to which the Service Principal details will be written.
+            path (str): The file name.
 
         Returns:
-            str: Message indicating the successful completion of the function.
+            tuple: (sorted list of ids, list of type tags or None).
 
         Raises:
-            Exception: If an error occurs during the processing, API requests, or file writing.
+            ValueError: If the file is not a snapshot file.
     """
-    try:
-        with open(groups_file_name, "r") as temp_group_file:
-            lines = ast.literal_eval(temp_group_file.read())
-            for group in lines:
-                logging.info("Now working in group: " + str(group.get("displayName")))
-                sp_in_group = get_service_principal(str(group.get("displayName")))
-                group_id1 = sp_in_group["value"][0]["id"]
-                headers = {"Authorization": f"Bearer {token}", "content-type": "application/json"}
-                sp = requests.get(
-                    url=f"https://graph.microsoft.com/v1.0/groups/{group_id1}?$expand=members",
-                    headers=headers
-                )
-                group_members = sp.json()["members"]
-                logging.info("Now will look if this group has any Service Principals.")
-                if len(group_members) > 0:
-                    # if the group has members, then look for service principals.
-                    for sps in group_members:
-                        if "#microsoft.graph.servicePrincipal" in sps.values():
-                            logging.info(f"The EntraID Group {group['displayName']} has the following "
-                                         f"Service Principals.")
-                            logging.info("Service Principal Name: " + sps["displayName"])
-                            required_for_sp = {
-                                "account_id": databricks_account_number,
-                                "id": sps["id"],
-                                "displayName": sps["displayName"],
-                                "applicationId": sps["id"],
-                                "active": "true"
-                            }
-                            with open(sp_file_name, "a") as sp_file:
-                                sp_file.write(str(required_for_sp) + "\n")
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, encoding, has_types, count = struct.unpack_from("<4sBBI", data, 0)
+    if magic != snapshot_magic:
+        raise ValueError(f"{path} is not a membership snapshot")
+    ids, offset = decode_id_column(encoding, count, data, struct.calcsize("<4sBBI"))
+    types = [snapshot_type_names.get(code, "other") for code in data[offset:offset + count]] if has_types else None
+    return ids, types
 
-                        else:
-                            logging.info(f"The EntraID Entity {sps['displayName']} is not a Service principals.")
-                else:
-                    logging.info(f"The EntraID Group {group['displayName']} does not have any members.")
-            return "get_service_principal_details Function completed successfully."
 
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        raise
+def snapshot_run_suffix():
+    """
+        Returns the suffix of the run ids of this process: empty, or the shard of a sharded run.
+    """
+    return f"_shard_{shard_index}_of_{shard_count}" if shard_count > 1 else ""
 
 
-def create_databricks_group(group_name):
+def snapshot_run_dir(run_id=None):
     """
-        Creates a group in Databricks with a name matching the group in Azure Active Directory.
+        Returns the snapshot folder of a run, by default of this run.
+    """
+    with checkpoint_lock:
+        return os.path.join(snapshot_dir, run_id or checkpoint_state["run_id"])
 
-        This function attempts to create a group in Databricks with the same display name as the group in Azure Active Directory.
+
+def write_group_snapshot(group_id, records):
+    """
+        Writes the snapshot of the flattened membership of a group.
 
         Args:
-            group_name (str): The display name of the group to be created in Databricks.
+            group_id (str): The Azure group id.
+            records (list): The MemberRecords of the flattened membership.
 
         Returns:
-            bool: True if the Databricks group creation is successful, False otherwise.
-
-        Raises:
-            Exception: If an error occurs during the Databricks group creation process.
+            str: The digest of the snapshot, or None if snapshots are disabled.
     """
-    # This function will create a group in Databricks with the same name in Azure AD.
-    try:
-        databricks_group_creation = a.groups.create(display_name=group_name)
-        print(databricks_group_creation)
-        return True
-    except Exception as e:
-        print("Error: " + str(e))
-        return False
+    if not snapshots_enabled:
+        return None
+    digest = write_snapshot_file(os.path.join(snapshot_run_dir(), f"{group_id}.bin"),
+                                 [record.id for record in records], [record.type for record in records])
+    with snapshot_lock:
+        snapshot_manifest.setdefault(group_id, {"targets": {}}).update(members=len(records), digest=digest)
+    return digest
 
 
-def check_db_group_existence(indv_group_id):
+def write_target_snapshot(group_id, target, db_member_ids):
     """
-        Checks the existence of a group in Databricks using its unique identifier.
-
-        This function verifies the existence of a group in Databricks by querying the group using its unique identifier.
-        It logs information regarding the group existence or absence in Databricks.
+        Writes the Databricks member ids of a group verified on a target.
 
         Args:
-            indv_group_id (str): The unique identifier of the group in Databricks.
+            group_id (str): The Azure group id.
+            target (SyncTarget): The Databricks target.
+            db_member_ids (set): The Databricks ids of the group members.
 
         Returns:
-            bool: True if the group exists in Databricks, False otherwise.
-
-        Raises:
             None
     """
-    try:
-        db_group_existence = a.groups.get(id=indv_group_id)
-        logging.info(db_group_existence)
-        return True
-    except Exception as e:
-        logging.warning(f"The group {indv_group_id} does not exist in Databricks.")
-        logging.warning("Error message from Databricks.")
-        logging.warning(f"{e}")
-        return False
+    if snapshots_enabled:
+        write_snapshot_file(os.path.join(snapshot_run_dir(), f"{group_id}@{target.name}.bin"), list(db_member_ids))
 
 
-def filter_tmp_files_by_group_id(directory, group_id):
+def get_group_snapshot_diff(group_id):
     """
-        Filters files in a directory based on a specified group ID prefix and suffix conditions.
-
-        This function scans a specified directory for files and filters them based on the given 'group_id'.
-        It selects files with names starting with the provided 'group_id' and ending with either '_tmp_sp.txt'
-        or '_tmp_users.txt'. The filtered filenames are added to a list and returned.
+        Compares the snapshot of a group in this run with the snapshot of its last verified run.
 
         Args:
-            directory (str): The path of the directory containing files.
-            group_id (str): The group ID used to filter files by prefix.
+            group_id (str): The Azure group id.
 
         Returns:
-            list: A list of filenames matching the conditions of starting with 'group_id' and ending with
-                  either '_tmp_sp.txt' or '_tmp_users.txt'.
-
-        Raises:
-            None
+            dict: {"status": "new", "unchanged" or "changed", "added": set, "removed": set} with the Azure ids of
+                  the added and removed members, or {"status": "unknown"} if there is nothing to compare.
     """
-    matching_files = []
-
-    for filename in os.listdir(directory):
-        if filename.startswith(group_id) and (filename.endswith("_tmp_sp.txt") or filename.endswith("_tmp_users.txt")):
-            matching_files.append(filename)
-
-    return matching_files
+    with snapshot_lock:
+        if group_id in snapshot_diffs:
+            return snapshot_diffs[group_id]
+        with checkpoint_lock:
+            digest = checkpoint_state["groups"].get(group_id, {}).get("snapshot_digest")
+        previous = snapshot_latest.get(group_id)
+        if not snapshots_enabled or not digest:
+            diff = {"status": "unknown"}
+        elif not previous:
+            diff = {"status": "new", "added": set(), "removed": set()}
+        elif previous["digest"] == digest:
+            diff = {"status": "unchanged", "added": set(), "removed": set()}
+        else:
+            try:
+                previous_ids = set(read_snapshot_file(os.path.join(snapshot_dir, previous["run"],
+                                                                   f"{group_id}.bin"))[0])
+                current_ids = set(read_snapshot_file(os.path.join(snapshot_run_dir(), f"{group_id}.bin"))[0])
+                diff = {"status": "changed", "added": current_ids - previous_ids,
+                        "removed": previous_ids - current_ids}
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning(f"Could not compare the membership snapshots of group {group_id}: {e}")
+                diff = {"status": "unknown"}
+        snapshot_diffs[group_id] = diff
+        entry = snapshot_manifest.setdefault(group_id, {"targets": {}})
+        entry["status"] = diff["status"]
+        entry["added"] = sorted(diff.get("added", ()))
+        entry["removed"] = sorted(diff.get("removed", ()))
+        log_event(logging.INFO, "group_membership_diff", group_id=group_id, status=diff["status"],
+                  added=len(diff.get("added", ())), removed=len(diff.get("removed", ())))
+        return diff
+
+
+def get_apply_plan(group_id, target):
+    """
+        Decides how much of a group has to be applied to a target, based on the snapshot diff.
 
+        Args:
+            group_id (str): The Azure group id.
+            target (SyncTarget): The Databricks target.
 
-def create_db_account_group(db_group_name):
+        Returns:
+            tuple: ("skip", None) if the group is unchanged since it was last verified on the target,
+                   ("incremental", set of added Azure ids) if it changed, ("full", None) otherwise.
+    """
+    diff = get_group_snapshot_diff(group_id)
+    previous = snapshot_latest.get(group_id, {})
+    if not snapshot_diff_apply or target.name not in previous.get("verified_targets", []):
+        return "full", None
+    if diff["status"] == "unchanged":
+        return "skip", None
+    if diff["status"] == "changed":
+        return "incremental", diff["added"]
+    return "full", None
+
+
+def record_group_apply(group_id, target, plan, verified):
     """
-        Creates an account group in the associated environment.
+        Records in the manifest of this run how a group was applied to a target and whether it was verified.
+    """
+    with checkpoint_lock:
+        crawled = dict(checkpoint_state["groups"].get(group_id, {}))
+    with snapshot_lock:
+        entry = snapshot_manifest.setdefault(group_id, {"targets": {}})
+        # Groups crawled before an interrupted run was resumed only have their digest in the checkpoint.
+        entry.setdefault("digest", crawled.get("snapshot_digest"))
+        entry.setdefault("display_name", crawled.get("display_name"))
+        entry["targets"][target.name] = {"apply": plan, "verified": verified}
 
-        This function attempts to create an account group using the provided 'db_group_name'.
-        If successful, it returns the created group details; otherwise, it handles the scenario
-        where the group already exists or encounters an error during group creation.
 
-        Args:
-            db_group_name (str): The display name of the account group to be created.
+def start_snapshots():
+    """
+        Loads the index of the last verified snapshot of every group.
 
         Returns:
-            dict or str: If the group is successfully created, it returns the details of the created group.
-                        If the group already exists, it returns "Exists".
-                        In case of an error during group creation, it logs a warning and returns "Exists".
-
-        Raises:
             None
     """
+    global snapshot_latest
+    if not snapshots_enabled:
+        return
     try:
-        create_dba_group = a.groups.create(display_name=db_group_name)
-        return create_dba_group
-        # return "Created"
-    except Exception as e:
-        logging.warning(f"Error creating account group '{db_group_name}': {e}")
-        # Handle or log the specific error encountered during group creation
-        return "Exists"
+        with open(snapshot_latest_file, "r") as f:
+            snapshot_latest = json.load(f)
+    except FileNotFoundError:
+        snapshot_latest = {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {snapshot_latest_file}, all groups are applied in full: {e}")
+        snapshot_latest = {}
 
 
-def create_users_add_to_groups(user_file, create_db_grp, group_value_existing):
+def finish_snapshots():
     """
-        Processes user details from a file and adds users to an existing Databricks group.
-
-        This function reads user details from a file and either creates new users in Databricks
-        or adds existing users to the specified Databricks group. It checks if users already exist
-        in the Databricks account and, based on that, adds users to the provided Databricks group.
-
-        Args:
-            user_file (file): A file containing user details to be processed.
-            create_db_grp (Group): An object representing the Databricks group to which users will be added.
-            group_value_existing (list): A list of existing user/group details to update in Databricks.
+        Writes the manifest of this run, points the groups verified in this run to their new snapshot and deletes
+        the snapshots of old runs that are no longer referenced.
 
         Returns:
             None
+    """
+    if not snapshots_enabled or "run_id" not in checkpoint_state:
+        return
+    run_id = checkpoint_state["run_id"]
+    run_dir = snapshot_run_dir()
+    os.makedirs(run_dir, exist_ok=True)
+    with snapshot_lock:
+        with open(os.path.join(run_dir, "manifest.json"), "w") as f:
+            json.dump({"run": run_id, "groups": snapshot_manifest}, f, indent=1)
+        for group_id, entry in snapshot_manifest.items():
+            verified = sorted(name for name, result in entry.get("targets", {}).items() if result["verified"])
+            if not verified or not entry.get("digest"):
+                continue
+            previous = snapshot_latest.get(group_id, {})
+            if previous.get("digest") == entry["digest"]:
+                verified = sorted(set(verified) | set(previous.get("verified_targets", [])))
+            snapshot_latest[group_id] = {"run": run_id, "digest": entry["digest"], "verified_targets": verified}
+        tmp_file = f"{snapshot_latest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(snapshot_latest, f, indent=1)
+        os.replace(tmp_file, snapshot_latest_file)
+        referenced = {entry["run"] for entry in snapshot_latest.values()}
+    suffix = snapshot_run_suffix()
+    runs = sorted(name for name in os.listdir(snapshot_dir) if os.path.isdir(os.path.join(snapshot_dir, name)) and
+                  (name.endswith(suffix) if suffix else "_shard_" not in name))
+    for old_run in runs[:-snapshot_keep_runs] if snapshot_keep_runs > 0 else []:
+        if old_run not in referenced:
+            shutil.rmtree(os.path.join(snapshot_dir, old_run), ignore_errors=True)
+
+
+# Scheduling.
+# Groups are crawled and applied by priority (lower number first) and then by deadline, the time their last
+# successful sync becomes older than their max staleness. Per-group settings come from the optional
+# "group_settings" object of groups_to_sync.json, keyed by group id or group name. Once the run has used its time
+# budget, only groups with a priority up to 'budget_priority_cutoff' are still started; the others are carried over
+# to the next run, which schedules them first among groups of the same priority.
+schedule_default_priority = config.getint("schedule", "default_priority", fallback=100)
+schedule_default_max_staleness_minutes = config.getfloat("schedule", "default_max_staleness_minutes", fallback=1440)
+schedule_time_budget_minutes = config.getfloat("schedule", "time_budget_minutes", fallback=0)
+schedule_budget_priority_cutoff = config.getint("schedule", "budget_priority_cutoff", fallback=0)
+schedule_state_file = config.get("schedule", "state_file", fallback="checkpoints/schedule_state.json")
+schedule_state = {"last_synced": {}, "carried_over": []}
+schedule_priorities = {}  # group id -> priority of the groups scheduled in this run
+schedule_carried_over = set()
+schedule_lock = threading.Lock()
+run_budget_deadline = None
+
+ScheduledGroup = collections.namedtuple("ScheduledGroup", ["group_id", "name", "priority", "deadline",
+                                                           "carried_over", "member_filter"])
+
+
+def load_schedule_state():
+    """
+        Reads the last sync times and the carried over groups of the previous runs.
 
-        Raises:
+        Returns:
             None
     """
-    group_info = []
-
-    for line in user_file:
-        display_name = ast.literal_eval(line).get("displayName", "None")
-        user_name = ast.literal_eval(line).get("displayName", "None")
-        check_if_user_exists_in_dba = a.users.list(filter=f"displayName eq '{display_name}'")
-        check_if_user_exists_in_dba_list = list(check_if_user_exists_in_dba)
-
-        if len(check_if_user_exists_in_dba_list):
-            # user already exists in the Databricks Account. So user will not be created,
-            # but will add user to group. To add user we need to id of the user. so get that first.
-            logging.info(f"User {display_name} already exists in Databricks Account, so will add this user"
-                         f" to the group. Databricks user creation will be ignored.")
-            db_user_id = a.users.list(filter=f"displayName eq {display_name}")
-            db_user_id_list = [item for item in db_user_id]
-
-            # logging.info(db_user_id_list[0])
-            # logging.info(type(db_user_id_list[0]))
-            idd = [user.id for user in db_user_id_list]
-            # logging.info(idd)
-            # logging.info(type(idd))
-            required_db_user_id = idd[0]
-            # logging.info(required_db_user_id)
-
-            # time.sleep(5)
-            group_value_new = ComplexValue(display=display_name, value=required_db_user_id)
-            group_value_existing.append(group_value_new)
-            # logging.info(group_value_existing)
-            group_member_details = [
-                {"display": cv.display, "primary": cv.primary, "type": cv.type, "value": cv.value}
-                for cv in group_value_existing
-            ]
-            # # group_info.append(group_info1)
-            # line_counter += 1
-            group_value1 = [ComplexValue(**info) for info in group_member_details]
-            adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                         display_name=create_db_grp.display_name,
-                                                         members=group_value1)
-            logging.info(f"Existing Users {display_name} added to the Databricks Account Group.")
-        else:
-            logging.info(f"User {display_name} Does NOT exists in Databricks Account. This user will be created "
-                         "in Databricks Account and then be added to the group.")
-            db_a_user_creation = a.users.create(active=True, display_name=display_name, user_name=user_name)
-            group_value_new = ComplexValue(display=display_name, value=db_a_user_creation.id)
-            if group_value_existing:
-                group_value_existing.append(group_value_new)
-                group_member_details = [
-                    {"display": cv.display, "primary": cv.primary, "type": cv.type, "value": cv.value}
-                    for cv in group_value_existing
-                ]
-
-                group_value1 = [ComplexValue(**info) for info in group_member_details]
-
-                # line_counter += 1
-                adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                             display_name=create_db_grp.display_name,
-                                                             members=group_value1)
-            else:
-                adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                             display_name=create_db_grp.display_name,
-                                                             members=[group_value_new])
-
+    global schedule_state
+    try:
+        with open(schedule_state_file, "r") as f:
+            schedule_state = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read schedule state file {schedule_state_file}, starting without it: {e}")
+    schedule_state.setdefault("last_synced", {})
+    schedule_state.setdefault("carried_over", [])
 
-        logging.info(f"useer {display_name} was created and added to group.")
 
+def save_schedule_state():
+    """
+        Writes the schedule state atomically.
 
-def create_sps_add_to_groups(sps_file, create_db_grp, group_value_existing):
+        Returns:
+            None
     """
-        Processes Service Principal details from a file and adds Service Principals to an existing Databricks group.
+    directory = os.path.dirname(schedule_state_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{schedule_state_file}.tmp"
+    with schedule_lock:
+        with open(tmp_file, "w") as f:
+            json.dump(schedule_state, f, indent=2)
+        os.replace(tmp_file, schedule_state_file)
 
-        This function reads SP details from a file and either creates new SP in Databricks
-        or adds existing SP to the specified Databricks group. It checks if SP already exist
-        in the Databricks account and, based on that, adds SP to the provided Databricks group.
 
-        Args:
-            sps_file (file): A file containing SP details to be processed.
-            create_db_grp (Group): An object representing the Databricks group to which users will be added.
-            group_value_existing (list): A list of existing SP/group details to update in Databricks.
+def start_run_budget():
+    """
+        Loads the schedule state and starts the clock of the [schedule] time_budget_minutes of this run.
 
         Returns:
             None
-
-        Raises:
-            None
     """
-    # logging.info(create_db_grp)
-    # logging.info(group_value_existing)
-    group_info = []
+    global run_budget_deadline
+    load_schedule_state()
+    if schedule_time_budget_minutes > 0:
+        run_budget_deadline = time.time() + schedule_time_budget_minutes * 60
 
-    for line in sps_file:
-        display_name = ast.literal_eval(line).get("displayName", "None")
-        user_name = ast.literal_eval(line).get("displayName", "None")
-        application_id = ast.literal_eval(line).get("applicationId", "None")
 
-        check_if_sps_exists_in_dba = a.service_principals.list(filter=f"displayName eq '{display_name}'")
-        check_if_sps_exists_in_dba_list = list(check_if_sps_exists_in_dba)
+def run_budget_exhausted():
+    """
+        Tells whether the time budget of the run is used up.
+    """
+    return run_budget_deadline is not None and time.time() >= run_budget_deadline
+
 
-        # logging.info(check_if_sps_exists_in_dba_list)
+def schedule_groups(entries, group_settings=None):
+    """
+        Orders the groups of a run by priority, carry-over and deadline.
 
+        Args:
+            entries (list): (group id, group name or None) tuples in configuration order.
+            group_settings (dict): Group id or name -> {"priority": int, "max_staleness_minutes": float,
+                                   "member_filter": dict}. Optional.
 
-        if len(check_if_sps_exists_in_dba_list):
-            # SP already exists in the Databricks Account. So SP will not be created,
-            # but will add SP to group. To add user we need to id of the SP. so get that first.
-            logging.info(f"Service Principal {display_name} already exists in Databricks Account, so will add this SP"
-                         f" to the group. Databricks Service Principal creation will be ignored.")
-            db_sps_id = a.service_principals.list(filter=f"displayName eq {display_name}")
-
-            # logging.info(db_sps_id)
-
-            db_sps_id_list = [item for item in db_sps_id]
-
-            # logging.info(db_sps_id_list[0])
-            # logging.info(type(db_sps_id_list[0]))
-            idd = [user.id for user in db_sps_id_list]
-            # logging.info(idd)
-            # logging.info(type(idd))
-            required_db_sps_id = idd[0]
-            # logging.info(required_db_sps_id)
-
-            # time.sleep(5)
-            group_value_new = ComplexValue(display=display_name, value=required_db_sps_id)
-
-            group_value_existing.append(group_value_new)
-
-            # logging.info(group_value_existing)
-            group_member_details = [
-                {"display": cv.display, "primary": cv.primary, "type": cv.type, "value": cv.value}
-                for cv in group_value_existing
-            ]
-            group_value1 = [ComplexValue(**info) for info in group_member_details]
-            adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                         display_name=create_db_grp.display_name,
-                                                         members=group_value1)
-            logging.info(f"Existing Users {display_name} added to the Databricks Account Group.")
+        Returns:
+            list: ScheduledGroup tuples in the order they should be crawled and applied.
+    """
+    group_settings = group_settings or {}
+    carried_over = set(schedule_state["carried_over"])
+    scheduled = []
+    for group_id, name in entries:
+        settings = group_settings.get(group_id) or group_settings.get(name) or {}
+        priority = int(settings.get("priority", schedule_default_priority))
+        max_staleness = float(settings.get("max_staleness_minutes", schedule_default_max_staleness_minutes))
+        last_synced = schedule_state["last_synced"].get(group_id)
+        if last_synced:
+            deadline = datetime.datetime.fromisoformat(last_synced).timestamp() + max_staleness * 60
         else:
-            logging.info(f"Service Principal {display_name} Does NOT exists in Databricks Account. "
-                         f"This Service Principal will be created in Databricks Account and then added to the group.")
-
-            db_a_sps_creation = a.service_principals.create(active=True, display_name=display_name, application_id=application_id)
-
-            # logging.info(db_a_sps_creation)
-
-            group_value_new = ComplexValue(display=display_name, value=db_a_sps_creation.id)
-            if group_value_existing:
-                group_value_existing.append(group_value_new)
-                group_member_details = [
-                    {"display": cv.display, "primary": cv.primary, "type": cv.type, "value": cv.value}
-                    for cv in group_value_existing
-                ]
-                group_value1 = [ComplexValue(**info) for info in group_member_details]
-                adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                             display_name=create_db_grp.display_name,
-                                                             members=group_value1)
-            else:
-                adding_db_user_to_db_group = a.groups.update(id=create_db_grp.id,
-                                                             display_name=create_db_grp.display_name,
-                                                             members=[group_value_new])
+            deadline = 0.0
+        scheduled.append(ScheduledGroup(group_id, name, priority, deadline, group_id in carried_over,
+                                        parse_member_filter(settings.get("member_filter"))))
+    # sorted() is stable, so groups with the same priority and deadline keep their configuration order.
+    scheduled.sort(key=lambda group: (group.priority, not group.carried_over, group.deadline))
+    with schedule_lock:
+        schedule_priorities.update((group.group_id, group.priority) for group in scheduled)
+    log_event(logging.INFO, "groups_scheduled", groups=len(scheduled),
+              overdue=sum(1 for group in scheduled if group.deadline <= time.time()),
+              carried_over=sum(1 for group in scheduled if group.carried_over),
+              time_budget_minutes=schedule_time_budget_minutes)
+    return scheduled
+
+
+def may_start_group(group_id):
+    """
+        Tells whether work on a group may still be started. Groups that may not are carried over to the next run.
 
-        logging.info(f"SERVICE PRINCIPAL {display_name} was created and added to group.")
+        Args:
+            group_id (str): The Azure group id.
 
+        Returns:
+            bool: False once the time budget is exhausted, for groups with a priority above the cutoff.
+    """
+    priority = schedule_priorities.get(group_id, schedule_default_priority)
+    if not run_budget_exhausted() or priority <= schedule_budget_priority_cutoff:
+        return True
+    with schedule_lock:
+        if group_id not in schedule_carried_over:
+            schedule_carried_over.add(group_id)
+            log_event(logging.INFO, "group_carried_over", group_id=group_id, priority=priority)
+    return False
 
 
-def create_db_users_add_to_group(db_user_file_name, db_group_name):
+def finish_schedule(group_ids):
     """
-        Creates Databricks account users and adds them to a specified group.
-
-        This function reads user details from a file ('db_user_file_name') and creates users in the Databricks account.
-        It then adds these users to the specified Databricks group ('db_group_name').
-        If the group already exists, it retrieves the group's members and updates the group membership with new users.
+        Records the sync time of the groups verified on all targets and the groups carried over to the next run.
 
         Args:
-            db_user_file_name (str): The file path containing user details to be processed.
-            db_group_name (str): The name of the Databricks group to which users will be added.
+            group_ids (list): The Azure group ids scheduled in this run.
 
         Returns:
-            None
-
-        Raises:
-            None
+            bool: True if groups were carried over.
     """
-    # create databricks account users.
-    # read the input user file and loop through the file line by line and create each user.
-    with open(db_user_file_name, "r") as user_file:
-        logging.info("contents of the user file:")
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with checkpoint_lock:
+        verified = [group_id for group_id in group_ids
+                    if group_verified_on_all_targets(group_id, checkpoint_state["groups"])]
+    with schedule_lock:
+        for group_id in verified:
+            schedule_state["last_synced"][group_id] = now
+        schedule_state["carried_over"] = sorted(schedule_carried_over - set(verified))
+    save_schedule_state()
+    log_event(logging.INFO, "schedule_summary", groups=len(group_ids), synced=len(verified),
+              carried_over=len(schedule_state["carried_over"]), budget_exhausted=run_budget_exhausted())
+    return bool(schedule_state["carried_over"])
+
+
+# Bulk user onboarding.
+# Users from groups_to_sync.json or from a CSV/JSONL file (--bulk-users) are streamed in batches: every batch is
+# validated against Graph with one 'in' filter request, checked against an index of all Databricks users that is
+# loaded once per target, and the missing users are created by a pool of workers at a limited rate. Every user gets
+# a line in a JSONL result file ('created', 'exists', 'invalid', 'duplicate' or 'failed'); invalid users do not stop
+# the run.
+bulk_users_batch_size = min(config.getint("bulk_users", "batch_size", fallback=graph_filter_in_batch_size),
+                            graph_filter_in_batch_size)
+bulk_users_workers = config.getint("bulk_users", "workers", fallback=8)
+bulk_users_creates_per_second = config.getfloat("bulk_users", "creates_per_second", fallback=5)
+bulk_users_result_dir = config.get("bulk_users", "result_dir", fallback="reports")
+bulk_user_attributes = ("userPrincipalName", "displayName", "user")
+
+
+class RateLimiter:
+    """
+        Spaces out calls, across threads, to at most 'rate' per second. A rate of 0 or less means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
 
-        line_counter = 0
-        create_db_grp = create_db_account_group(db_group_name)
+    def wait(self):
+        """
+            Blocks until the caller may make its call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
-        if create_db_grp != "Exists":
-            a1 = create_users_add_to_groups(user_file, create_db_grp,[])
-            logging.info(a1)
 
-        elif create_db_grp == "Exists":
-            logging.warning("Group Already Exists in Databricks Account. So user will be added to this group.")
-            # now get the group id and pass it to the below function.
-            # for existing groups, we may need to check if there are existing members. if there are existing
-            # members then we need to pull them as and re-apply them to the group along with the new members.
-            create_db_grp = a.groups.list(filter=f"displayName eq {db_group_name}")
-            create_db_grp_list = [item for item in create_db_grp]
-            # logging.info(create_db_grp)
-            group_members = [m.members for m in create_db_grp_list]
-            # logging.info(group_members[0])
-            a2 = create_users_add_to_groups(user_file, create_db_grp_list[0], group_members[0])
-            logging.info(a2)
+def read_bulk_users(file_name):
+    """
+        Streams the users of a bulk onboarding file.
 
+        Args:
+            file_name (str): A CSV file with a header row, or a JSONL file ('.jsonl'/'.json') with one object per
+                             line. Each user needs a 'userPrincipalName', 'displayName' or 'user' column/key.
 
-def create_db_sps_add_to_group(db_sps_file_name, db_group_name):
+        Yields:
+            dict: One row per user.
     """
-        Creates Databricks account users and adds them to a specified group.
+    with open(file_name, "r", newline="") as users_file:
+        if file_name.lower().endswith((".jsonl", ".json")):
+            for line in users_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(users_file)
 
-        This function reads user details from a file ('db_user_file_name') and creates users in the Databricks account.
-        It then adds these users to the specified Databricks group ('db_group_name').
-        If the group already exists, it retrieves the group's members and updates the group membership with new users.
+
+def bulk_user_query(row):
+    """
+        Returns the Graph attribute and value a bulk user row is identified by.
 
         Args:
-            db_sps_file_name (str): The file path containing user details to be processed.
-            db_group_name (str): The name of the Databricks group to which users will be added.
+            row (dict): A user row.
 
         Returns:
-            None
-
-        Raises:
-            None
+            tuple: ('userPrincipalName' or 'displayName', value), value being None for rows without a user.
     """
-    # create databricks account service principals.
-    # read the input Service Principal file and loop through the file line by line and create each SP in Databricks.
-    with open(db_sps_file_name, "r") as sp_file:
-        logging.info("contents of the user file:")
+    for attribute in bulk_user_attributes:
+        value = (row.get(attribute) or "").strip()
+        if value:
+            return ("displayName" if attribute == "user" else attribute), value
+    return "displayName", None
 
-        create_db_grp = create_db_account_group(db_group_name)
 
-        if create_db_grp != "Exists":
-            a1 = create_sps_add_to_groups(sp_file, create_db_grp,[])
-            logging.info(a1)
+def validate_azure_users(rows, token):
+    """
+        Looks up a batch of users in Azure EntraID with one request per identifying attribute.
 
-        elif create_db_grp == "Exists":
-            logging.warning("Group Already Exists in Databricks Account. So SP will be added to this group.")
-            # now get the group id and pass it to the below function.
-            # for existing groups, we may need to check if there are existing members. if there are existing
-            # members then we need to pull them as and re-apply them to the group along with the new members.
-            create_db_grp = a.groups.list(filter=f"displayName eq {db_group_name}")
-            create_db_grp_list = [item for item in create_db_grp]
-            # logging.info(create_db_grp)
-            group_members = [m.members for m in create_db_grp_list]
-            # logging.info(group_members[0])
-            # logging.info(type(create_db_grp))
-            a2 = create_sps_add_to_groups(sp_file, create_db_grp_list[0], group_members[0])
-            logging.info(a2)
+        Args:
+            rows (list): User rows, at most 'graph_filter_in_batch_size' of them.
+            token (str): Access token for the Microsoft Graph API.
 
+        Returns:
+            dict: (attribute, lower-cased value) -> Graph user object, for the users that exist.
+    """
+    values_by_attribute = collections.defaultdict(list)
+    for row in rows:
+        attribute, value = bulk_user_query(row)
+        if value:
+            values_by_attribute[attribute].append(value)
+    found = {}
+    for attribute, values in values_by_attribute.items():
+        quoted = ",".join("'{}'".format(value.replace("'", "''")) for value in values)
+        for user in graph_get_all("users", "/users", params={"$filter": f"{attribute} in ({quoted})"}, token=token):
+            if user.get(attribute):
+                found[(attribute, user[attribute].lower())] = user
+    return found
+
+
+def onboard_user(target, user, display_name, user_name, limiter):
+    """
+        Creates one Azure user in one Databricks target unless it exists there already.
 
+        Args:
+            target (SyncTarget): The Databricks target.
+            user (str): The user as given in the input.
+            display_name (str): The display name of the user in Azure EntraID.
+            user_name (str): The userPrincipalName of the user in Azure EntraID, used as Databricks user name.
+            limiter (RateLimiter): Limits the rate of user creations.
 
-def process_files(matching_files, db_group_name):
+        Returns:
+            dict: The result line of the user on the target.
     """
-        Processes files based on their types (user or service principal) and performs corresponding actions.
+    target_context.target = target
+    result = {"user": user, "displayName": display_name, "userName": user_name, "target": target.name}
+    try:
+        preload_db_principals("users")
+        existing_id = find_db_principal_id("users", user_name)
+        if existing_id:
+            return {**result, "status": "exists", "id": existing_id}
+        limiter.wait()
+        created = create_db_principal_exclusively(
+            "users", user_name,
+            lambda: db_client().users.create(active=True, display_name=display_name, user_name=user_name))
+        return {**result, "status": "created", "id": created.id}
+    except Exception as e:
+        return {**result, "status": "failed", "reason": str(e)}
+    finally:
+        target_context.target = None
 
-        This function analyzes the provided list of file names ('matching_files') to identify the presence of files
-        related to users ('_tmp_users.txt') and service principals ('_tmp_sp.txt'). Based on the identified files,
-        it initiates the creation of users and/or service principals in the Databricks account.
+
+def onboard_users(rows, token, result_file=None):
+    """
+        Creates the Azure users of a stream of rows in all Databricks targets.
 
         Args:
-            matching_files (list): A list of file names to be processed.
-            db_group_name (str): The name of the Databricks group where users/service principals will be added.
+            rows (iterable): User rows, see read_bulk_users().
+            token (str): Access token for the Microsoft Graph API.
+            result_file (str): The JSONL result file. Defaults to a new file in [bulk_users] result_dir.
 
         Returns:
-            None
+            dict: The number of result lines per status.
+    """
+    if result_file is None:
+        os.makedirs(bulk_users_result_dir, exist_ok=True)
+        shard_suffix = f"_shard_{shard_index}_of_{shard_count}" if shard_count > 1 else ""
+        result_file = os.path.join(bulk_users_result_dir,
+                                   f"bulk_users_{datetime.datetime.now():%Y-%m-%d_%H-%M-%S}{shard_suffix}.jsonl")
+    started = time.perf_counter()
+    counts = collections.Counter()
+    limiter = RateLimiter(bulk_users_creates_per_second)
+    seen = set()
+    rows = iter(rows)
+    with open(result_file, "w") as results, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=bulk_users_workers) as pool:
+
+        def write_result(result):
+            counts[result["status"]] += 1
+            results.write(json.dumps(result) + "\n")
+            if result["status"] in ("invalid", "failed"):
+                logging.error(f"User {result['user']} was not onboarded: {result.get('reason')}")
+
+        while True:
+            batch = list(itertools.islice(rows, bulk_users_batch_size))
+            if not batch:
+                break
+            found = validate_azure_users(batch, token)
+            futures = []
+            for row in batch:
+                attribute, value = bulk_user_query(row)
+                key = (attribute, (value or "").lower())
+                if key in seen:
+                    write_result({"user": value, "status": "duplicate"})
+                    continue
+                seen.add(key)
+                azure_user = found.get(key)
+                if not azure_user:
+                    write_result({"user": value, "status": "invalid", "reason": "not found in Azure EntraID"})
+                    continue
+                for target in sync_targets:
+                    futures.append(pool.submit(onboard_user, target, value, azure_user["displayName"],
+                                               azure_user_name(azure_user), limiter))
+            for future in futures:
+                write_result(future.result())
+
+    log_event(logging.INFO, "bulk_users_summary", result_file=result_file,
+              elapsed_s=round(time.perf_counter() - started, 3), **counts)
+    return dict(counts)
+
+
+def crawl_group(group_id, token, member_filter=None):
+    """
+        Reads the flattened membership of an Azure group and writes its temp files.
 
-        Raises:
-            None
+        Groups that were already staged by an interrupted run are skipped. A group whose crawl was interrupted is
+        crawled again from scratch.
+
+        Args:
+            group_id (str): The Azure group id.
+            token (str): Access token for the Microsoft Graph API.
+            member_filter (MemberFilter): Only crawl the members of these types that match its filters. Optional.
+
+        Returns:
+            bool: False if writing the temp files failed and the run should stop crawling, True otherwise.
     """
+    if checkpoint_phase_reached(group_id, "staged"):
+        log_event(logging.INFO, "group_crawl_skipped", group_id=group_id, reason="already staged")
+        return True
 
+    logging.info("####################################################################################")
+    logging.info(f"Now working on GROUP ID: {group_id}")
+    logging.info("The following 3 files will be created for this group id")
+    logging.info(f"Groups File name: {tmp_files_folder}/{group_id}_tmp_groups.txt")
+    logging.info(f"User File name: {tmp_files_folder}/{group_id}_tmp_users.txt")
+    logging.info(f"Service Principal File name: {tmp_files_folder}/{group_id}_tmp_sp.txt")
+    logging.info("####################################################################################")
+    remove_group_tmp_files(group_id)
+
+    ################################################
+    # Get transitive group members based on GroupID#
+    ################################################
     try:
-        has_users = any("_tmp_users.txt" in file for file in matching_files)
-        has_sp = any("_tmp_sp.txt" in file for file in matching_files)
-
-        if has_users and has_sp:
-            logging.info("Now creating both Users and Service Principals.")
-            # create_db_users() get only user files
-            users_files = [file for file in matching_files if file.endswith("_tmp_users.txt")]
-            user_grp_status = create_db_users_add_to_group("groups_users_sps/"+users_files[0], db_group_name)
-            logging.info(user_grp_status)
-            # create_db_sp()
-            sp_files = [file for file in matching_files if file.endswith("_tmp_sp.txt")]
-            sps_grp_status = create_db_sps_add_to_group("groups_users_sps/" + sp_files[0], db_group_name)
-            logging.info(sps_grp_status)
-        elif has_users:
-            logging.info("Now creating only users.")
-            # create_db_users()
-            users_files = [file for file in matching_files if file.endswith("_tmp_users.txt")]
-            user_grp_status = create_db_users_add_to_group("groups_users_sps/"+users_files[0], db_group_name)
-            logging.info(user_grp_status)
-        elif has_sp:
-            logging.info("Now creating only sp.")
-            # create_db_sp()
-            sp_files = [file for file in matching_files if file.endswith("_tmp_sp.txt")]
-            sps_grp_status = create_db_sps_add_to_group("groups_users_sps/" + sp_files[0], db_group_name)
-            logging.info(sps_grp_status)
+        if member_filter:
+            transitive_members = get_filtered_members_for_group(group_id, member_filter)
         else:
-            # Handle scenario when neither file is present
-            logging.error("Something other than Users, Service Principals found. Check the groups_users_sps folder "
-                          "for the types of files created.")
-            exit(99)
-
+            transitive_members = get_flattened_members_for_group(group_id)
+        logging.info("Transitive members identified.")
+        logging.info("Transitive members can be AD groups or Users or Service Principals.")
+        groups_users = transitive_members["value"]
+        logging.debug("Transitive members: %s", groups_users)
+        log_event(logging.INFO, "group_crawled", group_id=group_id, transitive_members=len(groups_users))
+        snapshot_digest = write_group_snapshot(group_id, groups_users)
+
+        #####################################################
+        # Append the original group name to the groups file #
+        #####################################################
+        orig_group_details = get_original_group_details(group_id, token)
+        logging.debug("orig_group_details: %s", orig_group_details)
+        update_checkpoint(group_id, "crawled", display_name=orig_group_details["displayName"])
+
+        #################
+        # Group details #
+        #################
+        try:
+            all_group = get_all_group_details(groups_users, orig_group_details,
+                                              f"{tmp_files_folder}/{group_id}_tmp_groups.txt")
+            logging.debug("Groups: %s", all_group)
+        except Exception as e:
+            logging.error(f"get_all_group_details Function encountered an error: {e}")
+            return False
+
+        ################
+        # User details #
+        ################
+        try:
+            all_user = get_all_user_details(groups_users, f"{tmp_files_folder}/{group_id}_tmp_users.txt")
+            logging.debug("all_user: %s", all_user)
+        except Exception as e:
+            logging.error(f"get_all_user_details Function encountered an error: {e}")
+            return False
+
+        ######################
+        # Service Principals #
+        ######################
+        try:
+            service_principals_details = write_service_principal_records(
+                groups_users, f"{tmp_files_folder}/{group_id}_tmp_sp.txt", token)
+            logging.debug("service_principals_details: %s", service_principals_details)
+        except Exception as e:
+            logging.error(f"write_service_principal_records Function encountered an error: {e}")
+            return False
+
+        # The digest is only recorded with complete temp files: a group whose staging failed must not count as
+        # unchanged in the next run.
+        update_checkpoint(group_id, "staged", snapshot_digest=snapshot_digest)
+
+    except AzureAPIError as e:
+        logging.error(f"Function encountered an error: {e}")
     except Exception as e:
-        logging.error(f"Error processing files: {e}")
+        logging.error(f"Unhandled error occurred: {e}")
+    return True
 
 
-def clean_up_files(directory_path: object) -> object:
+def apply_group(indv_group_id, token):
     """
-        Cleans up temporary files within the specified directory.
+        Creates the members of a staged group in the Databricks Account and adds them to the Databricks group.
 
-        This function deletes temporary files found within the provided directory path. It iterates through the files
-        in the directory and removes them one by one. If no temporary files are present, it logs a message indicating
-        their absence.
+        Groups that were already verified by an interrupted run are skipped. A group whose apply was interrupted
+        continues after the last checkpointed member. A group whose membership snapshot did not change since it was
+        last verified on the target is not applied again, a changed group only with its added members. After the
+        apply, the group members are read back and missing members are re-added, and the group is only marked as
+        verified once all intended members are present. With [deprovisioning] enabled, stale members are removed
+        afterwards (see deprovision_group()).
 
         Args:
-            directory_path (str): The path to the directory containing temporary files.
+            indv_group_id (str): The Azure group id.
+            token (str): Access token for the Microsoft Graph API.
 
         Returns:
-            None
-
-        Raises:
-            None
+            bool: True if the group is verified on the active Databricks target.
     """
-    tmp_files_folder_name = directory_path
-    if os.listdir(tmp_files_folder_name):
-        logging.info("Now attempting to delete all temp files.")
-        for filename in os.listdir(tmp_files_folder_name):
-            file_path = os.path.join(tmp_files_folder_name, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)  # Delete the file
-                    logging.info(f"Deleted: {file_path}")
-            except Exception as e:
-                logging.error(f"Error deleting {file_path}: {e}")
+    checkpoint_key = apply_checkpoint_key(indv_group_id)
+    if checkpoint_phase_reached(checkpoint_key, "verified"):
+        log_event(logging.INFO, "group_apply_skipped", group_id=indv_group_id, target=active_target().name,
+                  reason="already verified")
+        record_group_apply(indv_group_id, active_target(), "resumed", True)
+        return True
+    plan, added_member_ids = get_apply_plan(indv_group_id, active_target())
+    if plan == "skip":
+        # Same membership as when the group was last verified on this target: nothing to send to Databricks.
+        log_event(logging.INFO, "group_unchanged", group_id=indv_group_id, target=active_target().name)
+        if deprovisioning_enabled:
+            # Members may still have been added by hand in Databricks, so the stale members are checked anyway.
+            group_name = get_original_group_details(indv_group_id, token)["displayName"]
+            deprovision_group(indv_group_id, resolve_db_account_group(indv_group_id, group_name))
+        update_checkpoint(checkpoint_key, "verified")
+        record_group_apply(indv_group_id, active_target(), plan, True)
+        return True
+    if checkpoint_phase_reached(checkpoint_key, "memberships_applied"):
+        # Applied but not verified: apply again from the start, so the intended member ids are known again.
+        set_checkpoint_cursor(checkpoint_key, "users", 0)
+        set_checkpoint_cursor(checkpoint_key, "service_principals", 0)
+
+    db_group_to_be_created = get_original_group_details(indv_group_id, token)
+    logging.debug("db_group_to_be_created: %s", db_group_to_be_created)
+
+    # now read the tmp files and see if we have to add both users and SP or just one of them.
+    filtered_files = filter_tmp_files_by_group_id(tmp_files_folder, indv_group_id)
+    logging.info(f"The following list of files will be scanned and the members in those "
+                 f"files will be created in Databricks Account.")
+    logging.debug("filtered_files: %s", filtered_files)
+
+    # The filtered_files list will have both the users and SPs or just one of them.
+    # Based on the files, we will call the process_files functions to call the creation of
+    # user or service principal or call both the functions to create both users and service principals..
+    if len(filtered_files) > 0:
+        # Resolve (or create) the Databricks group once. The same handle is used for the users and the SPs.
+        db_group = resolve_db_account_group(indv_group_id, db_group_to_be_created['displayName'])
+        update_checkpoint(checkpoint_key, "principals_resolved", databricks_group_id=db_group.id)
+        # Changed groups only get their added members, see get_apply_plan().
+        applied = process_files(filtered_files, db_group, checkpoint_key, added_member_ids)
+        if applied is not None:
+            update_checkpoint(checkpoint_key, "memberships_applied")
+            if verify_group_membership(applied["group"], applied["member_ids"], indv_group_id)["converged"]:
+                if deprovisioning_enabled:
+                    deprovision_group(indv_group_id, applied["group"])
+                update_checkpoint(checkpoint_key, "verified")
+                record_group_apply(indv_group_id, active_target(), plan, True)
+                return True
+        record_group_apply(indv_group_id, active_target(), plan, False)
+        return False
     else:
-        logging.info("There are no tmp files to delete.")
+        logging.info(f"This group does not have any members inside, so no action will be taken.")
+        if deprovisioning_enabled:
+            # No group is created for an empty Azure group, but an existing one loses its stale members.
+            index = db_group_index(active_target())
+            db_group = (index.get(("externalId", indv_group_id)) or
+                        index.get(("displayName", db_group_to_be_created["displayName"])))
+            if db_group:
+                deprovision_group(indv_group_id, db_group)
+        update_checkpoint(checkpoint_key, "verified")
+        record_group_apply(indv_group_id, active_target(), plan, True)
+        return True
 
 
-def get_group_id_from_name(azure_group_name, tokens):
+def apply_to_target(target, group_ids, token):
     """
-        Retrieves the Azure Active Directory (AAD) group ID based on the group name.
+        Applies the staged groups to one Databricks target.
 
-        This function queries the Microsoft Graph API to find a group's ID by its display name. It uses the provided
-        authentication tokens to authorize the request. If the group exists, it returns the group ID; otherwise, it
-        returns False.
+        Runs in its own thread per target. Errors of one group are logged and do not stop the other groups or
+        the other targets.
 
         Args:
-            azure_group_name (str): The display name of the Azure Active Directory group.
-            tokens (str): The authentication token required for accessing the Microsoft Graph API.
+            target (SyncTarget): The Databricks target.
+            group_ids (iterable): The Azure group ids of the staged groups. In pipelined runs this iterates the
+                                  apply queue of the target until the crawl is finished.
+            token (str): Access token for the Microsoft Graph API.
 
         Returns:
-            Union[str, bool]: Returns the group ID as a string if found, or False if the group doesn't exist.
-
-        Raises:
-            AzureAPIError: If an error occurs while querying the Microsoft Graph API or processing the response,
-                an AzureAPIError is raised to handle exceptional cases.
+            dict: The number of groups that were verified, not verified, failed and carried over on the target.
     """
+    target_context.target = target
+    started = time.perf_counter()
+    results = {"verified": 0, "not_verified": 0, "failed": 0, "carried_over": 0}
+    applied_groups = 0
     try:
-        headers = {"Authorization": f"Bearer {tokens}", "content-type": "application/json"}
+        for group_id in group_ids:
+            if not may_start_group(group_id):
+                results["carried_over"] += 1
+                continue
+            applied_groups += 1
+            try:
+                results["verified" if apply_group(group_id, token) else "not_verified"] += 1
+            except Exception as e:
+                results["failed"] += 1
+                logging.error(f"Applying group {group_id} to Databricks target {target.name} failed: {e}")
+    finally:
+        target_context.target = None
+    log_event(logging.INFO, "target_summary", target=target.name, account_id=target.account_id,
+              groups=applied_groups, elapsed_s=round(time.perf_counter() - started, 3), **results)
+    return results
 
-        # Call MS Graph API to get the group details. This is needed because sometimes the top-level group
-        # may have some SP that needs to be added to the groups file.
-        response = requests.get(
-            url=f"https://graph.microsoft.com/v1.0/groups?$filter=startswith(displayName,'{azure_group_name}')",
-            headers=headers
-        )
-        if response.status_code == 200:
-            orig_group_details = response.json()
-            # return {"displayName": orig_group_details["displayName"]}
-            if len(orig_group_details['value']) > 0:
-                group_id = orig_group_details['value'][0]['id']
-                # print(group_id)
-
-                return group_id
-            else:
-                return False
-        else:
-            raise AzureAPIError(f"Error: {response.status_code} - {response.text}")
 
-    except Exception as e:
-        raise AzureAPIError(f"An error occurred: {str(e)}")
+# Pipelined crawl and apply.
+# With [pipeline] enabled, every group is handed to the apply threads (one per Databricks target) as soon as its
+# crawl has staged it, so Graph crawling and Databricks writes overlap. The queue of every target holds at most
+# 'queue_size' groups: when a target falls behind, the crawl waits instead of running far ahead of it.
+pipeline_enabled = config.getboolean("pipeline", "enabled", fallback=True)
+pipeline_queue_size = config.getint("pipeline", "queue_size", fallback=4)
+
+
+class ApplyPipeline:
+    """
+        Hands staged groups to the Databricks targets, either right away (pipelined) or all at once at the end.
+    """
+
+    def __init__(self, targets, token, pipelined=True):
+        """
+            Args:
+                targets (list): The SyncTarget objects to apply to.
+                token (str): Access token for the Microsoft Graph API.
+                pipelined (bool): Start applying while the crawl is still running.
+        """
+        self.targets = targets
+        self.token = token
+        self.pipelined = pipelined
+        self.submitted = []
+        self.submitted_ids = set()
+        self.queues = {}
+        self.pool = None
+        self.futures = []
+        if pipelined:
+            self.queues = {target.name: queue.Queue(maxsize=pipeline_queue_size) for target in targets}
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(targets))
+            self.futures = [self.pool.submit(apply_to_target, target, iter(self.queues[target.name].get, None), token)
+                            for target in targets]
+
+    def submit(self, group_id):
+        """
+            Queues a staged group for all targets. Blocks while the queue of a target is full.
+
+            Args:
+                group_id (str): The Azure group id.
+
+            Returns:
+                None
+        """
+        if group_id in self.submitted_ids:
+            return
+        self.submitted_ids.add(group_id)
+        self.submitted.append(group_id)
+        for target in self.targets if self.pipelined else []:
+            waited = time.perf_counter()
+            self.queues[target.name].put(group_id)
+            waited = time.perf_counter() - waited
+            if waited > 1:
+                logging.debug("Crawl waited %.1fs for the apply queue of Databricks target %s.", waited, target.name)
+
+    def close(self):
+        """
+            Tells the targets that the crawl is finished and waits until all submitted groups are applied.
+
+            Returns:
+                list: The result dict of apply_to_target() for every target, in the order of the targets.
+        """
+        if not self.pipelined:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.targets)) as target_pool:
+                return list(target_pool.map(lambda target: apply_to_target(target, self.submitted, self.token),
+                                            self.targets))
+        for target in self.targets:
+            self.queues[target.name].put(None)
+        results = [future.result() for future in self.futures]
+        self.pool.shutdown()
+        return results
 
 
 if __name__ == "__main__":
 
-    # Clean up all tmp files
+    parser = argparse.ArgumentParser(description="Sync nested Azure EntraID groups to flat Databricks Account groups.")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Ignore the checkpoints of an interrupted run and start from scratch.")
+    parser.add_argument("--full-apply", action="store_true",
+                        help="Apply all members of every group, even if its membership snapshot did not change.")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Only sync the groups and users of shard i of N (0 <= i < N).")
+    parser.add_argument("--processes", type=int, metavar="N",
+                        help="Run N worker processes on this node, one per shard, and merge their reports.")
+    parser.add_argument("--merge-reports", type=int, metavar="N",
+                        help="Merge the reports of the N shards of a multi-node run and exit.")
+    parser.add_argument("--bulk-users", metavar="FILE",
+                        help="Onboard the users of a CSV or JSONL file into the Databricks Account(s) and exit.")
+    parser.add_argument("--benchmark-members", type=int, metavar="N",
+                        help="Measure the memory per membership of the member representations for N synthetic "
+                             "memberships and exit.")
+    parser.add_argument("--record", metavar="CASSETTE",
+                        help="Run a sync, write its HTTP traffic sanitized to CASSETTE and exit.")
+    parser.add_argument("--replay", metavar="CASSETTE",
+                        help="Run a sync against the traffic recorded in CASSETTE, without network access, and exit.")
+    parser.add_argument("--perf-gate", metavar="CASSETTE",
+                        help="Replay CASSETTE and fail if the HTTP calls per group, bytes or wall time exceed the "
+                             "baseline.")
+    parser.add_argument("--baseline", metavar="FILE", default=perf_gate_baseline_file,
+                        help="Baseline file of --perf-gate (default: the [perf_gate] baseline_file of cred.ini).")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the result of --perf-gate as the new baseline of the cassette.")
+    args = parser.parse_args()
+
+    if args.benchmark_members:
+        benchmark_member_records(args.benchmark_members)
+        sys.exit(0)
+    if args.record:
+        sys.exit(record_cassette(args.record))
+    if args.replay:
+        sys.exit(replay_cassette(args.replay)["exit_code"])
+    if args.perf_gate:
+        sys.exit(0 if run_perf_gate(args.perf_gate, args.baseline, args.update_baseline) else 1)
+    if args.bulk_users:
+        onboard_users(read_bulk_users(args.bulk_users), get_access_token())
+        sys.exit(0)
+
+    if args.merge_reports:
+        merge_shard_reports(args.merge_reports)
+        sys.exit(0)
+    if args.processes and args.processes > 1:
+        sys.exit(run_shard_processes(args.processes, (["--fresh"] if args.fresh else []) +
+                                     (["--full-apply"] if args.full_apply else [])))
+    if args.shard:
+        configure_shard(*args.shard)
+    if args.full_apply:
+        snapshot_diff_apply = False
+    run_started = time.perf_counter()
+    start_run_budget()
+
+    # Clean up the tmp files. Files of groups that an interrupted run did not finish are kept and resumed.
+    resumed_run = False
     try:
-        clean_up_tmp_files: None = clean_up_files('groups_users_sps')
+        resumed_run = start_checkpointed_run(fresh=args.fresh)
+        start_snapshots()
         logging.info("clean_up_files Function Completed Successfully.")
     except Exception as e:
         logging.error(f"Temp file cleanup function failes.")
@@ -904,266 +5047,124 @@ if __name__ == "__main__":
         logging.error(f"Access Token Error: {e}")
 
 
+    # Staged groups are applied to all Databricks targets at the same time, one thread per target. In pipelined
+    # runs every group is applied as soon as it is staged, while the next groups are crawled.
+    apply_pipeline = ApplyPipeline(sync_targets, token, pipelined=pipeline_enabled)
+
     ######################################
     # Check the groups_to_sync.json File #
     ######################################
-    with open('groups_to_sync.json', 'r') as items:
-        items_to_sync = json.load(items)
-        # Check what are all the items we need to sync for this run.
-        keys = [key for key, value in items_to_sync.items() if isinstance(value, list) and len(value) > 0]
-        items_found = []
-        for key in keys:
-            value = items_to_sync[key]
-            if f"{key}" == "group_ids":
-                logging.info(f"The following {key} along with its values will be sync'd from your Azure EntraID to "
-                             f"Azure Databricks Account.")
-                logging.info(f"{key}: {value}")
-
-                for group_id in value:
-                    logging.info("####################################################################################")
-                    logging.info(f"Now working on GROUP ID: {group_id}")
-                    logging.info("The following 3 files will be created for this group id")
-                    logging.info(f"Groups File name: groups_users_sps/{group_id}_tmp_groups.txt")
-                    logging.info(f"User File name: groups_users_sps/{group_id}_tmp_users.txt")
-                    logging.info(f"Service Principal File name: groups_users_sps/{group_id}_tmp_sp.txt")
-                    logging.info("####################################################################################")
-
-                    ################################################
-                    # Get transitive group members based on GroupID#
-                    ################################################
-                    try:
-                        transitive_members = get_transitive_members_for_group(group_id)
-                        logging.info("Transitive members identified.")
-                        logging.info("Transitive members can be AD groups or Users or Service Principals.")
-                        groups_users = transitive_members["value"]
-                        logging.info(groups_users)
-
-                        #####################################################
-                        # Append the original group name to the groups file #
-                        #####################################################
-                        orig_group_details = get_original_group_details(group_id, token)
-                        logging.info(orig_group_details)
-
-                        #################
-                        # Group details #
-                        #################
-                        try:
-                            all_group = get_all_group_details(groups_users, orig_group_details,
-                                                              f"groups_users_sps/{group_id}_tmp_groups.txt")
-                            logging.info(all_group)
-                        except Exception as e:
-                            logging.error(f"get_all_group_details Function encountered an error: {e}")
-                            break
-
-                        ################
-                        # User details #
-                        ################
-                        try:
-                            all_user = get_all_user_details(groups_users, f"groups_users_sps/{group_id}_tmp_users.txt")
-                            logging.info(all_user)
-                        except Exception as e:
-                            logging.error(f"get_all_user_details Function encountered an error: {e}")
-                            break
-
-                        ######################
-                        # Service Principals #
-                        ######################
-                        try:
-                            service_principals_details = get_service_principal_details(
-                                f"groups_users_sps/{group_id}_tmp_groups.txt", token,
-                                f"groups_users_sps/{group_id}_tmp_sp.txt")
-                            logging.info(service_principals_details)
-                        except Exception as e:
-                            logging.error(f"get_service_principal_details Function encountered an error: {e}")
-                            break
-
-                    except AzureAPIError as e:
-                        logging.error(f"Function encountered an error: {e}")
-                    except Exception as e:
-                        logging.error(f"Unhandled error occurred: {e}")
-
-            elif f"{key}" == "group_names":
-                logging.info(f"The following {key} along with its values will be sync'd from your Azure EntraID to "
-                             f"Azure Databricks Account.")
-                logging.info(f"{key}: {value}")
-                # Using the group name, get the Group ID. Once the group ID is obtained, follow the steps above.
-                # call the Azure Graph API to get the group ID using the group name.
-
-                for group_name in value:
-                    group_id_from_group_name = get_group_id_from_name(group_name, token)
-                    if group_id_from_group_name:
-                        logging.info(f"{group_id_from_group_name} is the group id for group name {group_name}")
-                        for group_id in value:
-                            logging.info(
-                                "####################################################################################")
-                            logging.info(f"Now working on GROUP ID: {group_id_from_group_name}")
-                            logging.info("The following 3 files will be created for this group id")
-                            logging.info(f"Group File name: groups_users_sps/{group_id_from_group_name}_tmp_groups.txt")
-                            logging.info(f"User File name: groups_users_sps/{group_id_from_group_name}_tmp_users.txt")
-                            logging.info(f"Service Principal File name: groups_users_sps/{group_id_from_group_name}"
-                                         f"_tmp_sp.txt")
-                            logging.info(
-                                "####################################################################################")
-
-                            ################################################
-                            # Get transitive group members based on GroupID#
-                            ################################################
-                            try:
-                                transitive_members = get_transitive_members_for_group(group_id_from_group_name)
-                                logging.info("Transitive members identified.")
-                                logging.info("Transitive members can be AD groups or Users or Service Principals.")
-                                groups_users = transitive_members["value"]
-                                logging.info(groups_users)
-
-                                #####################################################
-                                # Append the original group name to the groups file #
-                                #####################################################
-                                orig_group_details = get_original_group_details(group_id_from_group_name, token)
-                                logging.info(orig_group_details)
-
-                                #################
-                                # Group details #
-                                #################
-                                try:
-                                    all_group = get_all_group_details(groups_users, orig_group_details,
-                                                                      f"groups_users_sps/{group_id_from_group_name}"
-                                                                      f"_tmp_groups.txt")
-                                    logging.info(all_group)
-                                except Exception as e:
-                                    logging.error(f"get_all_group_details Function encountered an error: {e}")
-                                    break
-
-                                ################
-                                # User details #
-                                ################
-                                try:
-                                    all_user = get_all_user_details(groups_users,
-                                                     f"groups_users_sps/{group_id_from_group_name}_tmp_users.txt")
-                                    logging.info(all_user)
-                                except Exception as e:
-                                    logging.error(f"get_all_user_details Function encountered an error: {e}")
-                                    break
-
-                                ######################
-                                # Service Principals #
-                                ######################
-                                try:
-                                    service_principals_details = get_service_principal_details(
-                                        f"groups_users_sps/{group_id_from_group_name}_tmp_groups.txt", token,
-                                        f"groups_users_sps/{group_id_from_group_name}_tmp_sp.txt")
-                                    logging.info(service_principals_details)
-                                except Exception as e:
-                                    logging.error(f"get_service_principal_details Function encountered an error: {e}")
-                                    break
-
-                            except AzureAPIError as e:
-                                logging.error(f"Function encountered an error: {e}")
-                            except Exception as e:
-                                logging.error(f"Unhandled error occurred: {e}")
-                    else:
-                        logging.error(f"{group_name} Was Not Found in Azure. Exiting.")
-                        break
-
-            elif f"{key}" == "users":
-                logging.info(f"The following Azure AD {key} will be created in Azure Databricks Account.")
-                logging.info(f"{key}: {value}")
-                # users: ['DB_User4']
-                # Check if this user exists in Azure AD. If Yes, then proceed to next step. Else, exit.
-                # If user exists in Azure AD then, check if user exists in Databricks. If user exists, then exit.
-                # If user does not exist in Databricks Account, then create the user.
-                for user in value:
-                    logging.info(f"Validating to make sure that the {user} exists in Azure AD.")
-                    azure_ad_user_status = get_azure_user(user, token)
-                    if len(azure_ad_user_status['value']) > 0:
-                        logging.info(f"User {user} is a valid user in Azure AD. Now will check if this user exists "
-                                     f"in Databricks Account before creating.")
-                        # check if this user exists in Databricks Account.
-                        display_name = azure_ad_user_status['value'][0]['displayName']
-                        name = azure_ad_user_status['value'][0]['displayName']
-
-                        check_if_user_exists_in_dba = a.users.list(filter=f"displayName eq '{display_name}'")
-                        check_if_user_exists_in_dba_list = list(check_if_user_exists_in_dba)
-
-                        if len(check_if_user_exists_in_dba_list) > 0:
-                            logging.info(f"User {display_name} already exists in Databricks Account. No action taken.")
+    try:
+        with open('groups_to_sync.json', 'r') as items:
+            items_to_sync = json.load(items)
+            # Check what are all the items we need to sync for this run.
+            keys = [key for key, value in items_to_sync.items() if isinstance(value, list) and len(value) > 0]
+            items_found = []
+            # (group id, group name) of the groups to sync, crawled below in the order of the scheduler.
+            group_entries = []
+            for key in keys:
+                value = items_to_sync[key]
+                if f"{key}" == "group_ids":
+                    logging.info(f"The following {key} along with its values will be sync'd from your Azure EntraID to "
+                                 f"Azure Databricks Account.")
+                    logging.info(f"{key}: {value}")
+
+                    for group_id in value:
+                        if not shard_owns(group_id):
+                            continue
+                        group_entries.append((group_id, None))
+
+                elif f"{key}" == "group_names":
+                    logging.info(f"The following {key} along with its values will be sync'd from your Azure EntraID to "
+                                 f"Azure Databricks Account.")
+                    logging.info(f"{key}: {value}")
+                    # Using the group name, get the Group ID. Once the group ID is obtained, follow the steps above.
+                    # call the Azure Graph API to get the group ID using the group name.
+
+                    # Groups are sharded by id, so a group listed by name and by id (or matched by a pattern)
+                    # belongs to one shard only.
+                    for group_name in value:
+                        group_id_from_group_name = get_group_id_from_name(group_name, token)
+                        if group_id_from_group_name:
+                            logging.info(f"{group_id_from_group_name} is the group id for group name {group_name}")
+                            if shard_owns(group_id_from_group_name):
+                                group_entries.append((group_id_from_group_name, group_name))
                         else:
-                            logging.info(f"User {display_name} will now be created in Databricks Account.")
-                            create_db_user = a.users.create(active=True, display_name=display_name,
-                                                            user_name=display_name)
-                            logging.info(create_db_user)
-
-                    else:
-                        logging.error(f"User {user} is not a Valid user in Azure AD.")
-                        exit(99)
-
-            items_found.append(key)
-
-    ###############################################################################
-    # Now that we got all Azure entities, lets create them in Databricks Account. #
-    # at this stage all the temp files are created. We can now use the entries in #
-    # those temp files and create those identities in Databricks Account.
-    # The files can be grouped with the Azure EntraID group id. Look at the file
-    # naming convention.
-    ###############################################################################
-
-    tmp_file_location = 'groups_users_sps'
-    file_names = [f for f in os.listdir(tmp_file_location) if os.path.isfile(os.path.join(tmp_file_location, f))]
-    logging.info(file_names)
-    patterns_to_remove = ['_tmp_sp.txt', '_tmp_groups.txt', '_tmp_users.txt']
-    unique_ids = list({file.split('_')[0] for file in file_names})
-    logging.info(unique_ids)
-
-    for indv_group_id in unique_ids:
-        db_group_to_be_created = get_original_group_details(indv_group_id, token)
-        logging.info(db_group_to_be_created)
-        logging.info(db_group_to_be_created['displayName'])
-        # logging.info(f"The following group {db_group_to_be_created['displayName']}"
-        #              f" will be created in Databricks Account.")
-
-
-        # Check if this group already exists in Databricks Account.
-        check_if_group_present_in_db = check_db_group_existence(indv_group_id)
-        if check_if_group_present_in_db:
-            logging.info(f"The group: {db_group_to_be_created['displayName']} is present in Databricks already.")
-            # if the group is present in Databricks Account, we can add the users / SP to the existing group.
-            # before adding users or SP we first need to check if they are available in DB.
-            # now read the tmp files and see if we have to add both users and SP or just one of them.
-
-            # Read the temp files.
-            filtered_files = filter_tmp_files_by_group_id("groups_users_sps", indv_group_id)
-            logging.info(f"The following list of files will be scanned and the members in those "
-                         f"files will be created in Databricks Account.")
-            logging.info(filtered_files)
-
-            # The filtered_files list will have both the users and SPs or just one of them.
-            # Based on the files, we will call the process_files functions to call the creation of
-            # user or service principal or call both the functions to create both users and service principals..
-            if len(filtered_files) > 0:
-                process_files(filtered_files, db_group_to_be_created['displayName'])
-            else:
-                logging.info(f"This group does not have any members inside, so no action will be taken.")
-        else:
-            logging.info(f"The group: {db_group_to_be_created['displayName']} is not present in Databricks. "
-                         f"So we will now create this group in Databricks Account.")
+                            logging.error(f"{group_name} Was Not Found in Azure. Exiting.")
+                            break
 
-            # Now creating Databricks Account Group
-            # db_account_grp = create_db_account_group(db_group_to_be_created['displayName'])
-            # if db_account_grp:
-
-            # time.sleep(10)
-            # if the group is Not present in Databricks Account, then create the group first,
-            # then add the users/SP to the newly created group.
-            # before adding users or SP we first need to check if they are available in DB.
-            # now read the tmp files and see if we have to add both users and SP or just one of them.
-            filtered_files = filter_tmp_files_by_group_id("groups_users_sps", indv_group_id)
-            logging.info(f"The following list of files will be scanned and the members in those "
-                         f"files will be created in Databricks Account.")
-            logging.info(filtered_files)
-
-            # The filtered_files list will have both the users and SPs or just one of them.
-            # Based on the files, we will call the process_files functions to call the creation of
-            # user or service principal or call both the functions to create both users and service principals..
-            if len(filtered_files) > 0:
-                process_files(filtered_files, db_group_to_be_created['displayName'])
-            else:
-                logging.info(f"This group does not have any members inside, so no action will be taken.")
+                elif f"{key}" == "users":
+                    logging.info(f"The following Azure AD {key} will be created in Azure Databricks Account.")
+                    logging.info(f"{key}: {value}")
+                    # Users that exist in Azure AD are created in every Databricks Account they are missing in.
+                    # Users that are not in Azure AD are listed in the result file and do not stop the run.
+                    onboard_users(({"displayName": user} for user in value if shard_owns(user)), token)
+
+                items_found.append(key)
+
+            # Groups selected by prefix, $search or administrative unit.
+            group_entries.extend(entry for entry in discover_groups(items_to_sync, token) if shard_owns(entry[0]))
+            # A group listed by id, by name or by several patterns is synced once, with the first name known for it.
+            group_names_by_id = {}
+            for group_id, group_name in group_entries:
+                group_names_by_id[group_id] = group_names_by_id.get(group_id) or group_name
+            group_entries = list(group_names_by_id.items())
+            # The performance gate counts the HTTP calls per group synced, see replay_cassette().
+            with http_lock:
+                http_stats["groups"] = len(group_entries)
+
+            # Crawl the groups by priority and deadline. Each group is applied as soon as it is staged.
+            scheduled_groups = schedule_groups(group_entries, items_to_sync.get("group_settings"))
+            for scheduled_group in scheduled_groups:
+                if not may_start_group(scheduled_group.group_id):
+                    continue
+                if not crawl_group(scheduled_group.group_id, token, scheduled_group.member_filter):
+                    break
+                if checkpoint_phase_reached(scheduled_group.group_id, "staged"):
+                    apply_pipeline.submit(scheduled_group.group_id)
+
+        ###############################################################################
+        # Now that we got all Azure entities, lets create them in Databricks Account. #
+        # at this stage all the temp files are created. We can now use the entries in #
+        # those temp files and create those identities in Databricks Account.
+        # The files can be grouped with the Azure EntraID group id. Look at the file
+        # naming convention.
+        ###############################################################################
+
+        # Groups staged by an interrupted run that were not crawled again in this run are applied as well. Temp files
+        # of groups whose staging failed are incomplete and are not applied.
+        tmp_file_location = tmp_files_folder
+        file_names = [f for f in os.listdir(tmp_file_location) if os.path.isfile(os.path.join(tmp_file_location, f))]
+        logging.debug("file_names: %s", file_names)
+        unique_ids = list({file.split('_')[0] for file in file_names})
+        logging.debug("unique_ids: %s", unique_ids)
+        for group_id in unique_ids:
+            if checkpoint_phase_reached(group_id, "staged"):
+                apply_pipeline.submit(group_id)
+    finally:
+        # Wait until all submitted groups are applied to all targets.
+        target_results = apply_pipeline.close()
+
+    finish_deprovisioning(target_results, resumed_run)
+    finish_snapshots()
+    finish_checkpointed_run(resumed_run)
+    finish_schedule(list(dict.fromkeys([group.group_id for group in scheduled_groups] + apply_pipeline.submitted)))
+    if shard_count > 1:
+        write_run_report({
+            "shard": f"{shard_index}/{shard_count}",
+            "groups": len(apply_pipeline.submitted),
+            "elapsed_s": round(time.perf_counter() - run_started, 3),
+            "targets": {target.name: result for target, result in zip(sync_targets, target_results)},
+            "verification": get_verification_summary(),
+            "traversal": dict(traversal_stats),
+            "graph": graph_payload_stats,
+            "graph_cache": graph_cache_stats,
+            "throttling": get_throttling_summary(),
+            "deprovisioning": get_deprovisioning_report(target_results, resumed_run),
+        })
+    log_verification_summary()
+    log_traversal_summary()
+    log_graph_payload_summary()
+    log_graph_cache_summary()
+    log_throttling_summary()
+    save_graph_cache()
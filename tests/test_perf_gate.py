@@ -0,0 +1,56 @@
+"""
+Runs the performance gate on the committed cassette, see "Recording, replay and the performance gate" in README.md.
+
+cassettes/large_tenant.json was recorded with record_cassette from 36 groups (listed by id, by name, by name prefix
+and by administrative unit) with 360 users, nested groups and service principals, some of which already exist in the
+Databricks Account.
+"""
+import configparser
+import json
+import os
+import subprocess
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+main_file = os.path.join(os.path.dirname(tests_dir), "main.py")
+cassette_file = os.path.join(tests_dir, "cassettes", "large_tenant.json")
+baseline_file = os.path.join(tests_dir, "perf_baseline.json")
+
+
+def run_perf_gate(work_dir, baseline):
+    """
+        Runs 'main.py --perf-gate' on the cassette in 'work_dir', without network access.
+
+        The gate itself runs with the cred.ini of the cassette and replays the cassette too, as the Azure login and
+        the Databricks client are set up when main.py starts. The replayed wall time depends on the machine, so only
+        the calls per group and the bytes are compared with their configured tolerances.
+    """
+    with open(cassette_file, "r") as cassette_in:
+        meta = json.load(cassette_in)["meta"]
+    cred = configparser.ConfigParser()
+    cred.read_string(meta["cred_ini"])
+    cred.read_dict({"perf_gate": {"wall_tolerance_percent": "1000"}})
+    with open(os.path.join(work_dir, "cred.ini"), "w") as cred_out:
+        cred.write(cred_out)
+    os.makedirs(os.path.join(work_dir, "logs"), exist_ok=True)
+    env = dict(os.environ, AD_SYNC_REPLAY=cassette_file, DATABRICKS_TOKEN="REDACTED")
+    return subprocess.run([sys.executable, main_file, "--perf-gate", cassette_file, "--baseline", baseline],
+                          cwd=work_dir, env=env, capture_output=True, text=True, timeout=300)
+
+
+def test_perf_gate_passes_on_committed_baseline(tmp_path):
+    result = run_perf_gate(tmp_path, baseline_file)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "http_replay_miss" not in result.stdout + result.stderr
+
+
+def test_perf_gate_fails_when_calls_per_group_grow(tmp_path):
+    with open(baseline_file, "r") as baseline_in:
+        baselines = json.load(baseline_in)
+    baselines["large_tenant.json"]["calls_per_group"] -= 1
+    tightened_file = os.path.join(tmp_path, "perf_baseline.json")
+    with open(tightened_file, "w") as baseline_out:
+        json.dump(baselines, baseline_out)
+    result = run_perf_gate(tmp_path, tightened_file)
+    assert result.returncode == 1, result.stdout + result.stderr
+    assert "calls_per_group" in result.stdout + result.stderr